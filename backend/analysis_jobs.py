@@ -0,0 +1,472 @@
+# this file runs library analyses, either inline for /api/analyze or as jobs taken from the Postgres-backed queue
+# Start analysis workers with `python analysis_jobs.py --processes N` (separately from the web server)
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+from lyrics_service import analyze_user_library, analyze_library_changes, upstream_metrics
+import spotify_service
+from db import (
+    get_or_create_user, insert_tracks, get_user_library_state,
+    get_mood_uris_for_user, delete_user_tracks, wait_for_db,
+    enqueue_analysis_job, claim_analysis_job, update_analysis_job_progress, finish_analysis_job, get_analysis_job,
+    store_upstream_metrics
+)
+
+logger = logging.getLogger(__name__)
+
+# Queue /api/analyze requests for analysis workers instead of analyzing inside the web request
+ANALYSIS_QUEUE_ENABLED = os.getenv('ANALYSIS_QUEUE_ENABLED', 'false').lower() == 'true'
+ANALYSIS_WORKER_PROCESSES = int(os.getenv('ANALYSIS_WORKER_PROCESSES', '1'))
+ANALYSIS_WORKER_POLL_SECONDS = float(os.getenv('ANALYSIS_WORKER_POLL_SECONDS', '2'))
+# A running job whose heartbeat is older than this is marked failed and gives up its lease
+ANALYSIS_JOB_STALE_SECONDS = int(os.getenv('ANALYSIS_JOB_STALE_SECONDS', '300'))
+# A queued job no worker claimed within this long is marked failed (e.g. no analysis worker is running)
+ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS = int(os.getenv('ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS', '600'))
+# Minimum time between progress writes, so per-track progress doesn't turn into per-track UPDATEs
+PROGRESS_WRITE_INTERVAL_SECONDS = float(os.getenv('ANALYSIS_PROGRESS_WRITE_INTERVAL_SECONDS', '2'))
+# Minimum time between streamed progress events within a phase (classified tracks are never held back)
+STREAM_PROGRESS_INTERVAL_SECONDS = float(os.getenv('ANALYSIS_STREAM_PROGRESS_INTERVAL_SECONDS', '0.5'))
+# Idle streams get a heartbeat event this often so proxies don't close them
+STREAM_HEARTBEAT_SECONDS = float(os.getenv('ANALYSIS_STREAM_HEARTBEAT_SECONDS', '15'))
+# Limiters, breakers and HTTP sessions live in each process, so processes that analyze libraries save
+# their upstream metrics to the database (for /api/metrics/upstreams) this often and after each analysis
+UPSTREAM_METRICS_PUBLISH_SECONDS = float(os.getenv('UPSTREAM_METRICS_PUBLISH_SECONDS', '30'))
+# Snapshots older than this (from processes that stopped or went idle) aren't reported
+UPSTREAM_METRICS_MAX_AGE_SECONDS = int(os.getenv('UPSTREAM_METRICS_MAX_AGE_SECONDS', '3600'))
+
+def classification_split(analyzed_tracks):
+    """Count how many tracks were labeled from the cache, each local classifier and the LLM."""
+    split = {"cache": 0, "local": 0, "knn": 0, "llm": 0}
+    for track in analyzed_tracks:
+        source = track.get('classification_source')
+        if source in split:
+            split[source] += 1
+    return split
+
+class TrackWriter:
+    """on_classified callback that stores each classified batch in the tracks table as soon as it
+    arrives, so /api/mood-tracks can serve the first moods while the rest of the library is analyzed.
+
+    With replace_existing, the batch's previously stored moods are deleted first (full re-analysis).
+    Otherwise only the rows of tracks in known_tracks (URI -> added_at) are replaced, i.e. tracks
+    re-analyzed because they were saved again, so their old moods and added_at don't linger.
+    Batches are also passed on to on_classified, if given (e.g. to stream them to the client).
+    """
+    def __init__(self, user_id, replace_existing=False, on_classified=None, known_tracks=None):
+        self.user_id = user_id
+        self.replace_existing = replace_existing
+        self.on_classified = on_classified
+        self.known_tracks = known_tracks or {}
+        self.written = 0
+
+    def __call__(self, analyzed_tracks):
+        if self.replace_existing:
+            delete_user_tracks(self.user_id, [track['uri'] for track in analyzed_tracks])
+        else:
+            delete_user_tracks(self.user_id, [track['uri'] for track in analyzed_tracks if track['uri'] in self.known_tracks])
+        insert_tracks(self.user_id, analyzed_tracks, replace=False)
+        self.written += len(analyzed_tracks)
+        if self.on_classified:
+            self.on_classified(analyzed_tracks)
+
+def run_incremental_analysis(sp, spotify_id, progress=None, on_classified=None):
+    """Analyze only newly saved tracks and drop removed ones.
+
+    New tracks are stored batch by batch as they are classified.
+
+    Returns:
+        tuple: (response body, HTTP status, mood_uris), or None when a full analysis is needed
+    """
+    try:
+        user_id = get_or_create_user(spotify_id)
+        known_tracks = get_user_library_state(user_id)
+    except Exception as e:
+        logger.error(f"Error loading stored tracks for incremental analysis: {e}")
+        return None
+
+    if not known_tracks:
+        print("--- No stored analysis for this user, running a full analysis ---")
+        sys.stdout.flush()
+        return None
+
+    print(f"--- Starting incremental analysis against {len(known_tracks)} stored tracks ---")
+    sys.stdout.flush()
+    writer = TrackWriter(user_id, on_classified=on_classified, known_tracks=known_tracks)
+    analyzed_tracks, _, removed_uris = analyze_library_changes(sp, known_tracks, progress, writer)
+
+    if progress:
+        progress('storing', tracks=len(analyzed_tracks), removed=len(removed_uris))
+    delete_user_tracks(user_id, removed_uris)
+
+    # Respond with the whole library's moods, not just the newly analyzed tracks
+    mood_uris = get_mood_uris_for_user(user_id)
+    if not mood_uris:
+        print("--- No moods stored after incremental analysis ---")
+        sys.stdout.flush()
+        return {
+            "error": "Analysis completed but no moods were assigned. Check logs for details.",
+            "tracks_analyzed": len(analyzed_tracks)
+        }, 404, None
+
+    mood_distribution = {mood: len(uris) for mood, uris in mood_uris.items()}
+    print(f"--- Incremental analysis complete: {len(analyzed_tracks)} new tracks, {len(removed_uris)} removed ---")
+    print(f"--- Final mood distribution: {json.dumps(mood_distribution, indent=2)} ---")
+    sys.stdout.flush()
+
+    return {
+        "message": "Successfully analyzed your music library",
+        "available_moods": list(mood_uris.keys()),
+        "tracks_analyzed": len(analyzed_tracks),
+        "tracks_removed": len(removed_uris),
+        "mood_distribution": mood_distribution,
+        "classification": classification_split(analyzed_tracks),
+        "mode": "incremental"
+    }, 200, mood_uris
+
+def run_full_analysis(sp, spotify_id, skip_db=False, progress=None, on_classified=None):
+    """Analyze the whole library and replace the user's stored tracks.
+
+    Tracks are stored batch by batch as they are classified; tracks that were stored before
+    but are no longer in the analysis are removed at the end.
+
+    Returns:
+        tuple: (response body, HTTP status, mood_uris)
+    """
+    writer = on_classified
+    stored_uris = None
+    if not skip_db:
+        try:
+            # Each database operation uses its own fresh connection in serverless
+            user_id = get_or_create_user(spotify_id)
+            stored_uris = get_user_library_state(user_id)
+            if stored_uris is not None:
+                writer = TrackWriter(user_id, replace_existing=True, on_classified=on_classified)
+        except Exception as e:
+            logger.error(f"Error loading stored tracks before full analysis: {e}")
+        if stored_uris is None:
+            print("--- Database unavailable, analysis only available in current session ---")
+            sys.stdout.flush()
+
+    print("--- Starting library analysis, this may take a minute... ---")
+    sys.stdout.flush()
+    analyzed_tracks, mood_uris = analyze_user_library(sp, progress=progress, on_classified=writer)
+
+    # Verify that ALL tracks have been analyzed and assigned moods
+    if not analyzed_tracks:
+        print("--- No tracks returned from analysis ---")
+        sys.stdout.flush()
+        return {
+            "error": "Analysis completed but no tracks were found. Check logs for details.",
+        }, 404, None
+
+    # Check if all tracks have moods assigned
+    tracks_without_moods = [t for t in analyzed_tracks if not t.get('moods') or len(t.get('moods', [])) == 0]
+    if tracks_without_moods:
+        print(f"--- Warning: {len(tracks_without_moods)} tracks have no moods assigned ---")
+        sys.stdout.flush()
+
+    # Verify we have mood data
+    if not mood_uris or len(mood_uris) == 0:
+        print("--- No moods returned from analysis ---")
+        sys.stdout.flush()
+        return {
+            "error": "Analysis completed but no moods were assigned. Check logs for details.",
+            "tracks_analyzed": len(analyzed_tracks)
+        }, 404, None
+
+    print(f"--- Analysis completed successfully with {len(analyzed_tracks)} tracks and {len(mood_uris)} moods ---")
+    sys.stdout.flush()
+
+    # The tracks were stored as they were classified; drop the ones this analysis didn't label
+    if isinstance(writer, TrackWriter):
+        stale_uris = set(stored_uris) - {track['uri'] for track in analyzed_tracks}
+        if progress:
+            progress('storing', tracks=len(analyzed_tracks), removed=len(stale_uris))
+        delete_user_tracks(writer.user_id, stale_uris)
+        print(f"--- Stored {writer.written} tracks in database for user {writer.user_id}, removed {len(stale_uris)} stale ones ---")
+        sys.stdout.flush()
+
+    # Collect all unique moods found in the analysis
+    moods = set(mood for track in analyzed_tracks for mood in track.get('moods', []))
+
+    # Calculate mood distribution for the response
+    mood_distribution = {}
+    if mood_uris:
+        for mood in moods:
+            if mood in mood_uris:
+                mood_distribution[mood] = len(mood_uris[mood])
+
+    print(f"--- Analysis complete: {len(analyzed_tracks)} tracks analyzed, {len(moods)} unique moods found ---")
+    print(f"--- Final mood distribution: {json.dumps(mood_distribution, indent=2)} ---")
+    sys.stdout.flush()
+
+    # Log detailed breakdown for immediate visibility
+    if mood_uris:
+        print("\n--- DETAILED MOOD BREAKDOWN (API) ---")
+        sys.stdout.flush()
+        for mood, uris in mood_uris.items():
+            print(f"{mood}: {len(uris)} tracks")
+            sys.stdout.flush()
+        print("--- END MOOD BREAKDOWN ---")
+        sys.stdout.flush()
+
+    return {
+        "message": "Successfully analyzed your music library",
+        "available_moods": list(moods),
+        "tracks_analyzed": len(analyzed_tracks),
+        "mood_distribution": mood_distribution,
+        "classification": classification_split(analyzed_tracks),
+        "mode": "full"
+    }, 200, mood_uris
+
+def run_analysis(sp, spotify_id, mode='incremental', skip_db=False, progress=None, on_classified=None):
+    """Analyze a user's library incrementally when possible, otherwise in full.
+
+    on_classified(analyzed_tracks), if given, receives each batch of tracks as soon as it is classified.
+
+    Returns:
+        tuple: (response body, HTTP status, mood_uris or None on failure)
+    """
+    if mode == 'incremental' and not skip_db:
+        result = run_incremental_analysis(sp, spotify_id, progress, on_classified)
+        if result is not None:
+            return result
+    return run_full_analysis(sp, spotify_id, skip_db, progress, on_classified)
+
+def publish_upstream_metrics(process_id):
+    """Save this process's upstream metrics under process_id."""
+    store_upstream_metrics(process_id, upstream_metrics())
+
+def wait_for_analysis_job(job_id, progress=None):
+    """Poll another process's job until it finishes, passing its progress on to progress(phase, **details).
+
+    Returns:
+        dict: The finished job, or None if it disappeared, its worker stopped sending heartbeats
+        or no worker claimed it within ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS
+    """
+    while True:
+        job = get_analysis_job(job_id)
+        if job is None:
+            return None
+        if job['status'] in ('completed', 'failed'):
+            return job
+        if job['status'] == 'running' and (job['heartbeat_age'] or 0) > ANALYSIS_JOB_STALE_SECONDS:
+            return None
+        if job['status'] == 'queued' and (job['age'] or 0) > ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS:
+            return None
+        if progress and job['phase']:
+            progress(job['phase'], **(job['progress'] or {}))
+        time.sleep(ANALYSIS_WORKER_POLL_SECONDS)
+
+def run_single_flight_analysis(sp, spotify_id, mode='incremental', progress=None, on_classified=None):
+    """Run an analysis in this process, or attach to the one already in flight for the same user.
+
+    The user's analysis_jobs row is the lease (see enqueue_analysis_job), so concurrent requests
+    across web workers and analysis workers never analyze the same library twice or race on its
+    stored tracks. Attached callers get the in-flight run's progress and result; on_classified
+    only sees tracks classified by a run this call started.
+
+    Returns:
+        tuple: (response body, HTTP status, mood_uris or None on failure)
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:inline"
+    while True:
+        job_id, created = enqueue_analysis_job(
+            spotify_id, mode, worker_id=worker_id, stale_seconds=ANALYSIS_JOB_STALE_SECONDS,
+            queued_seconds=ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS
+        )
+        if job_id is None:
+            # No database to coordinate through; analyze without a lease
+            return run_analysis(sp, spotify_id, mode, progress=progress, on_classified=on_classified)
+
+        if created:
+            try:
+                with JobProgress(job_id, progress) as job_progress:
+                    body, status, mood_uris = run_analysis(sp, spotify_id, mode, progress=job_progress, on_classified=on_classified)
+            except Exception as e:
+                finish_analysis_job(job_id, 'failed', error=f"Analysis failed: {str(e)}")
+                raise
+            finally:
+                publish_upstream_metrics(worker_id)
+            finish_analysis_job(
+                job_id, 'completed' if status == 200 else 'failed',
+                result=dict(body, status_code=status), error=body.get('error')
+            )
+            return body, status, mood_uris
+
+        print(f"--- Analysis already in flight for {spotify_id} (job {job_id}), waiting for its result ---")
+        sys.stdout.flush()
+        job = wait_for_analysis_job(job_id, progress)
+        if job is None:
+            # The run we attached to died or was never picked up; go around and take the lease over
+            continue
+        body = dict(job['result'] or {"error": job['error'] or "Analysis failed"})
+        status = body.pop('status_code', 200 if job['status'] == 'completed' else 500)
+        if status != 200:
+            return body, status, None
+        return body, status, get_mood_uris_for_user(get_or_create_user(spotify_id))
+
+def stream_analysis(sp, spotify_id, mode='incremental'):
+    """Run an analysis in a background thread and yield its events as they happen.
+
+    Yields dicts with an 'event' key:
+        'progress': phase and progress details, at most every STREAM_PROGRESS_INTERVAL_SECONDS per phase
+        'tracks': a batch of classified tracks (uri, name, artist, moods), already stored in the database
+        'heartbeat': nothing happened for STREAM_HEARTBEAT_SECONDS
+        'done': the final response body and its status_code, or 'error' if the analysis raised
+    If the client stops reading, the analysis still runs to completion and stores its results.
+    A stream for a user whose analysis is already in flight follows that run instead
+    (progress and the final result, but no 'tracks' events).
+    """
+    events = queue.Queue()
+    # Extraction and classification overlap, so each phase is throttled on its own
+    last_progress = {}
+
+    def progress(phase, **details):
+        now = time.time()
+        if now - last_progress.get(phase, 0) < STREAM_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_progress[phase] = now
+        events.put(dict(details, event='progress', phase=phase))
+
+    def on_classified(analyzed_tracks):
+        events.put({
+            'event': 'tracks',
+            'tracks': [{key: track[key] for key in ('uri', 'name', 'artist', 'moods')} for track in analyzed_tracks]
+        })
+
+    def run():
+        try:
+            body, status, _ = run_single_flight_analysis(sp, spotify_id, mode, progress, on_classified)
+            events.put(dict(body, event='done', status_code=status))
+        except Exception as e:
+            logger.error(f"Error in streamed analysis for {spotify_id}: {e}")
+            traceback.print_exc()
+            events.put({'event': 'error', 'error': f"Analysis failed: {str(e)}"})
+        finally:
+            events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        try:
+            event = events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+        except queue.Empty:
+            yield {'event': 'heartbeat'}
+            continue
+        if event is None:
+            return
+        yield event
+
+class JobProgress:
+    """Progress callback for a queued job: writes phase/progress to the job row at most every
+    PROGRESS_WRITE_INTERVAL_SECONDS, and keeps the job's heartbeat fresh in the background
+    so long phases (e.g. waiting on the LLM) don't look like a dead worker.
+
+    Extraction and classification overlap, so details from every phase are merged and only
+    a phase reported for the first time is written right away. Progress is also passed on to
+    on_progress(phase, **details), if given."""
+    def __init__(self, job_id, on_progress=None):
+        self.job_id = job_id
+        self.on_progress = on_progress
+        self.phase = 'starting'
+        self.phases_seen = set()
+        self.details = {}
+        self.last_write = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+
+    def __call__(self, phase, **details):
+        if self.on_progress:
+            self.on_progress(phase, **details)
+        with self.lock:
+            phase_changed = phase not in self.phases_seen
+            self.phases_seen.add(phase)
+            self.phase = phase
+            self.details = dict(self.details, **details)
+            details = self.details
+            if not phase_changed and time.time() - self.last_write < PROGRESS_WRITE_INTERVAL_SECONDS:
+                return
+            self.last_write = time.time()
+        update_analysis_job_progress(self.job_id, phase, details)
+
+    def _heartbeat(self):
+        while not self.stopped.wait(ANALYSIS_JOB_STALE_SECONDS / 3):
+            with self.lock:
+                phase, details = self.phase, self.details
+                self.last_write = time.time()
+            update_analysis_job_progress(self.job_id, phase, details)
+
+    def __enter__(self):
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.heartbeat.join()
+
+def process_job(job):
+    """Run one claimed analysis job and record its result."""
+    print(f"--- Analysis job {job['id']} ({job['mode']}) for user {job['spotify_id']}, attempt {job['attempts']} ---")
+    sys.stdout.flush()
+    try:
+        sp = spotify_service.get_spotify_client_from_token_info(job['token_info'])
+        with JobProgress(job['id']) as progress:
+            body, status, _ = run_analysis(sp, job['spotify_id'], job['mode'], progress=progress)
+        finish_analysis_job(
+            job['id'], 'completed' if status == 200 else 'failed',
+            result=dict(body, status_code=status), error=body.get('error')
+        )
+    except Exception as e:
+        logger.error(f"Error in analysis job {job['id']}: {e}")
+        traceback.print_exc()
+        finish_analysis_job(job['id'], 'failed', error=f"Analysis failed: {str(e)}")
+
+def run_worker():
+    """Process queued analysis jobs one at a time, forever."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"--- Analysis worker {worker_id} polling for jobs ---")
+    sys.stdout.flush()
+
+    def publish_metrics():
+        # Keeps the snapshot fresh during long analyses, which run on the main thread
+        while True:
+            publish_upstream_metrics(worker_id)
+            time.sleep(UPSTREAM_METRICS_PUBLISH_SECONDS)
+
+    threading.Thread(target=publish_metrics, daemon=True).start()
+    while True:
+        job = claim_analysis_job(worker_id, ANALYSIS_JOB_STALE_SECONDS)
+        if job is None:
+            time.sleep(ANALYSIS_WORKER_POLL_SECONDS)
+            continue
+        process_job(job)
+        publish_upstream_metrics(worker_id)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run analysis workers that process queued /api/analyze jobs")
+    parser.add_argument('--processes', type=int, default=ANALYSIS_WORKER_PROCESSES,
+                        help="number of worker processes (each analyzes one library at a time)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not wait_for_db():
+        print("Database not available, analysis workers can't start")
+        sys.exit(1)
+
+    if args.processes <= 1:
+        run_worker()
+    else:
+        workers = [multiprocessing.Process(target=run_worker) for _ in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -1,18 +1,20 @@
 from dotenv import load_dotenv
 import os
 import sys # For flushing output
+import json
 import traceback
+import hmac
 from datetime import timedelta  
-from flask import Flask, request, jsonify, redirect, session
+from flask import Flask, Response, request, jsonify, redirect, session
 from flask_cors import CORS
 import time
-from lyrics_service import analyze_user_library, get_tracks_for_mood
+from lyrics_service import get_tracks_for_mood
+from analysis_jobs import run_analysis, run_single_flight_analysis, stream_analysis, ANALYSIS_QUEUE_ENABLED, ANALYSIS_JOB_STALE_SECONDS, ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS, UPSTREAM_METRICS_MAX_AGE_SECONDS
 import spotify_service
-from db import get_or_create_user, insert_tracks, get_tracks_by_mood, delete_tracks_for_user, get_db_connection, init_database_config, close_db_connection
+from db import get_or_create_user, get_tracks_by_mood, delete_tracks_for_user, get_db_connection, init_database_config, close_db_connection, get_mood_uris_for_user, enqueue_analysis_job, get_analysis_job, expire_queued_analysis_job, get_upstream_metrics, has_active_analysis_job
 import logging
 import random
 from migrations import run_migrations
-import json
 
 # Set up logging
 logging.basicConfig(
@@ -79,6 +81,8 @@ app.secret_key = os.getenv("FLASK_SECRET_KEY")
 # --- Environment-Specific Configuration ---
 IS_PRODUCTION = os.getenv('FLASK_ENV') == 'production'
 backend_port_local_dev = os.getenv('PORT', '5001')
+# Bearer token for the internal /api/metrics/upstreams endpoint, which is disabled when it isn't set
+UPSTREAM_METRICS_TOKEN = os.getenv('UPSTREAM_METRICS_TOKEN')
 
 if IS_PRODUCTION:
     fly_app_hostname = os.getenv('FLY_APP_HOSTNAME')
@@ -225,14 +229,40 @@ def spotify_logout():
     # Always clear session data
     session.pop('spotify_token_info', None)
     session.pop('mood_uris', None)
+    session.pop('mood_uris_from_db', None)
     session.modified = True 
     print("--- User logged out, session data cleared. ---")
     sys.stdout.flush()
     return jsonify({"message": "Logged out successfully"}), 200
 
+def queue_analysis(spotify_id, mode):
+    """Queue an analysis job for the analysis workers and return the 202 response to send, or None
+    if it couldn't be queued (a user with an analysis already queued or running gets that job instead of a new one)"""
+    job_id, created = enqueue_analysis_job(
+        spotify_id, mode, session.get('spotify_token_info'), stale_seconds=ANALYSIS_JOB_STALE_SECONDS,
+        queued_seconds=ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS
+    )
+    if job_id is None:
+        return None
+    session['analysis_job_id'] = job_id
+    # The worker stores tracks as it classifies them; serve moods from the database until it's done
+    session.pop('mood_uris', None)
+    session['mood_uris_from_db'] = True
+    session.modified = True
+    job = get_analysis_job(job_id) if not created else None
+    print(f"--- {'Queued' if created else 'Attached to in-flight'} analysis job {job_id} ({mode}) ---")
+    sys.stdout.flush()
+    return jsonify({
+        "job_id": job_id,
+        "status": job['status'] if job else "queued",
+        "status_url": f"/api/analyze/{job_id}",
+        "mode": job['mode'] if job else mode,
+        "attached": not created
+    }), 202
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_library_route():
-    """route to manually trigger library analysis"""
+    """route to manually trigger library analysis (queued for analysis workers when ANALYSIS_QUEUE_ENABLED)"""
     print("--- /api/analyze route hit ---")
     sys.stdout.flush()
     
@@ -248,98 +278,121 @@ def analyze_library_route():
             return jsonify({"error": "Could not fetch user profile from Spotify."}), 401
         spotify_id = user_profile['id']
         
-        # Analyze user's library (prioritize session storage for serverless)
-        try:
-            print("--- Starting library analysis, this may take a minute... ---")
-            sys.stdout.flush()
-            analyzed_tracks, mood_uris = analyze_user_library(sp, session)
-            
-            # Verify that ALL tracks have been analyzed and assigned moods
-            if not analyzed_tracks:
-                print("--- /api/analyze: No tracks returned from analysis ---")
-                sys.stdout.flush()
-                return jsonify({
-                    "error": "Analysis completed but no tracks were found. Check logs for details.",
-                }), 404
-                
-            # Check if all tracks have moods assigned
-            tracks_without_moods = [t for t in analyzed_tracks if not t.get('moods') or len(t.get('moods', [])) == 0]
-            if tracks_without_moods:
-                print(f"--- Warning: {len(tracks_without_moods)} tracks have no moods assigned ---")
-                sys.stdout.flush()
-                
-            # Verify we have mood data
-            if not mood_uris or len(mood_uris) == 0:
-                print("--- /api/analyze: No moods returned from analysis ---")
-                sys.stdout.flush()
-                return jsonify({
-                    "error": "Analysis completed but no moods were assigned. Check logs for details.",
-                    "tracks_analyzed": len(analyzed_tracks)
-                }), 404
-                
-            print(f"--- Analysis completed successfully with {len(analyzed_tracks)} tracks and {len(mood_uris)} moods ---")
+        # Default to incremental re-analysis (?mode=full forces re-analyzing everything)
+        skip_db = bool(request.args.get('skip_db'))
+        mode = 'full' if request.args.get('mode', 'incremental') != 'incremental' or skip_db else 'incremental'
+        
+        # Hand the analysis to the worker processes and return right away
+        if ANALYSIS_QUEUE_ENABLED and not skip_db:
+            queued = queue_analysis(spotify_id, mode)
+            if queued:
+                return queued
+            print("--- /api/analyze: Could not queue analysis job, analyzing inline ---")
             sys.stdout.flush()
-                
+        
+        try:
+            if skip_db:
+                body, status, mood_uris = run_analysis(sp, spotify_id, mode, skip_db)
+            else:
+                # Concurrent requests for the same user share one run (across gunicorn workers)
+                body, status, mood_uris = run_single_flight_analysis(sp, spotify_id, mode)
         except Exception as e:
             print(f"--- /api/analyze: Error during library analysis: {str(e)} ---")
             sys.stdout.flush()
             traceback.print_exc()
             return jsonify({"error": f"Analysis failed: {str(e)}"}), 500
-
-        # Store results in session - critical for serverless where DB may not be available
-        session['mood_uris'] = mood_uris
-        session['last_analysis'] = time.time()
-        session.modified = True
-        
-        # Try to store in database if option not explicitly disabled
-        if not request.args.get('skip_db'):
-            try:
-                # Each database operation uses its own fresh connection in serverless
-                user_id = get_or_create_user(spotify_id)
-                delete_tracks_for_user(user_id)
-                insert_tracks(user_id, analyzed_tracks)
-                print(f"--- Stored {len(analyzed_tracks)} tracks in database for user {user_id} ---")
-                sys.stdout.flush()
-            except Exception as e:
-                logger.error(f"Error saving to database in /api/analyze: {e}")
-                print(f"--- Failed to store tracks in database: {e}. Analysis only available in current session. ---")
-                sys.stdout.flush()
-                
-        # Collect all unique moods found in the analysis
-        moods = set(mood for track in analyzed_tracks for mood in track.get('moods', []))
-        
-        # Calculate mood distribution for the response
-        mood_distribution = {}
-        if mood_uris:
-            for mood in moods:
-                if mood in mood_uris:
-                    mood_distribution[mood] = len(mood_uris[mood])
         
-        print(f"--- Analysis complete: {len(analyzed_tracks)} tracks analyzed, {len(moods)} unique moods found ---")
-        print(f"--- Final mood distribution: {json.dumps(mood_distribution, indent=2)} ---")
-        sys.stdout.flush()
-        
-        # Log detailed breakdown for immediate visibility
-        if mood_uris:
-            print("\n--- DETAILED MOOD BREAKDOWN (API) ---")
-            sys.stdout.flush()
-            for mood, uris in mood_uris.items():
-                print(f"{mood}: {len(uris)} tracks")
-                sys.stdout.flush()
-            print("--- END MOOD BREAKDOWN ---")
-            sys.stdout.flush()
-        
-        return jsonify({
-            "message": "Successfully analyzed your music library",
-            "available_moods": list(moods),
-            "tracks_analyzed": len(analyzed_tracks),
-            "mood_distribution": mood_distribution
-        }), 200
+        if status == 200:
+            # Store results in session - critical for serverless where DB may not be available
+            session['mood_uris'] = mood_uris
+            session['last_analysis'] = time.time()
+            session.pop('mood_uris_from_db', None)
+            session.modified = True
+        return jsonify(body), status
     except Exception as e:
         logger.error(f"Error in analyze_library_route: {e}")
         traceback.print_exc()
         return jsonify({"error": f"Analysis failed: {str(e)}"}), 500
 
+@app.route('/api/analyze/<int:job_id>', methods=['GET'])
+def analysis_job_status_route(job_id):
+    """route to poll a queued analysis job's status and per-phase progress"""
+    # Only the session that queued the job may poll it
+    if session.get('analysis_job_id') != job_id:
+        return jsonify({"error": "Analysis job not found"}), 404
+    
+    job = get_analysis_job(job_id)
+    if not job:
+        return jsonify({"error": "Analysis job not found"}), 404
+    if job['status'] == 'queued' and (job['age'] or 0) > ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS:
+        # No worker picked it up (none running?); fail it so the client stops polling and can retry
+        expire_queued_analysis_job(job_id)
+        job = get_analysis_job(job_id) or job
+    
+    response = {
+        "job_id": job['id'],
+        "status": job['status'],
+        "mode": job['mode'],
+        "phase": job['phase'],
+        "progress": job['progress'] or {},
+        "created_at": job['created_at'].isoformat() if job['created_at'] else None,
+        "started_at": job['started_at'].isoformat() if job['started_at'] else None,
+        "finished_at": job['finished_at'].isoformat() if job['finished_at'] else None
+    }
+    if job['status'] == 'completed':
+        # The worker stored the analysis in the database; cache it in the session like an inline analysis
+        if not session.get('mood_uris') or session.get('last_analysis_job_id') != job_id:
+            user_id = get_or_create_user(job['spotify_id'])
+            session['mood_uris'] = get_mood_uris_for_user(user_id)
+            session['last_analysis'] = time.time()
+            session['last_analysis_job_id'] = job_id
+            session.pop('mood_uris_from_db', None)
+            session.modified = True
+        response.update(job['result'] or {})
+    elif job['status'] == 'failed':
+        response.update(job['result'] or {})
+        response['error'] = job['error'] or "Analysis failed"
+    return jsonify(response), 200
+
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_library_stream_route():
+    """route to run a library analysis and stream its progress and classified tracks as NDJSON
+    (with ANALYSIS_QUEUE_ENABLED the analysis is queued instead and the 202 job response is returned, as for /api/analyze)"""
+    print("--- /api/analyze/stream route hit ---")
+    sys.stdout.flush()
+    
+    sp = spotify_service.get_spotify_client_from_session()
+    if not sp:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    user_profile = sp.current_user()
+    if not user_profile:
+        return jsonify({"error": "Could not fetch user profile from Spotify."}), 401
+    spotify_id = user_profile['id']
+    mode = 'full' if request.args.get('mode', 'incremental') != 'incremental' else 'incremental'
+    
+    # Analyses belong on the workers when there are any; clients poll the job instead of reading a stream
+    if ANALYSIS_QUEUE_ENABLED:
+        queued = queue_analysis(spotify_id, mode)
+        if queued:
+            return queued
+    
+    # Tracks are stored as they are classified, so /api/mood-tracks reads the database instead of
+    # the session cache; the session is sent before the stream starts and can't be updated at the end
+    session.pop('mood_uris', None)
+    session['mood_uris_from_db'] = True
+    session.modified = True
+    
+    def generate():
+        for event in stream_analysis(sp, spotify_id, mode):
+            yield json.dumps(event) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        # Don't let nginx-style proxies buffer the stream
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/mood-tracks', methods=['GET'])
 def get_mood_tracks_route():
     """Get tracks for a specific mood from the database"""
@@ -358,8 +411,10 @@ def get_mood_tracks_route():
         logger.warning("No mood specified in /api/mood-tracks")
         return jsonify({"error": "No mood specified"}), 400
     
-    # First check if we have tracks in session (prioritize session for serverless context)
-    session_mood_uris = session.get('mood_uris', {})
+    # First check if we have tracks in session (prioritize session for serverless context),
+    # unless an analysis has been storing tracks incrementally and the database is ahead of the session
+    read_from_db = session.get('mood_uris_from_db', False)
+    session_mood_uris = {} if read_from_db else session.get('mood_uris', {})
     if session_mood_uris and mood in session_mood_uris and session_mood_uris[mood]:
         # Use cached tracks from session
         track_uris = session_mood_uris[mood]
@@ -387,6 +442,26 @@ def get_mood_tracks_route():
             # Each database operation gets its own fresh connection
             user_id = get_or_create_user(spotify_id)
             
+            # Once the analysis that stored tracks incrementally is done, cache its moods in the session again
+            if read_from_db and not has_active_analysis_job(
+                spotify_id, ANALYSIS_JOB_STALE_SECONDS, ANALYSIS_JOB_QUEUE_TIMEOUT_SECONDS
+            ):
+                session_mood_uris = get_mood_uris_for_user(user_id)
+                session['mood_uris'] = session_mood_uris
+                session['last_analysis'] = time.time()
+                session.pop('mood_uris_from_db', None)
+                session.modified = True
+                read_from_db = False
+                track_uris = session_mood_uris.get(mood) or []
+                if track_uris:
+                    random_uris = random.sample(track_uris, min(len(track_uris), 75))
+                    logger.info(f"Using {len(random_uris)} tracks for mood '{mood}' from the finished analysis")
+                    return jsonify({
+                        "track_uris": random_uris,
+                        "count": len(random_uris),
+                        "source": "database"
+                    }), 200
+            
             # Get tracks for the requested mood from database
             track_uris = get_tracks_by_mood(user_id, mood, limit=75)  # Increased limit for better variety
             
@@ -395,7 +470,7 @@ def get_mood_tracks_route():
                 random.shuffle(track_uris)
                 
                 # Store in session for future requests (avoiding DB calls)
-                if mood not in session_mood_uris:
+                if not read_from_db and mood not in session_mood_uris:
                     session_mood_uris[mood] = track_uris
                     session['mood_uris'] = session_mood_uris
                     session.modified = True
@@ -561,6 +636,17 @@ def health_check():
             "serverless_mode": "enabled"
         }), 500
 
+@app.route('/api/metrics/upstreams', methods=['GET'])
+def upstream_metrics_route():
+    """Internal: per-provider limiter, circuit breaker, HTTP connection reuse and lyrics hedging metrics of
+    every process that analyzed libraries recently (analysis workers and web workers running inline analyses).
+    Needs UPSTREAM_METRICS_TOKEN as a bearer token; without the variable the endpoint doesn't exist."""
+    if not UPSTREAM_METRICS_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {UPSTREAM_METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"processes": get_upstream_metrics(UPSTREAM_METRICS_MAX_AGE_SECONDS)}), 200
+
 @app.after_request
 def add_cors_headers(response):
     frontend_url = os.getenv("FRONTEND_URL") or "https://spotify-mood-player.vercel.app"
@@ -0,0 +1,419 @@
+# this file has the audio decoding and librosa feature extraction used to describe each track preview
+import os
+import subprocess
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+import librosa
+import numpy as np
+import scipy.signal
+import http_clients
+
+# Sample rate used for all feature extraction (lower SR for faster processing with minimal quality loss)
+TARGET_SAMPLE_RATE = 22050
+
+# "full" runs every librosa extractor on the whole clip; "fast" derives everything from one STFT/mel pass
+AUDIO_FEATURE_MODE = os.getenv('AUDIO_FEATURE_MODE', 'full').lower()
+# In fast mode, only analyze this many seconds from the middle of the preview (0 = whole clip)
+AUDIO_ANALYSIS_WINDOW_SECONDS = float(os.getenv('AUDIO_ANALYSIS_WINDOW_SECONDS', '0'))
+
+# Identifies how cached features were extracted: fast mode (and its window) estimates tempo and the
+# spectral means differently, so features are only shared between runs with the same version
+AUDIO_FEATURE_VERSION = (
+    f"fast-w{AUDIO_ANALYSIS_WINDOW_SECONDS:g}" if AUDIO_FEATURE_MODE == 'fast' else 'full'
+)
+
+# STFT parameters shared by every fast-mode descriptor (librosa's defaults, so full mode matches)
+N_FFT = 2048
+HOP_LENGTH = 512
+
+# Number of decoded previews grouped into one vectorized fast-mode extraction call
+AUDIO_BATCH_SIZE = int(os.getenv('AUDIO_BATCH_SIZE', '8'))
+
+# Fast mode estimates chroma tuning from every Nth STFT frame
+TUNING_FRAME_STRIDE = 8
+
+# RMS of the Hann analysis window; undoes its attenuation so spectral RMS matches time-domain RMS
+WINDOW_RMS = float(np.sqrt(np.mean(scipy.signal.get_window('hann', N_FFT) ** 2)))
+
+# Size of the process pool for the CPU-bound librosa work (0 computes on the calling thread instead).
+# Every process that runs analyses (each analysis worker, or each gunicorn worker without the queue)
+# starts its own pool, so keep (analyzing processes x AUDIO_PROCESS_WORKERS) around the host's core count
+AUDIO_PROCESS_WORKERS = int(os.getenv('AUDIO_PROCESS_WORKERS', str(min(2, os.cpu_count() or 1))))
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+class PreviewDownloadError(Exception):
+    """The preview couldn't be downloaded completely (bad status, timeout or dropped connection)."""
+
+def decode_preview(preview_url, sr=TARGET_SAMPLE_RATE):
+    """Stream a preview straight into ffmpeg and return mono float32 PCM at `sr`.
+
+    The HTTP body is piped to ffmpeg's stdin as it downloads and the decoded,
+    resampled samples are read back from its stdout into a NumPy buffer, so
+    nothing touches the disk and no intermediate WAV is produced.
+    Returns None if ffmpeg can't decode the preview.
+
+    Raises:
+        PreviewDownloadError: if the download fails or breaks off, since ffmpeg would
+        otherwise decode the truncated bytes into features of a partial clip
+    """
+    try:
+        # Preview downloads share one keep-alive session, so consecutive tracks reuse the CDN connection
+        r = http_clients.get('itunes_audio', preview_url, stream=True)
+    except Exception as e:
+        raise PreviewDownloadError(f"Preview download failed: {e}") from e
+    if r.status_code != 200:
+        r.close()
+        raise PreviewDownloadError(f"Preview download failed: {r.status_code}")
+
+    download_errors = []
+    try:
+        proc = subprocess.Popen(
+            [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                '-i', 'pipe:0',
+                '-vn', '-ac', '1', '-ar', str(sr),
+                '-f', 'f32le', 'pipe:1'
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+        def feed_decoder():
+            # Runs alongside the stdout read below so neither pipe fills up and blocks
+            try:
+                for chunk in r.iter_content(chunk_size=8192):
+                    try:
+                        proc.stdin.write(chunk)
+                    except OSError:
+                        return  # ffmpeg exited early; its return code tells us why
+            except Exception as e:
+                # Read timeout or dropped connection mid-download
+                download_errors.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except Exception:
+                    pass
+                r.close()
+
+        feeder = threading.Thread(target=feed_decoder, daemon=True)
+        feeder.start()
+        pcm = proc.stdout.read()
+        proc.wait()
+        feeder.join()
+    except Exception as e:
+        r.close()
+        print(f"Error decoding preview: {e}")
+        return None
+
+    if download_errors:
+        raise PreviewDownloadError(f"Preview download broke off: {download_errors[0]}") from download_errors[0]
+    if proc.returncode != 0 or not pcm:
+        print(f"ffmpeg could not decode preview (exit code {proc.returncode}, {len(pcm)} bytes of output)")
+        return None
+    return np.frombuffer(pcm, dtype=np.float32)
+
+def compute_audio_features(y, sr=TARGET_SAMPLE_RATE, mode=None):
+    """Compute the 13 mood-related audio features from mono PCM samples using the configured mode."""
+    if (mode or AUDIO_FEATURE_MODE) == 'fast':
+        return compute_audio_features_fast(y, sr)
+    return compute_audio_features_full(y, sr)
+
+def compute_audio_features_full(y, sr=TARGET_SAMPLE_RATE):
+    """Compute the 13 mood-related audio features by running each librosa extractor on the whole clip."""
+    # Extract features
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+    tempo = float(np.atleast_1d(tempo)[0])  # librosa >= 0.10 returns a 1-element array
+    energy = float(np.mean(librosa.feature.rms(y=y)))
+
+    # Use optimized computation methods - compute STFT once and reuse
+    stft = np.abs(librosa.stft(y))
+
+    # Calculate spectral features efficiently using the same STFT
+    brightness = float(np.mean(librosa.feature.spectral_centroid(S=stft, sr=sr)))
+    zcr = float(np.mean(librosa.feature.zero_crossing_rate(y)))
+    contrast = float(np.mean(librosa.feature.spectral_contrast(S=stft, sr=sr)))
+    chroma = float(np.mean(librosa.feature.chroma_stft(S=stft, sr=sr)))
+    flatness = float(np.mean(librosa.feature.spectral_flatness(S=stft)))
+    rolloff = float(np.mean(librosa.feature.spectral_rolloff(S=stft, sr=sr)))
+
+    # Calculate all MFCCs at once for efficiency
+    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=5)
+
+    return {
+        'tempo': tempo,
+        'energy': energy,
+        'brightness': brightness,
+        'zcr': zcr,
+        'contrast': contrast,
+        'chroma': chroma,
+        'flatness': flatness,
+        'rolloff': rolloff,
+        'mfcc1': float(np.mean(mfccs[0])),
+        'mfcc2': float(np.mean(mfccs[1])),
+        'mfcc3': float(np.mean(mfccs[2])),
+        'mfcc4': float(np.mean(mfccs[3])),
+        'mfcc5': float(np.mean(mfccs[4]))
+    }
+
+def analysis_window(y, sr=TARGET_SAMPLE_RATE, window_seconds=None):
+    """Return the centered `window_seconds` slice of the clip (or the whole clip if it's shorter or 0)."""
+    if window_seconds is None:
+        window_seconds = AUDIO_ANALYSIS_WINDOW_SECONDS
+    window = int(window_seconds * sr)
+    if window <= 0 or window >= len(y):
+        return y
+    start = (len(y) - window) // 2
+    return y[start:start + window]
+
+def estimate_tempo(onset_envelope, sr=TARGET_SAMPLE_RATE, hop_length=HOP_LENGTH, start_bpm=120.0):
+    """Estimate tempo from one global autocorrelation of the onset envelope.
+
+    Same log-normal prior around `start_bpm` that librosa's tempo estimator
+    uses, but without the per-frame tempogram or the beat tracking dynamic
+    program.
+    """
+    if len(onset_envelope) < 2 or not np.any(onset_envelope):
+        return 0.0
+    ac = librosa.autocorrelate(onset_envelope - np.mean(onset_envelope))
+    lags = np.arange(1, len(ac))
+    bpms = 60.0 * sr / (hop_length * lags)
+    weights = np.exp(-0.5 * np.log2(bpms / start_bpm) ** 2)
+    weights[(bpms < 30) | (bpms > 320)] = 0
+    scores = ac[1:] * weights
+    if not np.any(scores > 0):
+        return 0.0
+    return float(bpms[np.argmax(scores)])
+
+def estimate_tuning_fast(S, sr=TARGET_SAMPLE_RATE):
+    """Estimate tuning for chroma from every TUNING_FRAME_STRIDE-th frame instead of all of them.
+
+    Tuning barely moves within a 30s preview, and the pitch tracking behind
+    it is otherwise the most expensive step of chroma extraction.
+    """
+    return float(librosa.estimate_tuning(S=S[:, ::TUNING_FRAME_STRIDE], sr=sr))
+
+def compute_audio_features_fast(y, sr=TARGET_SAMPLE_RATE, window_seconds=None):
+    """Compute the 13 audio features from a single STFT and the mel spectrogram derived from it.
+
+    RMS, spectral descriptors, MFCCs and the onset envelope used for tempo
+    all share one STFT, instead of beat_track, rms and mfcc each redoing
+    their own. Zero-crossing rate stays time-domain since it can't be
+    recovered from a magnitude spectrum, but that's a single cheap framewise pass.
+    """
+    y = analysis_window(y, sr, window_seconds)
+
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    power = S ** 2
+    log_mel = librosa.power_to_db(librosa.feature.melspectrogram(S=power, sr=sr))
+
+    mfccs = librosa.feature.mfcc(S=log_mel, n_mfcc=5)
+    onset_envelope = librosa.onset.onset_strength(S=log_mel, sr=sr)
+
+    return {
+        'tempo': estimate_tempo(onset_envelope, sr),
+        'energy': float(np.mean(librosa.feature.rms(S=S, frame_length=N_FFT, hop_length=HOP_LENGTH)) / WINDOW_RMS),
+        'brightness': float(np.mean(librosa.feature.spectral_centroid(S=S, sr=sr))),
+        'zcr': float(np.mean(librosa.feature.zero_crossing_rate(y, frame_length=N_FFT, hop_length=HOP_LENGTH))),
+        'contrast': float(np.mean(librosa.feature.spectral_contrast(S=S, sr=sr))),
+        'chroma': float(np.mean(librosa.feature.chroma_stft(S=S, sr=sr, tuning=estimate_tuning_fast(S, sr)))),
+        'flatness': float(np.mean(librosa.feature.spectral_flatness(S=S))),
+        'rolloff': float(np.mean(librosa.feature.spectral_rolloff(S=S, sr=sr))),
+        'mfcc1': float(np.mean(mfccs[0])),
+        'mfcc2': float(np.mean(mfccs[1])),
+        'mfcc3': float(np.mean(mfccs[2])),
+        'mfcc4': float(np.mean(mfccs[3])),
+        'mfcc5': float(np.mean(mfccs[4]))
+    }
+
+def _masked_frame_mean(feature, n_frames):
+    """Mean of a (N, ..., T) batched feature over each clip's own frames, ignoring padding frames."""
+    feature = feature.reshape(feature.shape[0], -1, feature.shape[-1])
+    mask = np.arange(feature.shape[-1])[np.newaxis, :] < n_frames[:, np.newaxis]
+    return (feature * mask[:, np.newaxis, :]).sum(axis=(1, 2)) / (n_frames * feature.shape[1])
+
+def _zero_crossing_rate_batch(Y):
+    """Framewise zero-crossing rate for a (N, L) batch, via one crossing mask and a cumulative sum.
+
+    Matches librosa.feature.zero_crossing_rate (edge-padded centered frames,
+    |x| <= 1e-10 treated as zero, zero counted as positive) without
+    materializing the (N, frame_length, T) frame view.
+    """
+    padded = np.pad(Y, ((0, 0), (N_FFT // 2, N_FFT // 2)), mode='edge')
+    signs = np.signbit(np.where(np.abs(padded) <= 1e-10, 0, padded))
+    crossings = np.concatenate(
+        [np.zeros((Y.shape[0], 1)), np.cumsum(signs[:, 1:] != signs[:, :-1], axis=1)],
+        axis=1
+    )
+    starts = np.arange(1 + (padded.shape[1] - N_FFT) // HOP_LENGTH) * HOP_LENGTH
+    # Crossings between consecutive samples inside each frame
+    return (crossings[:, starts + N_FFT - 1] - crossings[:, starts]) / N_FFT
+
+def compute_audio_features_batch(Y, lengths=None, sr=TARGET_SAMPLE_RATE):
+    """Compute fast-mode audio features for N zero-padded clips at once.
+
+    Args:
+        Y (np.ndarray): (N, L) float32 array, one clip per row, zero-padded to a common length
+        lengths (list): Original length of each clip in samples (defaults to L for every row)
+
+    Returns:
+        list: One feature dict per row, matching compute_audio_features_fast on the unpadded clip
+
+    The STFT, mel spectrogram, MFCCs, onset envelopes and per-frame spectral
+    descriptors are all computed as single vectorized librosa calls over the
+    leading batch axis; only chroma (per-clip tuning estimate) and the tempo
+    pick (per-clip autocorrelation) loop over rows.
+    """
+    Y = np.asarray(Y, dtype=np.float32)
+    if Y.ndim != 2 or Y.shape[0] == 0:
+        return []
+    lengths = np.full(Y.shape[0], Y.shape[1]) if lengths is None else np.asarray(lengths)
+    # Frames each clip would have on its own (center=True adds one)
+    n_frames = np.maximum(1 + lengths // HOP_LENGTH, 1)
+
+    S = np.abs(librosa.stft(Y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    power = S ** 2
+    # Apply the 80 dB floor per clip, as power_to_db would do for each clip on its own
+    log_mel = librosa.power_to_db(librosa.feature.melspectrogram(S=power, sr=sr), top_db=None)
+    log_mel = np.maximum(log_mel, log_mel.max(axis=(1, 2), keepdims=True) - 80.0)
+
+    mfccs = librosa.feature.mfcc(S=log_mel, n_mfcc=5)
+    onset_envelopes = librosa.onset.onset_strength(S=log_mel, sr=sr)
+
+    # Per-frame descriptors written directly against the shared (N, F, T) arrays;
+    # same formulas as librosa's extractors without their per-call normalization copies
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=N_FFT).astype(np.float32)
+    magnitude_sum = S.sum(axis=1)
+    safe_sum = np.where(magnitude_sum > 0, magnitude_sum, 1)
+
+    # RMS from the spectrum (DC and Nyquist bins count half), corrected for the Hann window
+    frame_power = power.sum(axis=1) - 0.5 * (power[:, 0, :] + power[:, -1, :])
+    energy = _masked_frame_mean(np.sqrt(2 * frame_power / N_FFT ** 2), n_frames) / WINDOW_RMS
+
+    brightness = _masked_frame_mean(np.einsum('f,nft->nt', freqs, S) / safe_sum, n_frames)
+
+    # 85% roll-off: first bin where the cumulative magnitude reaches the threshold
+    rolloff_bins = np.argmax(np.cumsum(S, axis=1) >= 0.85 * magnitude_sum[:, np.newaxis, :], axis=1)
+    rolloff = _masked_frame_mean(freqs[rolloff_bins], n_frames)
+
+    thresholded_power = np.maximum(power, 1e-10)
+    flatness = _masked_frame_mean(
+        np.exp(np.mean(np.log(thresholded_power), axis=1)) / np.mean(thresholded_power, axis=1),
+        n_frames
+    )
+
+    zcr = _masked_frame_mean(_zero_crossing_rate_batch(Y), n_frames)
+    contrast = _masked_frame_mean(librosa.feature.spectral_contrast(S=S, sr=sr), n_frames)
+    mfcc_means = [_masked_frame_mean(mfccs[:, i, :], n_frames) for i in range(5)]
+
+    features = []
+    for i, frames in enumerate(n_frames):
+        # Chroma depends on each clip's own tuning estimate, so it can't share one filter bank
+        clip_S = S[i, :, :frames]
+        chroma = float(np.mean(librosa.feature.chroma_stft(S=clip_S, sr=sr, tuning=estimate_tuning_fast(clip_S, sr))))
+        features.append({
+            'tempo': estimate_tempo(onset_envelopes[i, :frames], sr),
+            'energy': float(energy[i]),
+            'brightness': float(brightness[i]),
+            'zcr': float(zcr[i]),
+            'contrast': float(contrast[i]),
+            'chroma': chroma,
+            'flatness': float(flatness[i]),
+            'rolloff': float(rolloff[i]),
+            'mfcc1': float(mfcc_means[0][i]),
+            'mfcc2': float(mfcc_means[1][i]),
+            'mfcc3': float(mfcc_means[2][i]),
+            'mfcc4': float(mfcc_means[3][i]),
+            'mfcc5': float(mfcc_means[4][i])
+        })
+    return features
+
+def pad_clips(clips, sr=TARGET_SAMPLE_RATE, window_seconds=None):
+    """Window each clip like fast mode does and zero-pad them into one (N, L) array.
+
+    Returns:
+        tuple: (Y, lengths) ready for compute_audio_features_batch
+    """
+    clips = [analysis_window(np.asarray(y, dtype=np.float32), sr, window_seconds) for y in clips]
+    lengths = np.array([len(y) for y in clips])
+    Y = np.zeros((len(clips), int(lengths.max()) if len(clips) else 0), dtype=np.float32)
+    for i, y in enumerate(clips):
+        Y[i, :len(y)] = y
+    return Y, lengths
+
+def _compute_audio_features_from_pcm(pcm, sr, mode):
+    """Process pool entry point: rebuild the float32 signal from raw bytes and extract features."""
+    return compute_audio_features(np.frombuffer(pcm, dtype=np.float32), sr, mode)
+
+def _compute_audio_features_batch_from_pcm(pcm, shape, lengths, sr):
+    """Process pool entry point for micro-batches: rebuild the padded (N, L) array from raw bytes."""
+    return compute_audio_features_batch(np.frombuffer(pcm, dtype=np.float32).reshape(shape), lengths, sr)
+
+def get_process_pool():
+    """Return the shared process pool for feature extraction, creating it on first use."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            print(f"Starting audio feature process pool with {AUDIO_PROCESS_WORKERS} workers")
+            # spawn rather than fork: the web worker is multi-threaded and forking it is unsafe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=AUDIO_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _process_pool
+
+def _discard_process_pool(pool):
+    """Drop a broken pool so the next call starts a fresh one."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def extract_features_from_pcm(y, sr=TARGET_SAMPLE_RATE):
+    """Compute audio features for decoded PCM, off the GIL in the process pool when enabled.
+
+    The signal is shipped to the worker as raw float32 bytes, which pickle as
+    a single buffer copy. The calling thread just blocks on the result, so
+    network-bound threads keep running while the DSP uses every core.
+    """
+    if AUDIO_PROCESS_WORKERS <= 0:
+        return compute_audio_features(y, sr)
+
+    pool = get_process_pool()
+    try:
+        pcm = np.ascontiguousarray(y, dtype=np.float32).tobytes()
+        return pool.submit(_compute_audio_features_from_pcm, pcm, sr, AUDIO_FEATURE_MODE).result()
+    except BrokenProcessPool:
+        print("Audio feature process pool broke, restarting it and computing this track in-thread")
+        _discard_process_pool(pool)
+        return compute_audio_features(y, sr)
+
+def submit_features_batch(clips, sr=TARGET_SAMPLE_RATE):
+    """Start fast-mode feature extraction for a micro-batch of decoded clips.
+
+    Returns:
+        Future: Resolves to one feature dict per clip, in order. Runs in the
+        process pool when enabled, otherwise it is computed before returning.
+    """
+    Y, lengths = pad_clips(clips, sr)
+    if AUDIO_PROCESS_WORKERS <= 0:
+        future = Future()
+        try:
+            future.set_result(compute_audio_features_batch(Y, lengths, sr))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    pool = get_process_pool()
+    try:
+        return pool.submit(_compute_audio_features_batch_from_pcm, Y.tobytes(), Y.shape, lengths, sr)
+    except BrokenProcessPool:
+        print("Audio feature process pool broke, restarting it for the next batch")
+        _discard_process_pool(pool)
+        return get_process_pool().submit(_compute_audio_features_batch_from_pcm, Y.tobytes(), Y.shape, lengths, sr)
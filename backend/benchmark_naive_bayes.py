@@ -0,0 +1,109 @@
+# this script times the array-backed NaiveBayesMoodClassifier against the original dict-based one
+# (tests/test_naive_bayes.py checks that their outputs match)
+import argparse
+import csv
+import pathlib
+import random
+import re
+import time
+import numpy as np
+from collections import defaultdict, Counter
+from naive_bayes import NaiveBayesMoodClassifier
+
+class DictNaiveBayesMoodClassifier:
+    """The original nested-dict implementation, kept here as the reference for outputs and timing."""
+    def __init__(self):
+        self.mood_word_counts = defaultdict(Counter)
+        self.mood_counts = Counter()
+        self.vocab = set()
+        self.mood_priors = {}
+        self.word_probs = defaultdict(dict)
+
+    def tokenize(self, text):
+        return re.findall(r'\b\w+\b', text.lower())
+
+    def fit(self, training_data):
+        for lyrics, moods in training_data:
+            if isinstance(moods, str):
+                moods = [moods]
+            tokens = self.tokenize(lyrics)
+            for mood in moods:
+                self.mood_word_counts[mood].update(tokens)
+                self.mood_counts[mood] += 1
+            self.vocab.update(tokens)
+        total = sum(self.mood_counts.values())
+        self.mood_priors = {mood: count / total for mood, count in self.mood_counts.items()}
+        for mood in self.mood_word_counts:
+            total_words = sum(self.mood_word_counts[mood].values())
+            for word in self.vocab:
+                self.word_probs[mood][word] = (
+                    self.mood_word_counts[mood][word] + 1
+                ) / (total_words + len(self.vocab))
+
+    def predict_proba(self, lyrics):
+        tokens = self.tokenize(lyrics)
+        mood_scores = {}
+        for mood in self.mood_priors:
+            log_prob = np.log(self.mood_priors[mood])
+            for word in tokens:
+                if word in self.vocab:
+                    log_prob += np.log(self.word_probs[mood].get(word, 1 / (sum(self.mood_word_counts[mood].values()) + len(self.vocab))))
+            mood_scores[mood] = log_prob
+        max_log = max(mood_scores.values())
+        exp_scores = {mood: np.exp(score - max_log) for mood, score in mood_scores.items()}
+        total = sum(exp_scores.values())
+        return {mood: exp_scores[mood] / total for mood in exp_scores}
+
+    def predict(self, lyrics, threshold=0.1):
+        probs = self.predict_proba(lyrics)
+        return [mood for mood, prob in probs.items() if prob >= threshold]
+
+def load_examples():
+    csv_path = pathlib.Path(__file__).parent / 'training_data.csv'
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        return [(row['lyrics'], [mood.strip() for mood in row['moods'].split(',')]) for row in csv.DictReader(f)]
+
+def make_documents(examples, count, seed=0):
+    """Build `count` pseudo-songs from words drawn at random from the training lyrics."""
+    rng = random.Random(seed)
+    words = [word for lyrics, _ in examples for word in lyrics.split()]
+    # A few unseen words per document exercise the out-of-vocabulary path
+    return [' '.join(rng.choices(words, k=rng.randint(50, 400)) + ['zzunseen'] * rng.randint(0, 3)) for _ in range(count)]
+
+def benchmark_naive_bayes(documents_count, threshold):
+    examples = load_examples()
+    documents = make_documents(examples, documents_count)
+
+    start = time.time()
+    reference = DictNaiveBayesMoodClassifier()
+    reference.fit(examples)
+    reference_fit = time.time() - start
+    start = time.time()
+    expected = [reference.predict(lyrics, threshold) for lyrics in documents]
+    reference_predict = time.time() - start
+
+    start = time.time()
+    classifier = NaiveBayesMoodClassifier()
+    classifier.fit(examples)
+    array_fit = time.time() - start
+    start = time.time()
+    single = [classifier.predict(lyrics, threshold) for lyrics in documents]
+    array_predict = time.time() - start
+    start = time.time()
+    batch = classifier.predict_batch(documents, threshold)
+    array_batch = time.time() - start
+
+    mismatches = sum(1 for a, b, c in zip(expected, single, batch) if not (a == b == c))
+    print(f"=== Naive Bayes on {len(examples)} training songs, {len(documents)} documents (threshold {threshold}) ===")
+    print(f"{'':<28}{'dict-based':>12}{'array-backed':>14}{'speedup':>10}")
+    print(f"{'fit':<28}{reference_fit * 1000:>10.1f}ms{array_fit * 1000:>12.1f}ms{reference_fit / max(array_fit, 1e-9):>9.1f}x")
+    print(f"{'predict (one at a time)':<28}{reference_predict * 1000:>10.1f}ms{array_predict * 1000:>12.1f}ms{reference_predict / max(array_predict, 1e-9):>9.1f}x")
+    print(f"{'predict_batch':<28}{reference_predict * 1000:>10.1f}ms{array_batch * 1000:>12.1f}ms{reference_predict / max(array_batch, 1e-9):>9.1f}x")
+    print(f"\nPrediction mismatches vs dict-based: {mismatches}/{len(documents)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the array-backed Naive Bayes classifier against the dict-based one")
+    parser.add_argument('--documents', type=int, default=2000, help="number of synthetic documents to classify")
+    parser.add_argument('--threshold', type=float, default=0.1, help="posterior threshold passed to predict")
+    args = parser.parse_args()
+    benchmark_naive_bayes(args.documents, args.threshold)
@@ -0,0 +1,129 @@
+# this file keeps a circuit breaker per upstream provider: after repeated failures (timeouts, connection
+# errors, 5xx) the breaker opens and calls to that provider fail immediately, so callers fall through to
+# the next source instead of paying the full timeout and retry chain on every track during an outage
+import os
+import sys
+import threading
+import time
+
+# Consecutive failed calls that open a provider's breaker
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+# How long an opened breaker short-circuits calls before letting a probe through; doubles each
+# time a probe fails, up to BREAKER_MAX_OPEN_SECONDS
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv('BREAKER_MAX_OPEN_SECONDS', '300'))
+
+class UpstreamUnavailable(Exception):
+    """A provider was skipped without a definitive answer (outage or throttling), so the result mustn't be cached."""
+    def __init__(self, provider, reason):
+        super().__init__(f"{provider} {reason}, skipped the call")
+        self.provider = provider
+
+class CircuitOpen(UpstreamUnavailable):
+    """Raised instead of calling a provider whose breaker is open."""
+    def __init__(self, provider):
+        super().__init__(provider, "circuit is open")
+
+class BreakerPermit:
+    """Handed out by CircuitBreaker.allow() for a call that may go ahead."""
+    def __init__(self, is_probe):
+        self.is_probe = is_probe
+
+class CircuitBreaker:
+    """Closed -> open after BREAKER_FAILURE_THRESHOLD consecutive failures -> half-open after the open
+    period, when a single probe call is let through: its success closes the breaker, its failure reopens it."""
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.counts = {'short_circuited': 0, 'opened': 0, 'probes': 0}
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go ahead now; in half-open state only the one probe call is allowed.
+
+        Returns:
+            None if the call is short-circuited, otherwise a permit to pass back to record() or
+            cancel(), whose is_probe says whether the call is the half-open probe
+        """
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = 'half_open'
+            if self.state == 'closed':
+                return BreakerPermit(is_probe=False)
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                self.counts['probes'] += 1
+                return BreakerPermit(is_probe=True)
+            self.counts['short_circuited'] += 1
+            return None
+
+    def record(self, permit, outcome):
+        """Record an allowed call's outcome: 'failed' counts towards opening, anything else is a success.
+
+        Only the probe's outcome closes or reopens a half-open breaker; calls that started before
+        the breaker opened and finish afterwards don't change its state.
+        """
+        with self.lock:
+            if permit.is_probe:
+                self.probe_in_flight = False
+                if outcome != 'failed':
+                    print(f"Circuit for {self.name} closed after a successful probe")
+                    sys.stdout.flush()
+                    self.state = 'closed'
+                    self.consecutive_failures = 0
+                    self.open_seconds = BREAKER_OPEN_SECONDS
+                    return
+                self.consecutive_failures += 1
+                self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+            elif self.state != 'closed':
+                return
+            elif outcome != 'failed':
+                self.consecutive_failures = 0
+                return
+            else:
+                self.consecutive_failures += 1
+                if self.consecutive_failures < BREAKER_FAILURE_THRESHOLD:
+                    return
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.counts['opened'] += 1
+            print(f"Circuit for {self.name} opened after {self.consecutive_failures} consecutive failures, "
+                  f"short-circuiting calls for {self.open_seconds:.0f}s")
+            sys.stdout.flush()
+
+    def cancel(self, permit):
+        """An allowed call that never reached the provider (e.g. its limiter timed out) frees the probe slot."""
+        with self.lock:
+            if permit.is_probe:
+                self.probe_in_flight = False
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'open_seconds': self.open_seconds,
+                'retry_in_seconds': round(max(0.0, self.opened_at + self.open_seconds - time.monotonic()), 2)
+                if self.state == 'open' else 0.0,
+                **self.counts
+            }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(provider):
+    """The process-wide breaker for a provider, shared by every thread."""
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+def breaker_metrics():
+    """State and counters of every provider's breaker in this process."""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: breaker.snapshot() for name, breaker in sorted(breakers.items())}
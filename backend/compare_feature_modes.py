@@ -0,0 +1,78 @@
+# this script measures how far "fast" audio feature extraction drifts from "full" mode on the training songs
+import argparse
+import csv
+import pathlib
+import sys
+import time
+import numpy as np
+from audio_features import (
+    decode_preview, PreviewDownloadError, compute_audio_features_full, compute_audio_features_fast,
+    AUDIO_ANALYSIS_WINDOW_SECONDS, TARGET_SAMPLE_RATE
+)
+from lyrics_service import get_itunes_preview, AUDIO_FEATURE_KEYS
+from circuit_breaker import UpstreamUnavailable
+
+def compare_feature_modes(window_seconds, limit=None):
+    """Extract features in both modes for every training song with an iTunes preview and report the drift."""
+    csv_path = pathlib.Path(__file__).parent / 'training_data.csv'
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('itunes_preview_found') == 'True']
+    if limit:
+        rows = rows[:limit]
+
+    relative_errors = {key: [] for key in AUDIO_FEATURE_KEYS}
+    full_time = 0.0
+    fast_time = 0.0
+    compared = 0
+
+    for row in rows:
+        song = row['song name']
+        artist = row['artist'].split(',')[0]
+        try:
+            preview_url = get_itunes_preview(song, artist)
+        except UpstreamUnavailable:
+            preview_url = None
+        try:
+            y = decode_preview(preview_url) if preview_url else None
+        except PreviewDownloadError as e:
+            print(e)
+            y = None
+        if y is None:
+            print(f"Skipping '{song}' by {artist}: no decodable preview")
+            continue
+
+        start = time.time()
+        full = compute_audio_features_full(y, TARGET_SAMPLE_RATE)
+        full_time += time.time() - start
+        start = time.time()
+        fast = compute_audio_features_fast(y, TARGET_SAMPLE_RATE, window_seconds)
+        fast_time += time.time() - start
+        compared += 1
+
+        for key in AUDIO_FEATURE_KEYS:
+            # Symmetric relative error so features that are ~0 in one mode stay bounded at 100%
+            scale = max(abs(full[key]), abs(fast[key]), 1e-9)
+            relative_errors[key].append(abs(fast[key] - full[key]) / scale)
+        print(f"Compared '{song}' by {artist}")
+        sys.stdout.flush()
+
+    if not compared:
+        print("No previews could be compared")
+        return
+
+    window_label = f"{window_seconds:g}s window" if window_seconds else "whole clip"
+    print(f"\n=== FAST vs FULL on {compared} training songs ({window_label}) ===")
+    print(f"{'feature':<12}{'mean rel. drift':>18}{'p90 rel. drift':>18}")
+    for key in AUDIO_FEATURE_KEYS:
+        errors = np.array(relative_errors[key])
+        print(f"{key:<12}{np.mean(errors):>18.2%}{np.percentile(errors, 90):>18.2%}")
+    print(f"\nFull mode: {full_time / compared * 1000:.0f} ms/track")
+    print(f"Fast mode: {fast_time / compared * 1000:.0f} ms/track ({full_time / max(fast_time, 1e-9):.1f}x faster)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare fast and full audio feature extraction on training_data.csv")
+    parser.add_argument('--window', type=float, default=AUDIO_ANALYSIS_WINDOW_SECONDS,
+                        help="seconds of audio analyzed in fast mode (0 = whole clip)")
+    parser.add_argument('--limit', type=int, default=None, help="only compare the first N songs")
+    args = parser.parse_args()
+    compare_feature_modes(args.window, args.limit)
@@ -2,8 +2,10 @@ from dotenv import load_dotenv
 import os
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import Json
 import time
 import logging
+import zlib
 
 logger = logging.getLogger(__name__)
 
@@ -188,12 +190,13 @@ def get_or_create_user(spotify_id):
     finally:
         close_db_connection(conn)
 
-def insert_tracks(user_id, tracks):
+def insert_tracks(user_id, tracks, replace=True):
     """Insert or update tracks with their moods in the database.
     
     Args:
         user_id (int): The database user ID
-        tracks (list): List of track dictionaries, each with 'uri' and 'moods' fields
+        tracks (list): List of track dictionaries, each with 'uri' and 'moods' fields (and optionally 'added_at')
+        replace (bool): Delete the user's existing tracks first; pass False to add to them incrementally
     """
     if not tracks:
         print("No tracks provided to insert_tracks")
@@ -204,7 +207,8 @@ def insert_tracks(user_id, tracks):
         conn = get_db_connection()
         with conn.cursor() as cursor:
             # Delete existing tracks for this user
-            cursor.execute("DELETE FROM tracks WHERE user_id = %s", (user_id,))
+            if replace:
+                cursor.execute("DELETE FROM tracks WHERE user_id = %s", (user_id,))
             
             # Prepare data for batch insert
             batch_values = []
@@ -228,12 +232,12 @@ def insert_tracks(user_id, tracks):
                 # Insert one row per mood for this track
                 for mood in moods:
                     if mood and isinstance(mood, str):
-                        batch_values.append((user_id, uri.strip(), mood.lower().strip()))
+                        batch_values.append((user_id, uri.strip(), mood.lower().strip(), track.get('added_at')))
             
             # Execute batch insert if we have values
             if batch_values:
-                args = ','.join(cursor.mogrify("(%s,%s,%s)", i).decode('utf-8') for i in batch_values)
-                query = "INSERT INTO tracks (user_id, uri, mood) VALUES " + args
+                args = ','.join(cursor.mogrify("(%s,%s,%s,%s)", i).decode('utf-8') for i in batch_values)
+                query = "INSERT INTO tracks (user_id, uri, mood, added_at) VALUES " + args + " ON CONFLICT (user_id, uri, mood) DO NOTHING"
                 cursor.execute(query)
                 
             # Commit the transaction
@@ -266,6 +270,67 @@ def get_tracks_by_mood(user_id, mood, limit=20):
     finally:
         close_db_connection(conn)
 
+def get_user_library_state(user_id):
+    """Get the stored tracks for a user, used to diff against their current saved tracks.
+
+    Returns:
+        dict: Mapping of track URI to its saved-at timestamp (None for rows stored before
+        added_at was tracked), or None if the lookup failed
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT uri, MAX(added_at) FROM tracks WHERE user_id = %s GROUP BY uri",
+                (user_id,)
+            )
+            rows = cursor.fetchall() or []
+        return {row[0]: row[1] for row in rows}
+    except Exception as e:
+        logger.error(f"Error in get_user_library_state: {e}")
+        return None
+    finally:
+        close_db_connection(conn)
+
+def get_mood_uris_for_user(user_id):
+    """Get all of a user's stored tracks grouped by mood.
+
+    Returns:
+        dict: Mapping of mood to a list of track URIs
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT mood, uri FROM tracks WHERE user_id = %s", (user_id,))
+            rows = cursor.fetchall() or []
+        mood_uris = {}
+        for mood, uri in rows:
+            mood_uris.setdefault(mood, []).append(uri)
+        return mood_uris
+    except Exception as e:
+        logger.error(f"Error in get_mood_uris_for_user: {e}")
+        return {}
+    finally:
+        close_db_connection(conn)
+
+def delete_user_tracks(user_id, uris):
+    """Delete specific tracks (all of their moods) for a user."""
+    if not uris:
+        return
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM tracks WHERE user_id = %s AND uri = ANY(%s)",
+                (user_id, list(uris))
+            )
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error in delete_user_tracks: {e}")
+    finally:
+        close_db_connection(conn)
+
 def delete_tracks_for_user(user_id):
     conn = get_db_connection()
     try:
@@ -276,4 +341,679 @@ def delete_tracks_for_user(user_id):
         conn.rollback()
         logger.error(f"Error in delete_tracks_for_user: {e}")
     finally:
-        close_db_connection(conn) 
\ No newline at end of file
+        close_db_connection(conn)
+
+def get_track_audio_features(track_ids, feature_version):
+    """Look up previously extracted audio features shared across all users.
+
+    Args:
+        track_ids (list): Spotify track IDs to look up
+        feature_version (str): Extraction mode/window the features must have been computed with
+
+    Returns:
+        dict: Mapping of track ID to its feature dict; tracks without cached features are omitted
+    """
+    if not track_ids:
+        return {}
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT track_id, features FROM track_audio_features WHERE track_id = ANY(%s) AND feature_version = %s",
+                (list(track_ids), feature_version)
+            )
+            rows = cursor.fetchall() or []
+        return {row[0]: row[1] for row in rows}
+    except Exception as e:
+        logger.error(f"Error in get_track_audio_features: {e}")
+        return {}
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def store_track_audio_features(features_by_track, feature_version):
+    """Insert or refresh audio features in the shared cross-user store.
+
+    Args:
+        features_by_track (dict): Mapping of Spotify track ID to its feature dict
+        feature_version (str): Extraction mode/window the features were computed with
+    """
+    if not features_by_track:
+        return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            args = ','.join(
+                cursor.mogrify("(%s,%s,%s,NOW())", (track_id, feature_version, Json(features))).decode('utf-8')
+                for track_id, features in features_by_track.items()
+            )
+            cursor.execute(
+                "INSERT INTO track_audio_features (track_id, feature_version, features, updated_at) VALUES " + args +
+                " ON CONFLICT (track_id, feature_version) DO UPDATE SET features = EXCLUDED.features, updated_at = EXCLUDED.updated_at"
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in store_track_audio_features: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def get_cached_lyrics(cache_keys, not_found_ttl_seconds):
+    """Look up cached lyrics, including unexpired "not found" entries.
+
+    Args:
+        cache_keys (list): Normalized (title, artist) keys to look up
+        not_found_ttl_seconds (int): How long a "not found" entry stays valid
+
+    Returns:
+        dict: Mapping of cache key to lyrics text, or "" for songs known to have no lyrics
+    """
+    if not cache_keys:
+        return {}
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT cache_key, lyrics FROM lyrics_cache
+                WHERE cache_key = ANY(%s)
+                AND (lyrics IS NOT NULL OR updated_at > NOW() - make_interval(secs => %s))
+                """,
+                (list(cache_keys), not_found_ttl_seconds)
+            )
+            rows = cursor.fetchall() or []
+        return {
+            row[0]: zlib.decompress(bytes(row[1])).decode('utf-8') if row[1] is not None else ""
+            for row in rows
+        }
+    except Exception as e:
+        logger.error(f"Error in get_cached_lyrics: {e}")
+        return {}
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def store_cached_lyrics(lyrics_by_key):
+    """Insert or refresh compressed lyrics in the shared lyrics cache.
+
+    Args:
+        lyrics_by_key (dict): Mapping of cache key to lyrics text; empty lyrics are stored as "not found"
+    """
+    if not lyrics_by_key:
+        return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            args = ','.join(
+                cursor.mogrify(
+                    "(%s,%s,NOW())",
+                    (key, psycopg2.Binary(zlib.compress(lyrics.encode('utf-8'))) if lyrics else None)
+                ).decode('utf-8')
+                for key, lyrics in lyrics_by_key.items()
+            )
+            cursor.execute(
+                "INSERT INTO lyrics_cache (cache_key, lyrics, updated_at) VALUES " + args +
+                " ON CONFLICT (cache_key) DO UPDATE SET lyrics = EXCLUDED.lyrics, updated_at = EXCLUDED.updated_at"
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in store_cached_lyrics: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def get_cached_previews(track_ids, hit_ttl_seconds, miss_ttl_seconds):
+    """Look up resolved iTunes preview URLs, including unexpired misses.
+
+    Args:
+        track_ids (list): Spotify track IDs to look up
+        hit_ttl_seconds (int): How long a resolved preview URL stays valid
+        miss_ttl_seconds (int): How long a "no preview" entry stays valid
+
+    Returns:
+        dict: Mapping of track ID to preview URL, or "" for tracks known to have no preview
+    """
+    if not track_ids:
+        return {}
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT track_id, preview_url FROM itunes_preview_cache
+                WHERE track_id = ANY(%s)
+                AND updated_at > NOW() - make_interval(secs => CASE WHEN preview_url IS NULL THEN %s ELSE %s END)
+                """,
+                (list(track_ids), miss_ttl_seconds, hit_ttl_seconds)
+            )
+            rows = cursor.fetchall() or []
+        return {row[0]: row[1] or "" for row in rows}
+    except Exception as e:
+        logger.error(f"Error in get_cached_previews: {e}")
+        return {}
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def store_cached_previews(previews_by_track):
+    """Insert or refresh resolved iTunes preview URLs.
+
+    Args:
+        previews_by_track (dict): Mapping of Spotify track ID to preview URL, or None if no preview was found
+    """
+    if not previews_by_track:
+        return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            args = ','.join(
+                cursor.mogrify("(%s,%s,NOW())", (track_id, preview_url or None)).decode('utf-8')
+                for track_id, preview_url in previews_by_track.items()
+            )
+            cursor.execute(
+                "INSERT INTO itunes_preview_cache (track_id, preview_url, updated_at) VALUES " + args +
+                " ON CONFLICT (track_id) DO UPDATE SET preview_url = EXCLUDED.preview_url, updated_at = EXCLUDED.updated_at"
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in store_cached_previews: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def get_cached_classifications(track_ids, model, prompt_version):
+    """Look up mood classifications shared across all users.
+
+    Only rows for the current model and prompt version are returned, so bumping
+    either invalidates older entries without touching them.
+
+    Args:
+        track_ids (list): Spotify track IDs to look up
+        model (str): LLM model name the classification came from
+        prompt_version (str): Version of the classification prompt and mood list
+
+    Returns:
+        dict: Mapping of track ID to its list of moods; uncached tracks are omitted
+    """
+    if not track_ids:
+        return {}
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT track_id, moods FROM mood_classification_cache
+                WHERE track_id = ANY(%s) AND model = %s AND prompt_version = %s
+                """,
+                (list(track_ids), model, prompt_version)
+            )
+            rows = cursor.fetchall() or []
+        return {row[0]: list(row[1]) for row in rows}
+    except Exception as e:
+        logger.error(f"Error in get_cached_classifications: {e}")
+        return {}
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def store_cached_classifications(moods_by_track, model, prompt_version):
+    """Insert or refresh mood classifications and drop entries from older versions of the same tracks.
+
+    Args:
+        moods_by_track (dict): Mapping of Spotify track ID to its list of moods
+        model (str): LLM model name the classification came from
+        prompt_version (str): Version of the classification prompt and mood list
+    """
+    if not moods_by_track:
+        return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            args = ','.join(
+                cursor.mogrify("(%s,%s,%s,%s,NOW())", (track_id, model, prompt_version, list(moods))).decode('utf-8')
+                for track_id, moods in moods_by_track.items()
+            )
+            cursor.execute(
+                "INSERT INTO mood_classification_cache (track_id, model, prompt_version, moods, updated_at) VALUES " + args +
+                " ON CONFLICT (track_id, model, prompt_version) DO UPDATE SET moods = EXCLUDED.moods, updated_at = EXCLUDED.updated_at"
+            )
+            # Stale versions are only removed once the track is reclassified under the new one
+            cursor.execute(
+                """
+                DELETE FROM mood_classification_cache
+                WHERE track_id = ANY(%s) AND (model <> %s OR prompt_version <> %s)
+                """,
+                (list(moods_by_track.keys()), model, prompt_version)
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in store_cached_classifications: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def store_training_examples(examples, model, prompt_version):
+    """Save LLM-labeled tracks as training examples for the local classifiers.
+
+    Each track is only stored the first time it is labeled, so incremental training
+    never counts the same song twice.
+
+    Args:
+        examples (list): Dicts with 'track_id', 'lyrics', 'features' and 'moods'
+        model (str): LLM model name the labels came from
+        prompt_version (str): Version of the classification prompt and mood list
+    """
+    if not examples:
+        return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            args = ','.join(
+                cursor.mogrify(
+                    "(%s,%s,%s,%s,%s,%s,NOW())",
+                    (
+                        example['track_id'],
+                        psycopg2.Binary(zlib.compress(example['lyrics'].encode('utf-8'))) if example.get('lyrics') else None,
+                        Json(example['features']) if example.get('features') else None,
+                        list(example['moods']),
+                        model,
+                        prompt_version
+                    )
+                ).decode('utf-8')
+                for example in examples
+            )
+            cursor.execute(
+                "INSERT INTO classification_training_examples "
+                "(track_id, lyrics, features, moods, model, prompt_version, created_at) VALUES " + args +
+                " ON CONFLICT (track_id) DO NOTHING"
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in store_training_examples: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def get_training_examples(after_id=0, limit=1000):
+    """Read stored training examples in insertion order, for incremental training.
+
+    Args:
+        after_id (int): Only return examples with a larger id
+        limit (int): Maximum number of examples to return
+
+    Returns:
+        list: Dicts with 'id', 'track_id', 'lyrics', 'features' and 'moods'; empty on error
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id, track_id, lyrics, features, moods FROM classification_training_examples
+                WHERE id > %s ORDER BY id LIMIT %s
+                """,
+                (after_id, limit)
+            )
+            rows = cursor.fetchall() or []
+        return [
+            {
+                'id': row[0],
+                'track_id': row[1],
+                'lyrics': zlib.decompress(bytes(row[2])).decode('utf-8') if row[2] is not None else '',
+                'features': row[3] or {},
+                'moods': list(row[4])
+            }
+            for row in rows
+        ]
+    except Exception as e:
+        logger.error(f"Error in get_training_examples: {e}")
+        return []
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def enqueue_analysis_job(spotify_id, mode, token_info=None, worker_id=None, stale_seconds=300, queued_seconds=600):
+    """Queue a library analysis for the analysis workers, unless one is already in flight for the user.
+
+    A partial unique index allows one queued or running job per Spotify user, so the job row
+    doubles as a per-user lease across web workers and analysis workers. A running job whose
+    heartbeat is older than stale_seconds, or a job no worker claimed within queued_seconds,
+    is given up first so a dead or missing worker can't hold the lease.
+
+    Args:
+        spotify_id (str): Spotify user whose library is analyzed
+        mode (str): 'incremental' or 'full'
+        token_info (dict): Spotify OAuth token the worker uses on the user's behalf; only stored for
+            queued jobs, and cleared as soon as a worker claims the job
+        worker_id (str): Create the job already running under this worker (for analyses run in-process,
+            which never store the token)
+        stale_seconds (int): Heartbeat age after which a running job no longer holds the lease
+        queued_seconds (int): Age after which a job still waiting for a worker no longer holds the lease
+
+    Returns:
+        tuple: (job ID, True if this call created the job or False if it is the user's in-flight job),
+        or (None, False) if the job could not be queued
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = 'failed', error = 'Analysis worker stopped responding', token_info = NULL, finished_at = NOW()
+                WHERE spotify_id = %s AND status = 'running' AND heartbeat_at < NOW() - make_interval(secs => %s)
+                """,
+                (spotify_id, stale_seconds)
+            )
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = 'failed', error = 'No analysis worker picked the job up', token_info = NULL, finished_at = NOW()
+                WHERE spotify_id = %s AND status = 'queued' AND created_at < NOW() - make_interval(secs => %s)
+                """,
+                (spotify_id, queued_seconds)
+            )
+            if worker_id:
+                cursor.execute(
+                    """
+                    INSERT INTO analysis_jobs (spotify_id, mode, status, phase, attempts, worker_id, started_at, heartbeat_at)
+                    VALUES (%s, %s, 'running', 'starting', 1, %s, NOW(), NOW())
+                    ON CONFLICT (spotify_id) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING id
+                    """,
+                    (spotify_id, mode, worker_id)
+                )
+            else:
+                cursor.execute(
+                    """
+                    INSERT INTO analysis_jobs (spotify_id, mode, token_info, phase)
+                    VALUES (%s, %s, %s, 'queued')
+                    ON CONFLICT (spotify_id) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING id
+                    """,
+                    (spotify_id, mode, Json(token_info))
+                )
+            row = cursor.fetchone()
+            created = row is not None
+            if not created:
+                # The in-flight job may have finished since the insert; then its result is the one to use
+                cursor.execute(
+                    "SELECT id FROM analysis_jobs WHERE spotify_id = %s ORDER BY id DESC LIMIT 1",
+                    (spotify_id,)
+                )
+                row = cursor.fetchone()
+            conn.commit()
+        return row[0], created
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in enqueue_analysis_job: {e}")
+        return None, False
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def claim_analysis_job(worker_id, stale_seconds):
+    """Take the oldest queued job.
+
+    Jobs are claimed with FOR UPDATE SKIP LOCKED, so concurrent workers never get the same
+    job. The Spotify token is handed to the worker and cleared from the row in the same
+    statement, so it only sits in the table while the job waits. Running jobs whose worker
+    stopped sending heartbeats can't be resumed without it and are marked failed.
+
+    Returns:
+        dict: The claimed job (id, spotify_id, mode, token_info, attempts), or None if there is none
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = 'failed', error = 'Analysis worker stopped responding', token_info = NULL, finished_at = NOW()
+                WHERE status = 'running' AND heartbeat_at < NOW() - make_interval(secs => %s)
+                """,
+                (stale_seconds,)
+            )
+            cursor.execute(
+                """
+                WITH next_job AS (
+                    SELECT id, token_info FROM analysis_jobs
+                    WHERE status = 'queued'
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                UPDATE analysis_jobs
+                SET status = 'running', attempts = attempts + 1, worker_id = %s, token_info = NULL,
+                    started_at = NOW(), heartbeat_at = NOW(), phase = 'starting'
+                FROM next_job
+                WHERE analysis_jobs.id = next_job.id
+                RETURNING analysis_jobs.id, analysis_jobs.spotify_id, analysis_jobs.mode, next_job.token_info, analysis_jobs.attempts
+                """,
+                (worker_id,)
+            )
+            row = cursor.fetchone()
+            conn.commit()
+        if not row:
+            return None
+        return {'id': row[0], 'spotify_id': row[1], 'mode': row[2], 'token_info': row[3], 'attempts': row[4]}
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in claim_analysis_job: {e}")
+        return None
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def expire_queued_analysis_job(job_id):
+    """Fail a job that is still waiting for a worker (and drop its token); a claimed job is left alone."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = 'failed', phase = 'failed', error = 'No analysis worker picked the job up',
+                    token_info = NULL, finished_at = NOW()
+                WHERE id = %s AND status = 'queued'
+                """,
+                (job_id,)
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in expire_queued_analysis_job: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def has_active_analysis_job(spotify_id, stale_seconds=300, queued_seconds=600):
+    """Whether an analysis for the user is queued or running (and its lease hasn't lapsed).
+
+    Returns True if the database can't be reached, so callers keep treating the analysis as in flight.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT 1 FROM analysis_jobs
+                WHERE spotify_id = %s AND (
+                    (status = 'running' AND heartbeat_at >= NOW() - make_interval(secs => %s))
+                    OR (status = 'queued' AND created_at >= NOW() - make_interval(secs => %s))
+                )
+                LIMIT 1
+                """,
+                (spotify_id, stale_seconds, queued_seconds)
+            )
+            return cursor.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error in has_active_analysis_job: {e}")
+        return True
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def update_analysis_job_progress(job_id, phase, progress):
+    """Record a running job's current phase and progress; also serves as its heartbeat."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs SET phase = %s, progress = %s, heartbeat_at = NOW()
+                WHERE id = %s AND status = 'running'
+                """,
+                (phase, Json(progress), job_id)
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in update_analysis_job_progress: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def finish_analysis_job(job_id, status, result=None, error=None):
+    """Mark a job 'completed' or 'failed', store its result and drop the stored Spotify token."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE analysis_jobs
+                SET status = %s, phase = %s, result = %s, error = %s, token_info = NULL, finished_at = NOW()
+                WHERE id = %s
+                """,
+                (status, status, Json(result) if result is not None else None, error, job_id)
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in finish_analysis_job: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def get_analysis_job(job_id):
+    """Look up a job's status for the progress endpoint.
+
+    Returns:
+        dict: id, spotify_id, mode, status, phase, progress, result, error, timestamps,
+        heartbeat_age (seconds since the last heartbeat) and age (seconds since it was queued),
+        or None if not found
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id, spotify_id, mode, status, phase, progress, result, error,
+                       created_at, started_at, finished_at, EXTRACT(EPOCH FROM NOW() - heartbeat_at),
+                       EXTRACT(EPOCH FROM NOW() - created_at)
+                FROM analysis_jobs WHERE id = %s
+                """,
+                (job_id,)
+            )
+            row = cursor.fetchone()
+        if not row:
+            return None
+        keys = ['id', 'spotify_id', 'mode', 'status', 'phase', 'progress', 'result', 'error',
+                'created_at', 'started_at', 'finished_at', 'heartbeat_age', 'age']
+        return dict(zip(keys, row))
+    except Exception as e:
+        logger.error(f"Error in get_analysis_job: {e}")
+        return None
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def store_upstream_metrics(process_id, metrics):
+    """Save a process's current upstream metrics, replacing its previous snapshot."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO upstream_metrics (process_id, metrics, updated_at) VALUES (%s, %s, NOW())
+                ON CONFLICT (process_id) DO UPDATE SET metrics = EXCLUDED.metrics, updated_at = NOW()
+                """,
+                (process_id, Json(metrics))
+            )
+            conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logger.error(f"Error in store_upstream_metrics: {e}")
+    finally:
+        if conn:
+            close_db_connection(conn)
+
+def get_upstream_metrics(max_age_seconds):
+    """Upstream metrics snapshots saved within max_age_seconds, newest first.
+
+    Returns:
+        list: dicts with process_id, metrics and age (seconds since the snapshot), or [] on failure
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT process_id, metrics, EXTRACT(EPOCH FROM NOW() - updated_at) FROM upstream_metrics
+                WHERE updated_at >= NOW() - make_interval(secs => %s)
+                ORDER BY updated_at DESC
+                """,
+                (max_age_seconds,)
+            )
+            rows = cursor.fetchall() or []
+        return [{'process_id': row[0], 'metrics': row[1], 'age': round(float(row[2]), 1)} for row in rows]
+    except Exception as e:
+        logger.error(f"Error in get_upstream_metrics: {e}")
+        return []
+    finally:
+        if conn:
+            close_db_connection(conn)
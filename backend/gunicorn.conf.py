@@ -1,13 +1,16 @@
 # Gunicorn configuration file
 import multiprocessing
+import os
 
 max_requests = 1000
 max_requests_jitter = 50
 
 log_file = "-"
 
-# Increase timeout to 10 minutes (600 seconds)
-timeout = 600
+# With ANALYSIS_QUEUE_ENABLED analyses run in analysis workers and web requests stay short;
+# otherwise /api/analyze runs the whole analysis and needs up to 10 minutes (600 seconds)
+analysis_queue_enabled = os.getenv('ANALYSIS_QUEUE_ENABLED', 'false').lower() == 'true'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120' if analysis_queue_enabled else '600'))
 keepalive = 5
 
 # Worker configuration for parallel processing
@@ -0,0 +1,134 @@
+# this file gives each upstream provider one long-lived keep-alive requests.Session with its own
+# connect/read timeouts and retry policy, so tracks reuse warm TCP+TLS connections instead of opening
+# a new one per request, and counts how many requests actually got a reused connection
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from rate_limiter import active_call
+
+# Connections kept open per host and provider (at least the provider's limiter concurrency)
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '32'))
+
+# Connect/read timeouts in seconds and how often to retry a failed connection or a 502/504.
+# Read timeouts aren't retried, and 429/503 are left to the provider's limiter and breaker
+PROVIDER_HTTP_SETTINGS = {
+    'genius': {'connect_timeout': 3.05, 'read_timeout': 10, 'retries': 1},
+    'vagalume': {'connect_timeout': 3.05, 'read_timeout': 8, 'retries': 1},
+    'itunes': {'connect_timeout': 3.05, 'read_timeout': 8, 'retries': 1},
+    # Preview audio downloads from Apple's CDN
+    'itunes_audio': {'connect_timeout': 3.05, 'read_timeout': 15, 'retries': 2},
+}
+DEFAULT_HTTP_SETTINGS = {'connect_timeout': 3.05, 'read_timeout': 10, 'retries': 1}
+# Providers whose client library hides the HTTP status (lyricsgenius turns a 429 or 5xx into a bare
+# AssertionError), so their session reports every response to the provider's limiter itself
+REPORT_RESPONSES_TO_LIMITER = {'genius'}
+
+class ConnectionStats:
+    """Requests sent and connections opened by one provider's session."""
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        with self.lock:
+            requests_sent, opened = self.requests, self.connections_opened
+        return {
+            'requests': requests_sent,
+            'connections_opened': opened,
+            'connections_reused': max(0, requests_sent - opened),
+            'reuse_ratio': round(1 - opened / requests_sent, 3) if requests_sent else None
+        }
+
+def counting_pool_class(base, stats):
+    """Connection pool class that counts every new connection (each one means a TCP, and for https a TLS, handshake)."""
+    class CountingConnectionPool(base):
+        def _new_conn(self):
+            stats.count('connections_opened')
+            return super()._new_conn()
+    return CountingConnectionPool
+
+class ProviderAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools count new connections and whose sends count requests."""
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': counting_pool_class(HTTPConnectionPool, self.stats),
+            'https': counting_pool_class(HTTPSConnectionPool, self.stats)
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.count('requests')
+        return super().send(request, **kwargs)
+
+_sessions = {}
+_stats = {}
+_sessions_lock = threading.Lock()
+
+def limiter_response_hook(provider):
+    """requests response hook that passes each response to the provider's active limited() call,
+    so throttling (with Retry-After) and 5xx errors reach its limiter and breaker."""
+    def report(response, *args, **kwargs):
+        call = active_call(provider)
+        if call is not None:
+            call.check_response(response)
+        return response
+    return report
+
+def http_settings(provider):
+    return PROVIDER_HTTP_SETTINGS.get(provider, DEFAULT_HTTP_SETTINGS)
+
+def http_timeout(provider):
+    """(connect, read) timeout tuple for a provider, as accepted by requests."""
+    settings = http_settings(provider)
+    return (settings['connect_timeout'], settings['read_timeout'])
+
+def get_session(provider):
+    """The provider's shared keep-alive session, created on first use and reused by every thread."""
+    with _sessions_lock:
+        if provider not in _sessions:
+            settings = http_settings(provider)
+            retries = Retry(
+                total=settings['retries'],
+                connect=settings['retries'],
+                read=0,
+                status=settings['retries'],
+                status_forcelist=(502, 504),
+                backoff_factor=0.3,
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False
+            )
+            _stats[provider] = ConnectionStats()
+            adapter = ProviderAdapter(
+                _stats[provider], pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE,
+                max_retries=retries, pool_block=False
+            )
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if provider in REPORT_RESPONSES_TO_LIMITER:
+                session.hooks['response'].append(limiter_response_hook(provider))
+            _sessions[provider] = session
+        return _sessions[provider]
+
+def get(provider, url, **kwargs):
+    """GET through the provider's session, with its timeouts unless the caller passes its own."""
+    kwargs.setdefault('timeout', http_timeout(provider))
+    return get_session(provider).get(url, **kwargs)
+
+def http_metrics():
+    """Connection reuse statistics of every provider's session in this process."""
+    with _sessions_lock:
+        stats = dict(_stats)
+    return {provider: provider_stats.snapshot() for provider, provider_stats in sorted(stats.items())}
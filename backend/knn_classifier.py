@@ -0,0 +1,52 @@
+import numpy as np
+
+class KNearestMoodClassifier:
+    def __init__(self, k=5):
+        self.k = k
+        self.moods = []                 # mood labels, columns of self.labels
+        self.mean = np.zeros(0)
+        self.std = np.ones(0)
+        self.features = np.zeros((0, 0))   # standardized training features
+        self.labels = np.zeros((0, 0))     # (examples x moods) 0/1 membership
+
+    def fit(self, features, moods):
+        """
+        features: (examples x features) array of raw audio features
+        moods: list with the mood list of each example
+        """
+        features = np.asarray(features, dtype=np.float64)
+        self.moods = sorted({mood for example_moods in moods for mood in example_moods})
+        mood_index = {mood: i for i, mood in enumerate(self.moods)}
+        self.labels = np.zeros((len(moods), len(self.moods)))
+        for row, example_moods in enumerate(moods):
+            self.labels[row, [mood_index[mood] for mood in example_moods]] = 1
+
+        self.mean = features.mean(axis=0)
+        # Constant features would divide by zero; leaving them unscaled makes them drop out of distances
+        std = features.std(axis=0)
+        self.std = np.where(std > 0, std, 1.0)
+        self.features = (features - self.mean) / self.std
+
+    def predict_proba_batch(self, features):
+        """
+        Share of the k nearest training songs carrying each mood, as a (tracks x moods) array
+        whose columns follow self.moods
+        """
+        queries = (np.asarray(features, dtype=np.float64) - self.mean) / self.std
+        # Squared Euclidean distances to every training song at once: |q|^2 + |x|^2 - 2 q.x
+        distances = (
+            (queries ** 2).sum(axis=1, keepdims=True)
+            + (self.features ** 2).sum(axis=1)
+            - 2 * queries @ self.features.T
+        )
+        k = min(self.k, len(self.features))
+        neighbours = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return self.labels[neighbours].mean(axis=1)
+
+    def predict_batch(self, features, threshold=0.6):
+        probs = self.predict_proba_batch(features)
+        # Moods carried by at least `threshold` of the neighbours, always including the most common one
+        return [
+            [self.moods[i] for i in np.flatnonzero((row >= threshold) | (np.arange(len(row)) == row.argmax()))]
+            for row in probs
+        ]
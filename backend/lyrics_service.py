@@ -7,42 +7,34 @@ import numpy as np
 import tempfile
 from urllib.parse import quote
 from pydub import AudioSegment
-import csv
-import pathlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import openai
 import json
 import logging
 import time
-import urllib3
-from urllib3.util.retry import Retry
 import sys  # Add sys for flushing output
-
-# Configure the urllib3 connection pool globally with much larger limits
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Create a custom connection pool manager with larger pool sizes
-http = urllib3.PoolManager(
-    maxsize=100,  # Maximum number of connections in the pool
-    block=False,  # Don't block when pool is full, just create new connections
-    retries=Retry(
-        total=5,
-        backoff_factor=0.5,
-        status_forcelist=[500, 502, 503, 504]
-    )
+from datetime import datetime
+from audio_features import (
+    decode_preview, extract_features_from_pcm, submit_features_batch, PreviewDownloadError,
+    TARGET_SAMPLE_RATE, AUDIO_PROCESS_WORKERS, AUDIO_FEATURE_MODE, AUDIO_FEATURE_VERSION, AUDIO_BATCH_SIZE
 )
-
-# Monkey patch requests to use our custom pool manager
-import requests.adapters
-original_init = requests.adapters.HTTPAdapter.__init__
-
-def patched_init(self, *args, **kwargs):
-    kwargs['pool_maxsize'] = 100
-    kwargs['max_retries'] = 5
-    kwargs['pool_block'] = False
-    return original_init(self, *args, **kwargs)
-
-requests.adapters.HTTPAdapter.__init__ = patched_init
+from db import (
+    get_track_audio_features, store_track_audio_features,
+    get_cached_lyrics, store_cached_lyrics,
+    get_cached_previews, store_cached_previews,
+    get_cached_classifications, store_cached_classifications,
+    store_training_examples
+)
+import re
+from naive_bayes import NaiveBayesMoodClassifier
+from knn_classifier import KNearestMoodClassifier
+from model_artifact import (
+    read_training_csv, read_training_store, read_artifact_manifest, load_model_artifact, TrainingSet
+)
+from rate_limiter import limited, limiter_metrics, status_of, get_limiter
+from circuit_breaker import breaker_metrics, UpstreamUnavailable
+import http_clients
 
 # Configure logging to reduce Numba verbosity - disable completely
 logging.basicConfig(level=logging.INFO)
@@ -89,15 +81,8 @@ def initialize_openai_client():
 
 def load_training_data():
     """Load training data from CSV file."""
-    training_data = []
-    csv_path = pathlib.Path(__file__).parent / 'training_data.csv'
-    
     try:
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                moods = [mood.strip() for mood in row['moods'].split(',')]
-                training_data.append({'song': row['song'],'artist': row['artist'],'lyrics': row['lyrics'], 'moods': moods,'tempo': row['tempo'],'energy': row['energy'],'brightness': row['brightness'],'zcr': row['zcr'],'contrast': row['contrast'],'chroma': row['chroma'],'flatness': row['flatness'],'rolloff': row['rolloff'],'mfcc1': row['mfcc1'],'mfcc2': row['mfcc2'],'mfcc3': row['mfcc3'],'mfcc4': row['mfcc4'],'mfcc5': row['mfcc5']})
+        training_data = read_training_csv()
         print(f"Loaded {len(training_data)} training examples from CSV")
         return training_data
     except Exception as e:
@@ -114,8 +99,224 @@ def load_training_data():
             {"lyrics": "I'm so mysterious", "moods": ["mysterious"],'tempo': 0,'energy': 0,'brightness': 0,'zcr': 0,'contrast': 0,'chroma': 0,'flatness': 0,'rolloff': 0,'mfcc1': 0,'mfcc2': 0,'mfcc3': 0,'mfcc4': 0,'mfcc5': 0}
         ]
 
-# Load training data from CSV
-training_data = load_training_data()
+# The audio features extracted for every track (and stored in the shared cache)
+AUDIO_FEATURE_KEYS = [
+    'tempo', 'energy', 'brightness', 'zcr', 'contrast', 'chroma', 'flatness', 'rolloff',
+    'mfcc1', 'mfcc2', 'mfcc3', 'mfcc4', 'mfcc5'
+]
+
+# "Not found" lyrics entries expire so songs that gain lyrics later get picked up
+LYRICS_NOT_FOUND_TTL_SECONDS = int(os.getenv('LYRICS_NOT_FOUND_TTL_HOURS', '72')) * 3600
+
+# Resolved preview URLs are stable for weeks; misses are retried sooner
+ITUNES_PREVIEW_HIT_TTL_SECONDS = int(os.getenv('ITUNES_PREVIEW_HIT_TTL_HOURS', '720')) * 3600
+ITUNES_PREVIEW_MISS_TTL_SECONDS = int(os.getenv('ITUNES_PREVIEW_MISS_TTL_HOURS', '24')) * 3600
+
+# Spotify caps saved-tracks pages at 50 items
+SAVED_TRACKS_PAGE_SIZE = 50
+# Max concurrent saved-tracks page requests when ingesting large libraries
+SPOTIFY_PAGE_WORKERS = int(os.getenv('SPOTIFY_PAGE_WORKERS', '4'))
+
+# Mood labels the classifier may assign
+MOOD_LIST = ["happy", "sad", "energetic", "calm", "mad", "romantic", "mysterious", "focused"]
+
+LLM_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+# Bump whenever the classification prompt or MOOD_LIST changes so cached classifications are ignored
+CLASSIFICATION_PROMPT_VERSION = os.getenv('CLASSIFICATION_PROMPT_VERSION', '1')
+# Estimated prompt tokens per classification request (instructions + examples + tracks)
+LLM_CHUNK_TOKEN_BUDGET = int(os.getenv('LLM_CHUNK_TOKEN_BUDGET', '12000'))
+# Upper bound on tracks per request so responses stay short and cheap to retry
+LLM_MAX_TRACKS_PER_CHUNK = int(os.getenv('LLM_MAX_TRACKS_PER_CHUNK', '40'))
+# Concurrent classification requests
+LLM_MAX_IN_FLIGHT = int(os.getenv('LLM_MAX_IN_FLIGHT', '4'))
+# Extra rounds for failed chunks and tracks missing from responses
+LLM_CHUNK_RETRIES = int(os.getenv('LLM_CHUNK_RETRIES', '2'))
+# Shrink prompts: deduplicated/capped lyrics, quantized features, minified JSON and short track aliases
+PROMPT_COMPACTION = os.getenv('PROMPT_COMPACTION', 'true').lower() == 'true'
+# Estimated tokens of lyrics kept per song when compacting
+LYRICS_EXCERPT_TOKEN_BUDGET = int(os.getenv('LYRICS_EXCERPT_TOKEN_BUDGET', '250'))
+# Significant digits kept for audio features when compacting
+AUDIO_FEATURE_SIGNIFICANT_DIGITS = 3
+# Genius section markers like [Chorus] or [Verse 2: Artist]
+LYRIC_SECTION_PATTERN = re.compile(r'^\[[^\]]*\]$')
+
+# Label tracks locally with Naive Bayes when its top-mood posterior is confident enough (off by default:
+# trained on the small training_data.csv it is overconfident, so tune the threshold before enabling)
+LOCAL_CLASSIFIER_ENABLED = os.getenv('LOCAL_CLASSIFIER_ENABLED', 'false').lower() == 'true'
+LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD', '0.95'))
+# Moods at or above this posterior are assigned alongside the top mood
+LOCAL_CLASSIFIER_MOOD_THRESHOLD = float(os.getenv('LOCAL_CLASSIFIER_MOOD_THRESHOLD', '0.1'))
+# Posteriors from a handful of known words are mostly the prior, so short/instrumental lyrics always go to the LLM
+LOCAL_CLASSIFIER_MIN_TOKENS = int(os.getenv('LOCAL_CLASSIFIER_MIN_TOKENS', '30'))
+# Save LLM labels as training examples and periodically fold them into the local classifier. Only the
+# local classifier reads them, so this follows LOCAL_CLASSIFIER_ENABLED unless set (true alone collects
+# examples ahead of turning the classifier on)
+SELF_TRAINING_ENABLED = os.getenv('SELF_TRAINING_ENABLED', str(LOCAL_CLASSIFIER_ENABLED)).lower() == 'true'
+SELF_TRAINING_REFRESH_SECONDS = int(os.getenv('SELF_TRAINING_REFRESH_SECONDS', '600'))
+# Audio-feature k-NN labels anything the LLM could not classify
+KNN_NEIGHBOURS = int(os.getenv('KNN_NEIGHBOURS', '5'))
+# Moods shared by at least this fraction of the neighbours are assigned (the most common one always is)
+KNN_MOOD_THRESHOLD = float(os.getenv('KNN_MOOD_THRESHOLD', '0.6'))
+# Label tracks without lyrics by k-NN over their audio features instead of sending them to the LLM
+# (ones without audio features still go to the LLM). Off by default: k-NN's top mood is right less
+# often than always guessing the most common mood, while the LLM still sees title and artist
+KNN_FOR_TRACKS_WITHOUT_LYRICS = os.getenv('KNN_FOR_TRACKS_WITHOUT_LYRICS', 'false').lower() == 'true'
+# Streaming analyses classify extracted tracks in batches of up to this many while extraction continues
+# (by default one full LLM chunk, so streaming doesn't multiply prompt overhead)
+STREAM_CLASSIFY_BATCH_SIZE = int(os.getenv('STREAM_CLASSIFY_BATCH_SIZE', str(LLM_MAX_TRACKS_PER_CHUNK)))
+# Classification batches in flight at once (each may send several LLM chunks)
+STREAM_CLASSIFY_WORKERS = int(os.getenv('STREAM_CLASSIFY_WORKERS', '2'))
+# Hedged lyrics lookups: if Genius hasn't answered within its rolling LYRICS_HEDGE_PERCENTILE latency,
+# Vagalume is asked in parallel and the first non-empty answer wins
+LYRICS_HEDGE_ENABLED = os.getenv('LYRICS_HEDGE_ENABLED', 'true').lower() == 'true'
+LYRICS_HEDGE_PERCENTILE = float(os.getenv('LYRICS_HEDGE_PERCENTILE', '90'))
+# Hedge delay before Genius has latency samples, and the bounds the percentile is clamped to
+LYRICS_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv('LYRICS_HEDGE_DEFAULT_DELAY_SECONDS', '2'))
+LYRICS_HEDGE_MIN_DELAY_SECONDS = float(os.getenv('LYRICS_HEDGE_MIN_DELAY_SECONDS', '0.25'))
+LYRICS_HEDGE_MAX_DELAY_SECONDS = float(os.getenv('LYRICS_HEDGE_MAX_DELAY_SECONDS', '5'))
+# Threads running the provider calls of hedged lookups (the limiters still cap each provider)
+LYRICS_HEDGE_WORKERS = int(os.getenv('LYRICS_HEDGE_WORKERS', '32'))
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+_hedge_counts = {'lookups': 0, 'hedged': 0, 'secondary_won': 0}
+
+def train_local_classifier(examples):
+    """Train the Naive Bayes lyrics classifier used to label confident tracks without the LLM."""
+    try:
+        classifier = NaiveBayesMoodClassifier()
+        classifier.fit([(example['lyrics'], example['moods']) for example in examples if example.get('lyrics')])
+        print(f"Trained local mood classifier on {len(examples)} examples ({len(classifier.vocab)} words)")
+        return classifier
+    except Exception as e:
+        print(f"Error training local mood classifier: {e}")
+        return None
+
+def train_knn_classifier(examples):
+    """Fit the audio-feature k-NN classifier on the training examples that have extracted features."""
+    try:
+        if isinstance(examples, TrainingSet):
+            features, moods = examples.feature_matrix()
+        else:
+            features = np.array([[float(example.get(key) or 0) for key in AUDIO_FEATURE_KEYS] for example in examples])
+            moods = [example['moods'] for example in examples]
+        # Examples without a preview carry all-zero features, which would only add noise
+        has_features = np.any(features != 0, axis=1)
+        if not has_features.any():
+            print("No training examples with audio features; k-NN fallback disabled")
+            return None
+        classifier = KNearestMoodClassifier(k=KNN_NEIGHBOURS)
+        classifier.fit(features[has_features], [example_moods for example_moods, keep in zip(moods, has_features) if keep])
+        print(f"Trained k-NN mood classifier on {int(has_features.sum())} examples")
+        return classifier
+    except Exception as e:
+        print(f"Error training k-NN mood classifier: {e}")
+        return None
+
+# Training data and the local classifiers are loaded on first use (see load_models)
+_training_data = None
+_local_classifier = None
+_knn_classifier = None
+# Newest training-store example already folded into _local_classifier, and the artifact it was built on
+_store_max_id = 0
+_artifact_built_at = None
+_last_refresh = 0
+_models_lock = threading.Lock()
+
+def _load_models_locked():
+    """(Re)load the training set and local classifiers; callers must hold _models_lock."""
+    global _training_data, _local_classifier, _knn_classifier, _store_max_id, _artifact_built_at
+    start_time = time.time()
+    artifact = load_model_artifact()
+    if artifact:
+        training_data, classifier, manifest = artifact
+        _store_max_id = manifest.get('store_max_id', 0)
+        _artifact_built_at = manifest.get('built_at')
+        source = "model artifact"
+    else:
+        training_data = load_training_data()
+        classifier = train_local_classifier(training_data)
+        _store_max_id = 0
+        _artifact_built_at = None
+        source = "training CSV"
+    _local_classifier = classifier
+    _knn_classifier = train_knn_classifier(training_data)
+    _training_data = training_data
+    print(f"Loaded {len(training_data)} training examples and local classifiers from {source} in {time.time() - start_time:.2f}s")
+    sys.stdout.flush()
+
+def load_models():
+    """Load the training set and local classifiers once per process.
+
+    Prefers the precompiled artifact from model_artifact.py, whose arrays are
+    memory-mapped and shared between workers; otherwise parses training_data.csv
+    and fits the classifier in this process.
+    """
+    with _models_lock:
+        if _training_data is None:
+            _load_models_locked()
+
+def refresh_local_classifier():
+    """Fold newly stored LLM labels into the local classifier, at most every SELF_TRAINING_REFRESH_SECONDS.
+
+    If the artifact was recompiled since it was loaded (it then already contains the
+    store up to its store_max_id), it is reloaded first; examples stored after that
+    are added with partial_fit.
+    """
+    global _local_classifier, _store_max_id, _last_refresh
+    if not SELF_TRAINING_ENABLED or time.time() - _last_refresh < SELF_TRAINING_REFRESH_SECONDS:
+        return
+    with _models_lock:
+        if time.time() - _last_refresh < SELF_TRAINING_REFRESH_SECONDS:
+            return
+        _last_refresh = time.time()
+        manifest = read_artifact_manifest()
+        if manifest and manifest.get('built_at') != _artifact_built_at:
+            print("Model artifact was recompiled, reloading it")
+            sys.stdout.flush()
+            _load_models_locked()
+        if _local_classifier is None:
+            return
+        
+        examples, max_id = read_training_store(after_id=_store_max_id)
+        labeled = [(example['lyrics'], example['moods']) for example in examples if example['lyrics'] and example['moods']]
+        if labeled:
+            # classify_locally scores without the lock, so fit a copy and swap it in whole;
+            # growing the vocab in place could pair a wider count matrix with the old probabilities
+            classifier = _local_classifier.copy()
+            classifier.partial_fit(labeled)
+            _local_classifier = classifier
+            print(f"Local classifier trained on {len(labeled)} new LLM-labeled tracks ({len(classifier.vocab)} words)")
+            sys.stdout.flush()
+        _store_max_id = max_id
+
+def get_training_data():
+    """Training examples used as few-shot examples in classification prompts."""
+    load_models()
+    return _training_data
+
+def get_knn_classifier():
+    """The audio-feature k-NN classifier, or None if no training example has features."""
+    load_models()
+    return _knn_classifier
+
+def get_local_classifier():
+    """The local Naive Bayes classifier, or None when LOCAL_CLASSIFIER_ENABLED is off."""
+    if not LOCAL_CLASSIFIER_ENABLED:
+        return None
+    load_models()
+    refresh_local_classifier()
+    return _local_classifier
+
+def clean_track_title(track_name):
+    """Strip featured artists, remaster tags, etc. from a track name for lyrics search."""
+    return track_name.split('(')[0].strip().split('-')[0].strip()
+
+def lyrics_cache_key(track):
+    """Build the normalized (title, artist) key used by the shared lyrics cache."""
+    title = re.sub(r'\s+', ' ', clean_track_title(track['name'])).lower()
+    artist = re.sub(r'\s+', ' ', track['artist']).strip().lower()
+    return f"{title}|{artist}"[:512]
 
 def create_genius_client():
     token = os.getenv('GENIUS_ACCESS_TOKEN')
@@ -128,28 +329,22 @@ def create_genius_client():
             print("WARNING: GENIUS_ACCESS_TOKEN is not set")
             return None
         
-        print("Creating Genius client with optimized connection pool...")
+        print("Creating Genius client on the shared Genius session...")
         genius = Genius(
             token,
             verbose=True,
             remove_section_headers=True,
-            timeout=30,
-            retries=3,  # Reduced from 5 to avoid overloading
-            sleep_time=0.5,  # Reduced for speed while still respecting rate limits
+            timeout=http_clients.http_timeout('genius'),
+            retries=0,  # Connection retries come from the session's retry policy, throttling from the limiter
+            sleep_time=0,  # The 'genius' limiter paces requests instead of sleeping after each one
         )
         
-        # Override the genius client's session to use our configured adapter
-        session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(
-            pool_maxsize=100,
-            max_retries=3,
-            pool_block=False
-        )
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
+        # Swap in the shared keep-alive session, keeping the auth/User-Agent headers lyricsgenius set up
+        session = http_clients.get_session('genius')
+        session.headers.update(genius._session.headers)
         genius._session = session
         
-        print("Genius client created successfully with optimized connection pool")
+        print("Genius client created successfully")
         return genius
     except Exception as e:
         print(f"Error creating Genius client: {e}")
@@ -162,8 +357,8 @@ def download_and_convert_preview(preview_url):
     try:
         # Download m4a
         m4a_fd, m4a_path = tempfile.mkstemp(suffix='.m4a')
-        with os.fdopen(m4a_fd, 'wb') as f:
-            r = requests.get(preview_url, stream=True)
+        with os.fdopen(m4a_fd, 'wb') as f, http_clients.get('itunes_audio', preview_url, stream=True) as r:
+            r.raise_for_status()
             for chunk in r.iter_content(chunk_size=8192):
                 f.write(chunk)
         # Convert to wav
@@ -183,21 +378,36 @@ def download_and_convert_preview(preview_url):
         return None
 
 def get_itunes_preview(track_name, artist_name):
-    """Search iTunes for a track and return the 30s preview URL if available."""
+    """Search iTunes for a track and return the 30s preview URL if available.
+
+    Raises:
+        UpstreamUnavailable: if iTunes is down or throttling us, so the miss isn't cached as "no preview"
+    """
     query = f'{track_name} {artist_name}'
     url = f'https://itunes.apple.com/search?term={quote(query)}&entity=song&limit=1'
     try:
-        resp = requests.get(url, timeout=10)
+        with limited('itunes') as call:
+            resp = call.check_response(http_clients.get('itunes', url))
+        if call.outcome in ('throttled', 'failed'):
+            raise UpstreamUnavailable('itunes', f"answered {resp.status_code}")
         if resp.status_code == 200:
             data = resp.json()
             if data['resultCount'] > 0:
                 return data['results'][0].get('previewUrl')  # 30s MP3 URL
+    except UpstreamUnavailable:
+        raise
+    except requests.RequestException as e:
+        raise UpstreamUnavailable('itunes', f"is unreachable ({e})") from e
     except Exception as e:
         print(f"Error fetching iTunes preview: {e}")
     return None 
 
 def fetch_lyrics_with_vagalume(song_title, artist_name):
-    """Fetch lyrics from Vagalume public API as a fallback if Genius fails."""
+    """Fetch lyrics from Vagalume public API as a fallback if Genius fails.
+
+    Raises:
+        UpstreamUnavailable: if Vagalume is down or throttling us
+    """
     try:
         print(f"[VAGALUME] Attempting to fetch lyrics for '{song_title}' by '{artist_name}'")
         base_url = "https://api.vagalume.com.br/search.php"
@@ -205,7 +415,10 @@ def fetch_lyrics_with_vagalume(song_title, artist_name):
             'art': artist_name,
             'mus': song_title
         }
-        resp = requests.get(base_url, params=params, timeout=10)
+        with limited('vagalume') as call:
+            resp = call.check_response(http_clients.get('vagalume', base_url, params=params))
+        if call.outcome in ('throttled', 'failed'):
+            raise UpstreamUnavailable('vagalume', f"answered {resp.status_code}")
         if resp.status_code != 200:
             print(f"[VAGALUME] API request failed: {resp.status_code}")
             return None
@@ -219,53 +432,138 @@ def fetch_lyrics_with_vagalume(song_title, artist_name):
             return lyrics
         print(f"[VAGALUME] No lyrics found in response for '{song_title}' by '{artist_name}'")
         return None
+    except UpstreamUnavailable:
+        raise
+    except requests.RequestException as e:
+        raise UpstreamUnavailable('vagalume', f"is unreachable ({e})") from e
     except Exception as e:
         print(f"[VAGALUME] Error fetching lyrics: {e}")
         import traceback; traceback.print_exc()
         return None
 
-def analyze_track(track, genius):
-    """Extract audio features and lyrics from a track efficiently."""
+def analyze_track(track, genius, cached_features=None, cached_lyrics=None, cached_preview=None, defer_features=False,
+                  lyrics_executor=None):
+    """Extract audio features and lyrics from a track efficiently.
+
+    If cached_features is given (from the shared track_audio_features store),
+    the iTunes lookup and librosa analysis are skipped entirely. Likewise a
+    cached_lyrics value (including "" for songs known to have no lyrics)
+    skips the Genius/Vagalume lookup, and a cached_preview value (including ""
+    for tracks known to have no preview) skips the iTunes search.
+    
+    With a lyrics_executor, the lyrics lookup runs on it while this thread
+    fetches and decodes the preview, so a track takes about as long as the
+    slower of the two instead of their sum.
+    
+    With defer_features, the decoded preview is returned under 'pcm' (with
+    feature_source 'pending') so the caller can extract features in micro-batches.
+    """
     track_name = track['name']
     artist_name = track['artist']
     print(f"Analyzing track: {track_name} by {artist_name}")
     
-    # Initialize with defaults
-    audio_features = {
-        'tempo': 0, 'energy': 0, 'brightness': 0, 'zcr': 0, 
-        'contrast': 0, 'chroma': 0, 'flatness': 0, 'rolloff': 0,
-        'mfcc1': 0, 'mfcc2': 0, 'mfcc3': 0, 'mfcc4': 0, 'mfcc5': 0
-    }
-    lyrics = ""
-    
     # Create result dictionary immediately to avoid redundant copy operations
     result = track.copy()
+    lyrics_future = None
     
     try:
-        # Process lyrics first (while iTunes request is being made)
-        # This is often faster than audio processing and can run in parallel
-        if genius:
-            lyrics = extract_lyrics_faster(track, genius)
-            result['lyrics'] = lyrics
-        
-        # Process audio features
-        preview_url = get_itunes_preview(track_name, artist_name)
-        if preview_url:
-            print(f"Found iTunes preview for {track_name}")
-            audio_features = extract_audio_features(preview_url, track_name)
-            result.update(audio_features)
-        else:
-            print(f"No iTunes preview found for {track_name}")
-            result.update(audio_features)  # Use default features
+        if cached_lyrics is not None:
+            result['lyrics'] = cached_lyrics
+            result['lyrics_source'] = 'cache'
+        elif genius and lyrics_executor is not None:
+            lyrics_future = lyrics_executor.submit(extract_lyrics_faster, track, genius)
+        elif genius:
+            set_fetched_lyrics(result, extract_lyrics_faster(track, genius))
         
+        analyze_track_audio(result, track_name, artist_name, cached_features, cached_preview, defer_features)
         return result
         
     except Exception as e:
         print(f"Error analyzing track {track_name}: {e}")
         # Still return a track with at least the basic info so it doesn't get lost
-        result['lyrics'] = lyrics
-        result.update(audio_features)
+        result.setdefault('lyrics', "")
+        for key in AUDIO_FEATURE_KEYS:
+            result.setdefault(key, 0)
         return result
+    
+    finally:
+        # Runs before the caller gets result, so the lyrics are in it on both paths above
+        if lyrics_future is not None:
+            set_fetched_lyrics(result, lyrics_future.result())
+
+def set_fetched_lyrics(result, lyrics):
+    """Store an extract_lyrics_faster answer on a track result."""
+    # None means a source was down or throttled; don't cache that as "no lyrics"
+    result['lyrics_source'] = 'fetched' if lyrics is not None else 'unavailable'
+    result['lyrics'] = lyrics or ""
+
+def analyze_track_audio(result, track_name, artist_name, cached_features, cached_preview, defer_features):
+    """Fill in a track result's preview URL and audio features (see analyze_track)."""
+    # Initialize with defaults
+    audio_features = {key: 0 for key in AUDIO_FEATURE_KEYS}
+    
+    # Reuse features another analysis already extracted for this song
+    if cached_features:
+        print(f"Using cached audio features for {track_name}")
+        audio_features.update(cached_features)
+        result.update(audio_features)
+        result['feature_source'] = 'cache'
+        return
+    
+    if cached_preview is not None:
+        preview_url = cached_preview or None
+        result['preview_source'] = 'cache'
+    else:
+        try:
+            preview_url = get_itunes_preview(track_name, artist_name)
+            result['preview_source'] = 'fetched'
+        except UpstreamUnavailable as e:
+            # Not cached, so the next analysis looks the preview up again
+            print(f"Skipping iTunes preview for {track_name}: {e}")
+            preview_url = None
+            result['preview_source'] = 'unavailable'
+    result['preview_url'] = preview_url
+    if preview_url and defer_features:
+        print(f"Found iTunes preview for {track_name}")
+        result.update(audio_features)  # Defaults until the batch is processed
+        result['pcm'] = load_preview_audio(preview_url, track_name)
+        result['feature_source'] = 'pending' if result['pcm'] is not None else 'none'
+    elif preview_url:
+        print(f"Found iTunes preview for {track_name}")
+        audio_features = extract_audio_features(preview_url, track_name)
+        result.update(audio_features)
+        # Only successful extractions are worth sharing with other users
+        result['feature_source'] = 'itunes' if any(audio_features.values()) else 'none'
+    else:
+        print(f"No iTunes preview found for {track_name}")
+        result.update(audio_features)  # Use default features
+        result['feature_source'] = 'none'
+
+def load_preview_audio(preview_url, track_name):
+    """Decode a preview to mono float32 PCM at TARGET_SAMPLE_RATE. Returns None on failure."""
+    # Decode straight from the HTTP stream into memory (no temp files)
+    try:
+        y = decode_preview(preview_url, sr=TARGET_SAMPLE_RATE)
+    except PreviewDownloadError as e:
+        # Downloading the same URL again for the temp-file path wouldn't go any better; no features
+        # means nothing is stored in the shared cache, so the next analysis tries again
+        print(f"{e} for {track_name}")
+        return None
+    if y is not None and len(y) > 0:
+        return y
+    
+    # Fall back to the temp-file path for containers ffmpeg can't read from a pipe
+    # (e.g. m4a files with the moov atom at the end)
+    print(f"In-memory decode failed for {track_name}, falling back to temp file conversion")
+    wav_path = download_and_convert_preview(preview_url)
+    if not wav_path:
+        return None
+    try:
+        y, _ = librosa.load(wav_path, sr=TARGET_SAMPLE_RATE)
+        return y
+    finally:
+        if os.path.exists(wav_path):
+            os.remove(wav_path)
 
 def extract_audio_features(preview_url, track_name):
     """Extract audio features from a track preview URL."""
@@ -275,58 +573,15 @@ def extract_audio_features(preview_url, track_name):
         'mfcc1': 0, 'mfcc2': 0, 'mfcc3': 0, 'mfcc4': 0, 'mfcc5': 0
     }
     
-    wav_path = None
     y = None
-    sr = None
     
     try:
-        wav_path = download_and_convert_preview(preview_url)
-        if not wav_path:
+        y = load_preview_audio(preview_url, track_name)
+        if y is None:
             return audio_features
-            
-        # Use a lower SR for faster processing with minimal quality loss
-        y, sr = librosa.load(wav_path, sr=22050)  # Lower sample rate for faster processing
         
-        # Extract features
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-        energy = float(np.mean(librosa.feature.rms(y=y)))
-        
-        # Use optimized computation methods - compute STFT once and reuse
-        stft = np.abs(librosa.stft(y))
-        
-        # Calculate spectral features efficiently using the same STFT
-        brightness = float(np.mean(librosa.feature.spectral_centroid(S=stft, sr=sr)))
-        zcr = float(np.mean(librosa.feature.zero_crossing_rate(y)))
-        contrast = float(np.mean(librosa.feature.spectral_contrast(S=stft, sr=sr)))
-        chroma = float(np.mean(librosa.feature.chroma_stft(S=stft, sr=sr)))
-        flatness = float(np.mean(librosa.feature.spectral_flatness(S=stft)))
-        rolloff = float(np.mean(librosa.feature.spectral_rolloff(S=stft, sr=sr)))
-
-        # Calculate all MFCCs at once for efficiency
-        mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=5)
-        mfcc1 = float(np.mean(mfccs[0]))
-        mfcc2 = float(np.mean(mfccs[1]))
-        mfcc3 = float(np.mean(mfccs[2]))
-        mfcc4 = float(np.mean(mfccs[3]))
-        mfcc5 = float(np.mean(mfccs[4]))
-        
-        audio_features = {
-            'tempo': tempo,
-            'energy': energy,
-            'brightness': brightness,
-            'zcr': zcr,
-            'contrast': contrast,
-            'chroma': chroma,
-            'flatness': flatness,
-            'rolloff': rolloff,
-            'mfcc1': mfcc1,
-            'mfcc2': mfcc2,
-            'mfcc3': mfcc3,
-            'mfcc4': mfcc4,
-            'mfcc5': mfcc5
-        }
-        
-        return audio_features
+        # CPU-bound part runs in the process pool; this thread only waits for the result
+        return extract_features_from_pcm(y, TARGET_SAMPLE_RATE)
         
     except Exception as e:
         print(f"Error extracting audio features: {e}")
@@ -334,82 +589,533 @@ def extract_audio_features(preview_url, track_name):
         
     finally:
         # Clean up resources
-        if wav_path and os.path.exists(wav_path):
-            os.remove(wav_path)
         if y is not None:
             del y
-        if sr is not None:
-            del sr
+
+def fetch_lyrics_with_genius(genius, song_title, artist_name, started=None):
+    """Look lyrics up on Genius.
+
+    If given, the started event is set once the call holds its 'genius' limiter slot
+    (or has finished without one), so callers can time Genius itself rather than the queue.
+
+    Returns:
+        str: The lyrics, "" if Genius has none, or None if it didn't answer (breaker open,
+        throttled, timed out or 5xx)
+    """
+    call = None
+    try:
+        with limited('genius') as call:
+            if started:
+                started.set()
+            song = genius.search_song(song_title, artist_name, get_full_info=False)
+        # The genius session reports responses to the call; a throttled or failed lyrics page can still
+        # come back as a song without lyrics, which mustn't be cached as "no lyrics"
+        if call.outcome in ('throttled', 'failed'):
+            print(f"Genius search for '{song_title}' was {call.outcome}")
+            return None
+        return song.lyrics if song and song.lyrics else ""
+    except Exception as e:
+        print(f"Genius search failed: {e}")
+        # Only a 4xx about the request itself is a real answer; an open breaker skips straight to Vagalume.
+        # lyricsgenius raises a bare AssertionError for error statuses, so fall back to what the session saw
+        if call is not None and call.outcome == 'client_error':
+            return ""
+        status = status_of(e)
+        return "" if status is not None and 400 <= status < 500 and status != 429 else None
+    finally:
+        if started:
+            started.set()
+
+def fetch_lyrics_with_fallback(song_title, artist_name):
+    """fetch_lyrics_with_vagalume with the same return convention as fetch_lyrics_with_genius."""
+    try:
+        return fetch_lyrics_with_vagalume(song_title, artist_name) or ""
+    except UpstreamUnavailable as e:
+        print(f"[VAGALUME] Skipped: {e}")
+        return None
+
+def get_hedge_pool():
+    """Return the shared thread pool for hedged lyrics lookups, creating it on first use."""
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=LYRICS_HEDGE_WORKERS, thread_name_prefix='lyrics-hedge')
+        return _hedge_pool
+
+def lyrics_hedge_delay():
+    """Seconds to wait for Genius before also asking Vagalume: Genius's rolling latency percentile, clamped."""
+    delay = get_limiter('genius').latency_percentile(LYRICS_HEDGE_PERCENTILE)
+    if delay is None:
+        return LYRICS_HEDGE_DEFAULT_DELAY_SECONDS
+    return min(LYRICS_HEDGE_MAX_DELAY_SECONDS, max(LYRICS_HEDGE_MIN_DELAY_SECONDS, delay))
+
+def count_hedge(name):
+    with _hedge_pool_lock:
+        _hedge_counts[name] += 1
+
+def hedge_metrics():
+    """How many lyrics lookups were hedged and how often Vagalume answered first."""
+    with _hedge_pool_lock:
+        counts = dict(_hedge_counts)
+    return {**counts, 'delay_seconds': round(lyrics_hedge_delay(), 3)}
+
+def upstream_metrics():
+    """Limiter, circuit breaker, HTTP connection and lyrics hedging metrics of this process."""
+    return {
+        'limiters': limiter_metrics(),
+        'breakers': breaker_metrics(),
+        'http': http_clients.http_metrics(),
+        'lyrics_hedging': hedge_metrics()
+    }
+
+def hedged_lyrics_lookup(genius, song_title, artist_name):
+    """Ask Genius, and Vagalume too if Genius takes longer than lyrics_hedge_delay() once its limiter
+    let the call through; the first lyrics win.
+
+    The losing call is cancelled if it hasn't started yet; an HTTP request already in
+    flight can't be interrupted, so it finishes in the background and its answer is dropped.
+
+    Returns:
+        list: The answers received, in the convention of fetch_lyrics_with_genius
+    """
+    pool = get_hedge_pool()
+    count_hedge('lookups')
+    started = threading.Event()
+    primary = pool.submit(fetch_lyrics_with_genius, genius, song_title, artist_name, started)
+    # The delay starts once Genius is actually being asked: time spent waiting for a pool thread
+    # or the limiter is our own queueing, and hedging on it would add load while Genius is throttled
+    started.wait()
+    done, _ = wait([primary], timeout=lyrics_hedge_delay())
+    if done:
+        answer = primary.result()
+        # Genius answered in time; Vagalume is only the fallback, as without hedging
+        return [answer] if answer else [answer, fetch_lyrics_with_fallback(song_title, artist_name)]
+    
+    count_hedge('hedged')
+    print(f"Genius is slow for '{song_title}', asking Vagalume in parallel")
+    secondary = pool.submit(fetch_lyrics_with_fallback, song_title, artist_name)
+    pending = {primary, secondary}
+    answers = []
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            answer = future.result()
+            answers.append(answer)
+            if answer:
+                for loser in pending:
+                    loser.cancel()
+                if future is secondary:
+                    count_hedge('secondary_won')
+                return answers
+    return answers
 
 def extract_lyrics_faster(track, genius):
-    """Extract lyrics with faster approach - single attempt only."""
+    """Extract lyrics with faster approach - single attempt only.
+
+    Genius is tried first and Vagalume as the fallback; with LYRICS_HEDGE_ENABLED,
+    Vagalume is also asked as soon as Genius is slower than usual (see hedged_lyrics_lookup).
+
+    Returns:
+        str: The lyrics, "" if no source has them, or None if a source was down or throttled
+        (its breaker is open, it timed out or answered 429/5xx)
+    """
     try:
         if not genius:
             return ""
             
         print(f"Fetching lyrics for '{track['name']}' by '{track['artist']}'")
         
-        # First try a clean search
-        clean_title = track['name'].split('(')[0].strip().split('-')[0].strip()
+        clean_title = clean_track_title(track['name'])
         artist = track['artist']
         
-        try:
-            song = genius.search_song(clean_title, artist, get_full_info=False)
-            if song and song.lyrics:
-                return song.lyrics
-        except Exception as e:
-            print(f"Genius search failed: {e}")
-            
-        # If that fails, try Vagalume as fallback
-        lyrics = fetch_lyrics_with_vagalume(clean_title, artist)
-        if lyrics:
-            return lyrics
-            
-        # Return empty string as fallback so we still process the track
-        return ""
+        if LYRICS_HEDGE_ENABLED:
+            answers = hedged_lyrics_lookup(genius, clean_title, artist)
+        else:
+            answers = [fetch_lyrics_with_genius(genius, clean_title, artist)]
+            if not answers[0]:
+                answers.append(fetch_lyrics_with_fallback(clean_title, artist))
+        
+        for lyrics in answers:
+            if lyrics:
+                return lyrics
+        # Empty string means no source has lyrics, so we still process the track
+        return None if None in answers else ""
             
     except Exception as e:
         print(f"Error extracting lyrics: {e}")
         return ""
 
-def analyze_user_library(sp, session=None):
-    """Analyze a user's Spotify library in parallel."""
-    print("Starting library analysis...")
-    sys.stdout.flush()
+def parse_saved_tracks(items):
+    """Turn a page of saved-track items into the basic track dicts used by the pipeline."""
+    tracks = []
+    for item in items or []:
+        track = item.get('track')
+        if track and track.get('id'):
+            tracks.append({
+                'id': track['id'],
+                'name': track['name'],
+                'artist': track['artists'][0]['name'] if track['artists'] else "Unknown",
+                'uri': track['uri'],
+                'added_at': item.get('added_at')
+            })
+    return tracks
+
+def parse_spotify_timestamp(value):
+    """Parse a Spotify ISO 8601 timestamp (e.g. '2024-01-31T12:00:00Z'), returning None if invalid."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+def is_known_track(track, known_tracks):
+    """Whether a saved track is already stored from a previous analysis and hasn't been re-saved since."""
+    if not known_tracks or track['uri'] not in known_tracks:
+        return False
+    stored_added_at = known_tracks[track['uri']]
+    added_at = parse_spotify_timestamp(track.get('added_at'))
+    # Rows stored before added_at was tracked can't be compared, so trust them
+    if stored_added_at is None or added_at is None:
+        return True
+    return stored_added_at == added_at
+
+def prefetch_cached_data(tracks):
+    """Look up shared audio features, lyrics and preview URLs for a group of tracks."""
+    cached = {'features': {}, 'lyrics': {}, 'previews': {}}
+    if not tracks:
+        return cached
     
-    # Get the first 100 saved tracks from the user's library
-    print("Fetching user's saved tracks...")
+    # Audio features never change for a given song, so check the shared store first
+    # (only features extracted with this process's mode and window, so fast-mode values never pass as full-mode ones)
+    cached['features'] = get_track_audio_features([track['id'] for track in tracks], AUDIO_FEATURE_VERSION)
+    # Same for lyrics, including songs we already know have none
+    cached['lyrics'] = get_cached_lyrics(
+        list({lyrics_cache_key(track) for track in tracks}),
+        LYRICS_NOT_FOUND_TTL_SECONDS
+    )
+    # Preview URLs are only needed for tracks whose features still have to be extracted
+    cached['previews'] = get_cached_previews(
+        [track['id'] for track in tracks if track['id'] not in cached['features']],
+        ITUNES_PREVIEW_HIT_TTL_SECONDS,
+        ITUNES_PREVIEW_MISS_TTL_SECONDS
+    )
+    print(f"Cache hits for {len(tracks)} tracks: {len(cached['features'])} audio features, "
+          f"{len(cached['lyrics'])} lyrics, {len(cached['previews'])} iTunes previews")
     sys.stdout.flush()
-    results = sp.current_user_saved_tracks(limit=50)
+    return cached
+
+def fetch_library_page(sp, offset):
+    """Fetch one page of saved tracks and prefetch its cache entries (runs on the page fetch pool).
+
+    Returns:
+        tuple: (raw Spotify page, parsed tracks, cached data for those tracks)
+    """
+    page = sp.current_user_saved_tracks(limit=SAVED_TRACKS_PAGE_SIZE, offset=offset)
+    tracks = parse_saved_tracks(page.get('items') if page else [])
+    return page, tracks, prefetch_cached_data(tracks)
+
+def store_cached_data(processed_tracks):
+    """Write newly fetched features, lyrics and preview lookups back to the shared caches."""
+    # Write newly extracted features back so other users skip the download and analysis
+    new_features = {
+        track['id']: convert_numpy_to_python({key: track[key] for key in AUDIO_FEATURE_KEYS})
+        for track in processed_tracks
+        if track.get('feature_source') == 'itunes'
+    }
+    if new_features:
+        store_track_audio_features(new_features, AUDIO_FEATURE_VERSION)
+        print(f"Stored audio features for {len(new_features)} tracks in the shared cache")
+        sys.stdout.flush()
+    
+    new_lyrics = {
+        lyrics_cache_key(track): track.get('lyrics', '')
+        for track in processed_tracks
+        if track.get('lyrics_source') == 'fetched'
+    }
+    if new_lyrics:
+        store_cached_lyrics(new_lyrics)
+        print(f"Stored lyrics lookups for {len(new_lyrics)} tracks in the lyrics cache")
+        sys.stdout.flush()
     
-    if not results or 'items' not in results:
+    new_previews = {
+        track['id']: track.get('preview_url')
+        for track in processed_tracks
+        if track.get('preview_source') == 'fetched'
+    }
+    if new_previews:
+        store_cached_previews(new_previews)
+        print(f"Stored iTunes preview lookups for {len(new_previews)} tracks")
+        sys.stdout.flush()
+
+def apply_feature_batch(batch_tracks, job):
+    """Wait for a micro-batch feature extraction job and copy the features onto its tracks."""
+    try:
+        batch_features = job.result()
+    except Exception as e:
+        print(f"Error extracting audio features for a batch of {len(batch_tracks)} tracks: {e}")
+        sys.stdout.flush()
+        batch_features = [None] * len(batch_tracks)
+    for track, features in zip(batch_tracks, batch_features):
+        track.pop('pcm', None)
+        if features:
+            track.update(features)
+        track['feature_source'] = 'itunes' if features and any(features.values()) else 'none'
+
+def report_progress(progress, phase, **details):
+    """Pass pipeline progress to the optional progress(phase, **details) callback."""
+    if progress:
+        progress(phase, **details)
+
+def extract_library_tracks(sp, genius, resources, known_tracks=None, progress=None, on_tracks=None):
+    """PHASE 1: Fetch the whole saved-tracks library and extract lyrics and audio features.
+
+    The first page gives the library total; the remaining pages are fetched
+    concurrently (at most SPOTIFY_PAGE_WORKERS at a time) and each page's
+    tracks are submitted for analysis as soon as it arrives rather than after
+    the whole library has been listed. Tracks in known_tracks (URI -> added_at
+    from a previous analysis) are listed but not analyzed again.
+
+    Progress is reported as phase 'extracting' with the library total and
+    the number of tracks submitted and completed so far. If given,
+    on_tracks(tracks) is called with each group of tracks whose lyrics and
+    audio features are final, so they can be classified before the rest of
+    the library has been extracted.
+
+    Returns:
+        tuple: (processed tracks, set of every saved track URI or None if some pages failed to load)
+    """
+    first_page, first_tracks, first_cached = fetch_library_page(sp, 0)
+    if not first_page or 'items' not in first_page:
         print("No tracks found in user's library")
         sys.stdout.flush()
-        return {}, {}
-        
-    items = results['items']
-    tracks = []
+        return [], None
     
-    print(f"Processing {len(items)} tracks...")
+    total = first_page.get('total') or len(first_page['items'])
+    print(f"Library has {total} saved tracks, fetching {max(0, -(-total // SAVED_TRACKS_PAGE_SIZE) - 1)} more pages")
     sys.stdout.flush()
     
-    for item in items:
-        track = item['track']
-        if track and 'id' in track:
-            track_data = {
-                'id': track['id'],
-                'name': track['name'],
-                'artist': track['artists'][0]['name'] if track['artists'] else "Unknown",
-                'uri': track['uri']
+    processed_tracks = []
+    seen_ids = set()
+    library_uris = set()
+    listing_complete = True
+    skipped = 0
+    pending_batch = []
+    # Micro-batch feature jobs -> the tracks waiting on them
+    batch_jobs = {}
+    submitted = 0
+    completed = 0
+    
+    report_progress(progress, 'extracting', library_total=total, tracks_submitted=0, tracks_completed=0)
+    
+    with ThreadPoolExecutor(max_workers=SPOTIFY_PAGE_WORKERS) as page_executor, \
+         ThreadPoolExecutor(max_workers=resources['lyrics_workers']) as lyrics_executor, \
+         ThreadPoolExecutor(max_workers=resources['thread_workers']) as executor:
+        # lyrics_executor is entered first so it shuts down only after every track that submits to it
+        
+        def submit_tracks(tracks, cached):
+            nonlocal skipped
+            library_uris.update(track['uri'] for track in tracks)
+            # Saved tracks are unique, but pages can shift if the library changes mid-fetch
+            new_tracks = [track for track in tracks if track['id'] not in seen_ids]
+            seen_ids.update(track['id'] for track in new_tracks)
+            # Incremental mode: only tracks saved since the last analysis need work
+            unknown_tracks = [track for track in new_tracks if not is_known_track(track, known_tracks)]
+            skipped += len(new_tracks) - len(unknown_tracks)
+            new_tracks = unknown_tracks
+            return {
+                executor.submit(
+                    analyze_track, track, genius,
+                    cached['features'].get(track['id']),
+                    cached['lyrics'].get(lyrics_cache_key(track)),
+                    cached['previews'].get(track['id']),
+                    resources['audio_batch_size'] > 1,
+                    lyrics_executor
+                )
+                for track in new_tracks
             }
-            tracks.append(track_data)
+        
+        track_futures = submit_tracks(first_tracks, first_cached)
+        submitted += len(track_futures)
+        page_futures = {
+            page_executor.submit(fetch_library_page, sp, offset)
+            for offset in range(SAVED_TRACKS_PAGE_SIZE, total, SAVED_TRACKS_PAGE_SIZE)
+        }
+        
+        def submit_batch(batch_tracks):
+            job = submit_features_batch([t['pcm'] for t in batch_tracks])
+            batch_jobs[job] = batch_tracks
+            return job
+        
+        # Handle pages, tracks and feature batches in whatever order they finish
+        pending = page_futures | track_futures
+        batches_run = 0
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in batch_jobs:
+                    batch_tracks = batch_jobs.pop(future)
+                    apply_feature_batch(batch_tracks, future)
+                    batches_run += 1
+                    if on_tracks:
+                        on_tracks(batch_tracks)
+                    continue
+                if future in page_futures:
+                    try:
+                        _, tracks, cached = future.result()
+                        new_futures = submit_tracks(tracks, cached)
+                        submitted += len(new_futures)
+                        pending |= new_futures
+                    except Exception as e:
+                        listing_complete = False
+                        print(f"Error fetching a page of saved tracks: {e}")
+                        sys.stdout.flush()
+                    continue
+                
+                completed += 1
+                report_progress(progress, 'extracting', library_total=total, tracks_submitted=submitted, tracks_completed=completed)
+                try:
+                    result = future.result()
+                    if result:
+                        processed_tracks.append(result)
+                        print(f"Completed {completed}/{submitted} submitted tracks ({int(completed/submitted*100)}%)")
+                        sys.stdout.flush()
+                        if result.get('feature_source') == 'pending':
+                            pending_batch.append(result)
+                            if len(pending_batch) >= resources['audio_batch_size']:
+                                pending.add(submit_batch(pending_batch))
+                                pending_batch = []
+                        elif on_tracks:
+                            on_tracks([result])
+                except Exception as e:
+                    print(f"Error processing track: {e}")
+                    sys.stdout.flush()
+            # Once only feature batches are left, the last partial batch won't fill up any more
+            if pending_batch and all(future in batch_jobs for future in pending):
+                pending.add(submit_batch(pending_batch))
+                pending_batch = []
     
-    if not tracks:
-        print("No valid track data found")
+    if batches_run:
+        print(f"Extracted audio features in {batches_run} micro-batches")
         sys.stdout.flush()
-        return {}, {}
-        
-    print(f"Extracted basic info for {len(tracks)} tracks")
+    store_cached_data(processed_tracks)
+    if known_tracks:
+        print(f"Incremental analysis: skipped {skipped} already analyzed tracks, analyzed {len(processed_tracks)} new ones")
+        sys.stdout.flush()
+    return processed_tracks, (library_uris if listing_complete else None)
+
+def analyze_user_library(sp, session=None, progress=None, on_classified=None):
+    """Analyze a user's Spotify library in parallel."""
+    analyzed_tracks, mood_uris, _ = run_library_analysis(sp, progress=progress, on_classified=on_classified)
+    return analyzed_tracks, mood_uris
+
+def analyze_library_changes(sp, known_tracks, progress=None, on_classified=None):
+    """Incrementally analyze a user's library against what a previous analysis stored.
+
+    Args:
+        known_tracks (dict): Track URI -> added_at for the tracks already stored for this user
+
+    Returns:
+        tuple: (analyzed new tracks, mood_uris for the new tracks, URIs no longer saved).
+        Removed URIs are empty if the library listing was incomplete, so nothing gets
+        deleted because of a failed page fetch.
+    """
+    analyzed_tracks, mood_uris, library_uris = run_library_analysis(sp, known_tracks, progress, on_classified)
+    if library_uris is None:
+        print("Library listing was incomplete, not removing any stored tracks")
+        sys.stdout.flush()
+        return analyzed_tracks, mood_uris, set()
+    removed_uris = set(known_tracks) - library_uris
+    print(f"Incremental analysis: {len(analyzed_tracks)} new tracks classified, {len(removed_uris)} tracks removed")
+    sys.stdout.flush()
+    return analyzed_tracks, mood_uris, removed_uris
+
+def format_analyzed_tracks(tracks, mood_data, classification_sources):
+    """Streamlined track objects with their moods, for storage and the API response; tracks without moods are left out."""
+    analyzed_tracks = []
+    for track in tracks:
+        track_id = str(track.get('id'))
+        track_moods = mood_data.get(track_id)
+        if track_moods:
+            analyzed_tracks.append({
+                'id': track['id'],
+                'name': track['name'],
+                'artist': track['artist'],
+                'uri': track['uri'],
+                'added_at': track.get('added_at'),
+                'moods': track_moods,
+                'classification_source': classification_sources.get(track_id)
+            })
+    return analyzed_tracks
+
+class StreamingClassification:
+    """Classifies tracks in batches while extraction is still running.
+
+    Extracted tracks are buffered and sent to classify_tracks once
+    STREAM_CLASSIFY_BATCH_SIZE have arrived. While no batch is being classified,
+    smaller batches go out early: the first track on its own, so the first moods
+    are ready within seconds, then batches doubling in size up to
+    STREAM_CLASSIFY_BATCH_SIZE, so a slow extraction doesn't turn into one LLM
+    request per track. Each classified batch is passed to
+    on_classified(analyzed_tracks), one call at a time, before tracks_with_moods
+    is reported, so progress never counts tracks that aren't stored yet.
+    """
+    def __init__(self, on_classified, progress=None):
+        self.on_classified = on_classified
+        self.progress = progress
+        self.buffer = []
+        self.min_batch_size = 1
+        self.futures = []
+        self.analyzed_tracks = []
+        self.tracks_classified = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=STREAM_CLASSIFY_WORKERS)
+
+    def add(self, tracks):
+        self.buffer.extend(tracks)
+        idle = all(future.done() for future in self.futures)
+        if len(self.buffer) >= STREAM_CLASSIFY_BATCH_SIZE or (idle and len(self.buffer) >= self.min_batch_size):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.futures.append(self.executor.submit(self._classify, self.buffer))
+            self.buffer = []
+            self.min_batch_size = min(self.min_batch_size * 2, STREAM_CLASSIFY_BATCH_SIZE)
+
+    def _classify(self, tracks):
+        mood_data, classification_sources = classify_tracks(tracks)
+        analyzed_tracks = format_analyzed_tracks(tracks, mood_data, classification_sources)
+        with self.lock:
+            self.analyzed_tracks.extend(analyzed_tracks)
+            self.tracks_classified += len(tracks)
+            if analyzed_tracks:
+                self.on_classified(analyzed_tracks)
+            report_progress(self.progress, 'classifying', tracks_classified=self.tracks_classified, tracks_with_moods=len(self.analyzed_tracks))
+
+    def finish(self):
+        """Classify whatever is still buffered and wait for every batch; returns all analyzed tracks."""
+        self.flush()
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error classifying a streamed batch: {e}")
+                sys.stdout.flush()
+        return self.analyzed_tracks
+
+def run_library_analysis(sp, known_tracks=None, progress=None, on_classified=None):
+    """Run the full analysis pipeline, skipping tracks in known_tracks.
+
+    With on_classified, tracks are classified in batches as soon as they are
+    extracted (see StreamingClassification) and each classified batch is passed
+    to on_classified(analyzed_tracks) before the rest of the library is done.
+
+    Returns:
+        tuple: (analyzed tracks, mood_uris, set of saved track URIs or None if the listing was incomplete)
+    """
+    print("Starting library analysis...")
     sys.stdout.flush()
     
     # Get a Genius client for lyrics fetching
@@ -419,46 +1125,30 @@ def analyze_user_library(sp, session=None):
     resources = {
         'cpu_count': os.cpu_count() or 2,
         # Use maximum threads for speed since we've configured the connection pool properly
-        'thread_workers': min(32, max(4, (os.cpu_count() or 2) * 2))
+        'thread_workers': min(32, max(4, (os.cpu_count() or 2) * 2)),
+        # librosa DSP runs in a separate process pool so it isn't serialized by the GIL
+        'process_workers': AUDIO_PROCESS_WORKERS,
+        # Decoded previews are grouped into micro-batches for vectorized fast-mode extraction
+        'audio_batch_size': AUDIO_BATCH_SIZE if AUDIO_FEATURE_MODE == 'fast' else 1
     }
     
-    print(f"System resources: {resources['cpu_count']} CPUs, thread workers: {resources['thread_workers']}")
+    # Lyrics lookups run on their own threads alongside each track's preview download
+    resources['lyrics_workers'] = resources['thread_workers']
+    
+    print(f"System resources: {resources['cpu_count']} CPUs, thread workers: {resources['thread_workers']}, process workers: {resources['process_workers']}")
     sys.stdout.flush()
     
-    # Process tracks in parallel with ThreadPoolExecutor
-    processed_tracks = []
     start_time = time.time()
+    streaming = StreamingClassification(on_classified, progress) if on_classified else None
     
-    # Create batches of tracks for better load balancing
-    batch_size = max(1, min(10, len(tracks) // resources['thread_workers']))
-    batches = [tracks[i:i+batch_size] for i in range(0, len(tracks), batch_size)]
-    print(f"Processing {len(batches)} batches of ~{batch_size} tracks each")
-    sys.stdout.flush()
-    
-    # PHASE 1: Extract all lyrics and audio features in parallel
+    # PHASE 1: Fetch the library and extract all lyrics and audio features in parallel
     print("\n=== PHASE 1: Extracting lyrics and audio features ===")
     sys.stdout.flush()
-    with ThreadPoolExecutor(max_workers=resources['thread_workers']) as executor:
-        # Submit all tracks for parallel processing
-        futures = []
-        for track in tracks:
-            future = executor.submit(analyze_track, track, genius)
-            futures.append(future)
-            
-        # Process results as they complete
-        total = len(futures)
-        completed = 0
-        for future in as_completed(futures):
-            completed += 1
-            try:
-                result = future.result()
-                if result:
-                    processed_tracks.append(result)
-                    print(f"Completed {completed}/{total} tracks ({int(completed/total*100)}%)")
-                    sys.stdout.flush()
-            except Exception as e:
-                print(f"Error processing track: {e}")
-                sys.stdout.flush()
+    print("Fetching user's saved tracks...")
+    sys.stdout.flush()
+    processed_tracks, library_uris = extract_library_tracks(
+        sp, genius, resources, known_tracks, progress, streaming.add if streaming else None
+    )
     
     elapsed = time.time() - start_time
     print(f"Completed extraction in {elapsed:.2f} seconds")
@@ -466,75 +1156,44 @@ def analyze_user_library(sp, session=None):
     
     # Ensure we have tracks to analyze
     if not processed_tracks:
-        print("No tracks were successfully processed")
+        print("No new tracks to analyze" if known_tracks else "No tracks were successfully processed")
         sys.stdout.flush()
-        return [], {}
+        if streaming:
+            streaming.finish()
+        return [], {}, library_uris
         
     print(f"Successfully processed {len(processed_tracks)} tracks")
     sys.stdout.flush()
     
-    # PHASE 2: Classify songs by mood using ChatGPT (after all tracks are processed)
-    print("\n=== PHASE 2: Classifying songs by mood with ChatGPT ===")
-    sys.stdout.flush()
-    
-    # Initialize the OpenAI client if not already done - only once all tracks are processed
-    if not openai_client:
-        print("Initializing OpenAI client for mood classification...")
+    if streaming:
+        # PHASE 2 already started during extraction; wait for the last batches
+        print("\n=== PHASE 2: Finishing streamed mood classification ===")
         sys.stdout.flush()
-        initialize_openai_client()
-    
-    # Analyze all tracks at once
-    mood_data = analyze_with_chatgpt(processed_tracks, training_data)
-    
-    # Check if all tracks were classified
-    track_ids = [str(track['id']) for track in processed_tracks]
-    missing_track_ids = set(track_ids) - set(mood_data.keys())
-    
-    # If some tracks weren't classified, try again with just those tracks
-    if missing_track_ids and len(missing_track_ids) < len(track_ids):
-        print(f"\n{len(missing_track_ids)} tracks weren't classified. Making a second attempt for these tracks...")
+        analyzed_tracks = streaming.finish()
+    else:
+        # PHASE 2: Classify songs by mood using ChatGPT (after all tracks are processed)
+        print("\n=== PHASE 2: Classifying songs by mood with ChatGPT ===")
         sys.stdout.flush()
-        missing_tracks = [t for t in processed_tracks if str(t['id']) in missing_track_ids]
-        second_attempt = analyze_with_chatgpt(missing_tracks, training_data)
-        
-        # Merge the results
-        for track_id, moods in second_attempt.items():
-            if track_id not in mood_data:
-                mood_data[track_id] = moods
-                print(f"Second attempt classified track {track_id} as {moods}")
-                sys.stdout.flush()
+        report_progress(progress, 'classifying', tracks=len(processed_tracks))
+        mood_data, classification_sources = classify_tracks(processed_tracks)
+        # Format the results for storage and API response
+        analyzed_tracks = format_analyzed_tracks(processed_tracks, mood_data, classification_sources)
     
-    # Format the results for storage and API response
-    analyzed_tracks = []
+    # Group tracks by mood for easy retrieval (prevent duplicates using set)
     mood_uris = {}
-    
-    # Process the mood classification results
-    for track_id, track_moods in mood_data.items():
-        # Find the matching track object
-        track_obj = next((t for t in processed_tracks if str(t['id']) == str(track_id)), None)
-        
-        if track_obj and track_moods:
-            # Create a streamlined track object with moods
-            track_with_moods = {
-                'id': track_obj['id'],
-                'name': track_obj['name'],
-                'artist': track_obj['artist'],
-                'uri': track_obj['uri'],
-                'moods': track_moods
-            }
-            analyzed_tracks.append(track_with_moods)
-            
-            # Group tracks by mood for easy retrieval (prevent duplicates using set)
-            for mood in track_moods:
-                if mood not in mood_uris:
-                    mood_uris[mood] = set()  # Use set to prevent duplicates
-                mood_uris[mood].add(track_obj['uri'])  # Add to set instead of append
+    for track in analyzed_tracks:
+        for mood in track['moods']:
+            mood_uris.setdefault(mood, set()).add(track['uri'])
     
     # Convert sets back to lists for JSON serialization
     for mood in mood_uris:
         mood_uris[mood] = list(mood_uris[mood])
     
     print(f"Final organization: {len(analyzed_tracks)} tracks grouped into {len(mood_uris)} moods")
+    print(f"Upstream limiters: {json.dumps(limiter_metrics())}")
+    print(f"Upstream circuit breakers: {json.dumps(breaker_metrics())}")
+    print(f"Upstream HTTP connections: {json.dumps(http_clients.http_metrics())}")
+    print(f"Hedged lyrics lookups: {json.dumps(hedge_metrics())}")
     sys.stdout.flush()
     
     # Log simplified mood distribution as a dictionary/JSON object
@@ -546,12 +1205,9 @@ def analyze_user_library(sp, session=None):
         # Also log which tracks are in each mood for verification
         print("\n=== DETAILED MOOD BREAKDOWN ===")
         sys.stdout.flush()
+        tracks_by_uri = {t['uri']: t for t in analyzed_tracks}
         for mood, uris in mood_uris.items():
-            track_names = []
-            for uri in uris:
-                track_obj = next((t for t in analyzed_tracks if t['uri'] == uri), None)
-                if track_obj:
-                    track_names.append(f"{track_obj['name']} by {track_obj['artist']}")
+            track_names = [f"{tracks_by_uri[uri]['name']} by {tracks_by_uri[uri]['artist']}" for uri in uris if uri in tracks_by_uri]
             print(f"{mood}: {len(uris)} tracks")
             sys.stdout.flush()
             for name in track_names:
@@ -564,7 +1220,7 @@ def analyze_user_library(sp, session=None):
         sys.stdout.flush()
     
     # Return both processed tracks and mood data
-    return analyzed_tracks, mood_uris
+    return analyzed_tracks, mood_uris, library_uris
 
 def convert_numpy_to_python(obj):
     """Convert NumPy datatypes to Python native types for JSON serialization"""
@@ -580,116 +1236,137 @@ def convert_numpy_to_python(obj):
         return [convert_numpy_to_python(item) for item in obj]
     return obj
 
-def analyze_with_chatgpt(tracks, training_data):
-    """Send tracks to ChatGPT for mood analysis with improved diversity"""
-    try:
-        print(f"Analyzing {len(tracks)} tracks with ChatGPT")
-        sys.stdout.flush()
-        
-        # Ensure OpenAI client is initialized
-        if not openai_client:
-            print("OpenAI client not initialized, initializing now...")
-            sys.stdout.flush()
-            initialize_openai_client()
-            
-        # Check if client was properly initialized
-        if not openai_client:
-            print("Error: OpenAI client not initialized")
-            sys.stdout.flush()
-            return {}
-        else:
-            print(f"Using OpenAI client: {type(openai_client).__name__}")
-            sys.stdout.flush()
-            
-        # Select random examples for more diverse training
-        training_examples = random.sample(training_data, min(5, len(training_data)))
-        print(f"Selected {len(training_examples)} random training examples")
-        sys.stdout.flush()
-        
-        # Prepare example data from training data for few-shot learning
-        examples = []
-        for i, example in enumerate(training_examples):
-            examples.append({
-                "id": f"example_{i}",
-                "name": example.get('song', 'Unknown Song'),
-                "artist": example.get('artist', 'Unknown Artist'),
-                "lyrics": example.get('lyrics', ''),
-                "audio_features": {
-                    "tempo": float(example.get('tempo', 0)),
-                    "energy": float(example.get('energy', 0)),
-                    "brightness": float(example.get('brightness', 0)),
-                    "zcr": float(example.get('zcr', 0)),
-                    "contrast": float(example.get('contrast', 0)),
-                    "chroma": float(example.get('chroma', 0)),
-                    "flatness": float(example.get('flatness', 0)),
-                    "rolloff": float(example.get('rolloff', 0)),
-                    "mfcc1": float(example.get('mfcc1', 0)),
-                    "mfcc2": float(example.get('mfcc2', 0)),
-                    "mfcc3": float(example.get('mfcc3', 0)),
-                    "mfcc4": float(example.get('mfcc4', 0)),
-                    "mfcc5": float(example.get('mfcc5', 0))
-                },
-                "moods": example.get('moods', [])
-            })
-        
-        # Prepare tracks data for analysis
-        tracks_data = []
-        track_ids = []  # Keep track of IDs to ensure all tracks are processed
-        
-        for track in tracks:
-            # Don't skip tracks missing data - we want to analyze as many as possible
-            if not track.get('id'):
-                continue  # Only skip if ID is missing
-                
-            track_ids.append(str(track['id']))
-                
-            # Create a complete dictionary with all fields
-            track_data = {
-                "id": track['id'],
-                "name": track.get('name', 'Unknown'),
-                "artist": track.get('artist', 'Unknown'),
-                "uri": track.get('uri', ''),
-                "lyrics": track.get('lyrics', ''),
-                "audio_features": {
-                    "tempo": track.get('tempo', 0),
-                    "energy": track.get('energy', 0),
-                    "brightness": track.get('brightness', 0),
-                    "zcr": track.get('zcr', 0),
-                    "contrast": track.get('contrast', 0),
-                    "chroma": track.get('chroma', 0),
-                    "flatness": track.get('flatness', 0),
-                    "rolloff": track.get('rolloff', 0),
-                    "mfcc1": track.get('mfcc1', 0),
-                    "mfcc2": track.get('mfcc2', 0),
-                    "mfcc3": track.get('mfcc3', 0),
-                    "mfcc4": track.get('mfcc4', 0),
-                    "mfcc5": track.get('mfcc5', 0)
-                }
-            }
-            tracks_data.append(track_data)
-            
-        if not tracks_data:
-            print("No valid tracks to analyze")
-            return {}
-            
-        # Convert NumPy arrays to Python native types for JSON serialization
-        tracks_data = convert_numpy_to_python(tracks_data)
-        examples = convert_numpy_to_python(examples)
+def estimate_tokens(text):
+    """Rough token count for budgeting prompts (~4 characters per token for English/JSON)."""
+    return len(text) // 4 + 1
+
+def build_training_examples(training_data):
+    """Pick random few-shot examples from the training data for a classification request."""
+    # Select random examples for more diverse training
+    training_examples = random.sample(training_data, min(5, len(training_data)))
+    print(f"Selected {len(training_examples)} random training examples")
+    sys.stdout.flush()
+    
+    # Prepare example data from training data for few-shot learning
+    examples = []
+    for i, example in enumerate(training_examples):
+        examples.append({
+            "id": f"example_{i}",
+            "name": example.get('song', 'Unknown Song'),
+            "artist": example.get('artist', 'Unknown Artist'),
+            "lyrics": example.get('lyrics', ''),
+            "audio_features": {key: float(example.get(key, 0)) for key in AUDIO_FEATURE_KEYS},
+            "moods": example.get('moods', [])
+        })
+    return convert_numpy_to_python(examples)
+
+def build_track_data(track):
+    """Build the per-track entry sent to the classifier."""
+    return convert_numpy_to_python({
+        "id": track['id'],
+        "name": track.get('name', 'Unknown'),
+        "artist": track.get('artist', 'Unknown'),
+        "uri": track.get('uri', ''),
+        "lyrics": track.get('lyrics', ''),
+        "audio_features": {key: track.get(key, 0) for key in AUDIO_FEATURE_KEYS}
+    })
+
+def compact_lyrics(lyrics, token_budget=None):
+    """Drop section markers and repeated lines, then cut the lyrics to roughly token_budget tokens.
 
-        # Use the complete set of moods including mysterious and mad
-        mood_list = ["happy", "sad", "energetic", "calm", "mad", "romantic", "mysterious", "focused"]
+    Choruses repeat several times in most songs, so keeping only the first
+    occurrence of each line preserves nearly all of the mood signal.
+    """
+    if not lyrics:
+        return ''
+    if token_budget is None:
+        token_budget = LYRICS_EXCERPT_TOKEN_BUDGET
+    char_budget = token_budget * 4
+    
+    seen = set()
+    kept = []
+    length = 0
+    for line in lyrics.splitlines():
+        line = ' '.join(line.split())
+        key = line.lower()
+        if not line or LYRIC_SECTION_PATTERN.match(line) or key in seen:
+            continue
+        seen.add(key)
+        if length + len(line) > char_budget:
+            if not kept:
+                kept.append(line[:char_budget])
+            break
+        kept.append(line)
+        length += len(line) + 3
+    return ' / '.join(kept)
+
+def quantize_features(features):
+    """Round audio features to AUDIO_FEATURE_SIGNIFICANT_DIGITS significant digits."""
+    quantized = {}
+    for key, value in features.items():
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            quantized[key] = value
+            continue
+        rounded = float(f"{value:.{AUDIO_FEATURE_SIGNIFICANT_DIGITS}g}")
+        quantized[key] = int(rounded) if rounded.is_integer() else rounded
+    return quantized
+
+def compact_entry(entry, alias):
+    """Compact one example/track entry for the prompt, replacing its ID with alias."""
+    compacted = {
+        "id": alias,
+        "name": entry.get('name', 'Unknown'),
+        "artist": entry.get('artist', 'Unknown'),
+        "lyrics": compact_lyrics(entry.get('lyrics', '')),
+        "audio_features": quantize_features(entry.get('audio_features', {}))
+    }
+    if 'moods' in entry:
+        compacted['moods'] = entry['moods']
+    return compacted
 
-        prompt = f"""You are an expert music mood classifier with deep knowledge of emotional qualities in music across all genres.
+def compact_examples(examples):
+    """Compact the few-shot examples (aliased e0, e1, ... so they never collide with track aliases)."""
+    return [compact_entry(example, f"e{i}") for i, example in enumerate(examples)]
+
+def compact_tracks(tracks_data):
+    """Compact a chunk of tracks, aliasing Spotify IDs to 1, 2, 3, ...
+
+    Returns (compacted tracks, {alias: Spotify ID}) so responses can be translated back.
+    """
+    compacted = []
+    aliases = {}
+    for i, track_data in enumerate(tracks_data, start=1):
+        aliases[str(i)] = str(track_data['id'])
+        compacted.append(compact_entry(track_data, i))
+    return compacted, aliases
+
+def dump_prompt_json(data, compact=None):
+    """Serialize prompt data, minified when compaction is enabled."""
+    if compact is None:
+        compact = PROMPT_COMPACTION
+    if compact:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    return json.dumps(data, indent=2)
+
+def build_classification_prompt(examples, tracks_data, compact=None):
+    """Build the user prompt asking the model to classify tracks_data, with examples as few-shot data."""
+    if compact is None:
+        compact = PROMPT_COMPACTION
+    mood_list = MOOD_LIST
+    id_labels = ["1", "2", "3"] if compact else ["spotify_id_1", "spotify_id_2", "spotify_id_3"]
+    return f"""You are an expert music mood classifier with deep knowledge of emotional qualities in music across all genres.
 Your task is to analyze songs based on audio features, lyrics, artist name, and song title, and assign the most appropriate mood(s) to each song.
 
 Here are some example songs with their features and corresponding moods:
 ```json
-{json.dumps(examples, indent=2)}
+{dump_prompt_json(examples, compact)}
 ```
 
 Now, analyze these songs and assign the most appropriate moods to each:
 ```json
-{json.dumps(tracks_data, indent=2)}
+{dump_prompt_json(tracks_data, compact)}
 ```
 
 For each song, assign one or more moods from this SPECIFIC list ONLY: {", ".join(mood_list)}
@@ -729,100 +1406,306 @@ IMPORTANT CLASSIFICATION GUIDELINES:
 Return your analysis as a JSON object with song IDs as keys and arrays of moods as values:
 ```json
 {{
-  "spotify_id_1": ["happy", "energetic"],
-  "spotify_id_2": ["mysterious", "calm"],
-  "spotify_id_3": ["mad", "energetic"]
+  "{id_labels[0]}": ["happy", "energetic"],
+  "{id_labels[1]}": ["mysterious", "calm"],
+  "{id_labels[2]}": ["mad", "energetic"]
 }}
 ```
 CRITICAL: Your response MUST include ALL song IDs that were provided in the input. Do not skip any songs.
 """
 
-        # Call ChatGPT API with proper response format
-        print("Sending request to OpenAI API...")
+def chunk_tracks_by_token_budget(tracks_data, examples):
+    """Split tracks into chunks whose prompts fit LLM_CHUNK_TOKEN_BUDGET.
+
+    The fixed part of the prompt (instructions plus few-shot examples) is
+    measured once and each track is charged its own serialized size, so a
+    chunk of lyric-heavy songs holds fewer tracks than one of instrumentals.
+    Chunks are also capped at LLM_MAX_TRACKS_PER_CHUNK to keep responses short.
+    """
+    prompt_examples = compact_examples(examples) if PROMPT_COMPACTION else examples
+    base_tokens = estimate_tokens(build_classification_prompt(prompt_examples, []))
+    track_budget = max(1, LLM_CHUNK_TOKEN_BUDGET - base_tokens)
+    
+    chunks = []
+    current = []
+    current_tokens = 0
+    for track_data in tracks_data:
+        # Estimate on the layout actually sent (compacted entries are far smaller than raw ones)
+        entry = compact_entry(track_data, len(current) + 1) if PROMPT_COMPACTION else track_data
+        track_tokens = estimate_tokens(dump_prompt_json(entry))
+        if current and (current_tokens + track_tokens > track_budget or len(current) >= LLM_MAX_TRACKS_PER_CHUNK):
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(track_data)
+        current_tokens += track_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def parse_classification_response(content, aliases=None):
+    """Parse the model's JSON response into {track_id: [valid moods]}. Raises ValueError if unusable.
+
+    When aliases ({alias: Spotify ID}) is given, keys are translated back and unknown aliases are dropped.
+    """
+    if content is None:
+        raise ValueError("Got None response from OpenAI")
+    
+    moods_by_track = json.loads(content)
+    # Ensure moods_by_track is a dictionary
+    if not isinstance(moods_by_track, dict):
+        raise ValueError(f"Expected dict response but got {type(moods_by_track)}")
+    
+    # Create a result dictionary with proper string keys and validated moods
+    result = {}
+    for track_id, moods in moods_by_track.items():
+        # Validate moods are from the allowed list
+        valid_moods = []
+        if isinstance(moods, list):
+            for mood in moods:
+                if isinstance(mood, str) and mood.lower() in MOOD_LIST:
+                    valid_moods.append(mood.lower())
+        track_id = str(track_id)
+        if aliases is not None:
+            track_id = aliases.get(track_id)
+            if track_id is None:
+                continue
+        # Store valid moods (or empty list if none were valid)
+        result[track_id] = valid_moods
+    return result
+
+def classify_chunk(tracks_data, examples):
+    """Send one chunk of tracks to ChatGPT and return its parsed {track_id: moods} map."""
+    aliases = None
+    if PROMPT_COMPACTION:
+        raw_tokens = estimate_tokens(build_classification_prompt(examples, tracks_data, compact=False))
+        prompt_tracks, aliases = compact_tracks(tracks_data)
+        prompt = build_classification_prompt(compact_examples(examples), prompt_tracks)
+        prompt_tokens = estimate_tokens(prompt)
+        print(f"Compacted prompt for {len(tracks_data)} tracks: ~{raw_tokens} -> ~{prompt_tokens} tokens "
+              f"({1 - prompt_tokens / raw_tokens:.0%} smaller)")
         sys.stdout.flush()
-        start_time = time.time()
+    else:
+        prompt = build_classification_prompt(examples, tracks_data)
+    start_time = time.time()
+    # A 429 from OpenAI (openai.RateLimitError) halves the 'openai' window and pauses it for Retry-After
+    with limited('openai'):
         completion = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
+            model=LLM_MODEL,
             messages=[
                 {"role": "system", "content": "You are an expert music mood classifier. You MUST classify EVERY song with at least one mood from the specified list ONLY. You MUST give EQUAL consideration to ALL possible moods including 'mad' and 'mysterious'. Every single song in the input MUST be included in your output with at least one mood. Make your best educated guess for each song based on all available information."},
                 {"role": "user", "content": prompt}
             ],
             response_format={"type": "json_object"}  
         )
-        elapsed = time.time() - start_time
-        print(f"OpenAI API response received in {elapsed:.2f} seconds")
+    elapsed = time.time() - start_time
+    print(f"OpenAI API response for {len(tracks_data)} tracks (~{estimate_tokens(prompt)} prompt tokens) received in {elapsed:.2f} seconds")
+    sys.stdout.flush()
+    return parse_classification_response(completion.choices[0].message.content, aliases)
+
+def classify_locally(tracks):
+    """Label tracks whose Naive Bayes top-mood posterior clears LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD.
+
+    Returns:
+        tuple: ({track_id: moods} for confident tracks, list of tracks left for the LLM)
+    """
+    local_classifier = get_local_classifier()
+    if local_classifier is None:
+        return {}, list(tracks)
+    
+    # Score every track in one sparse matrix product
+    counts = local_classifier.vectorize([track.get('lyrics') or '' for track in tracks])
+    known_tokens = np.asarray(counts.sum(axis=1)).ravel()
+    probs = local_classifier.posteriors(counts)
+    
+    mood_data = {}
+    remaining = []
+    for track, track_tokens, track_probs in zip(tracks, known_tokens, probs):
+        if track_tokens < LOCAL_CLASSIFIER_MIN_TOKENS or track_probs.max() < LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD:
+            remaining.append(track)
+            continue
+        mood_data[str(track['id'])] = [
+            mood for mood, prob in zip(local_classifier.moods, track_probs) if prob >= LOCAL_CLASSIFIER_MOOD_THRESHOLD
+        ]
+    return mood_data, remaining
+
+def has_audio_features(track):
+    """Whether features were actually extracted for the track (failed extractions are all zeros)."""
+    return any(track.get(key) for key in AUDIO_FEATURE_KEYS)
+
+def classify_with_knn(tracks):
+    """Label tracks that have audio features by k-NN vote over the training songs.
+
+    Returns:
+        dict: Mapping of track ID to its list of moods; tracks without features are omitted
+    """
+    knn_classifier = get_knn_classifier()
+    tracks = [track for track in tracks if has_audio_features(track)]
+    if knn_classifier is None or not tracks:
+        return {}
+    features = np.array([[float(track.get(key) or 0) for key in AUDIO_FEATURE_KEYS] for track in tracks])
+    predictions = knn_classifier.predict_batch(features, KNN_MOOD_THRESHOLD)
+    return {str(track['id']): moods for track, moods in zip(tracks, predictions)}
+
+def classify_tracks(tracks):
+    """Classify tracks by mood, reusing classifications shared across users.
+
+    Cached classifications for the current LLM_MODEL and CLASSIFICATION_PROMPT_VERSION
+    are used first, then the local Naive Bayes classifier labels confident tracks and
+    the audio-feature k-NN labels tracks without lyrics; only the rest are sent to
+    ChatGPT. LLM results are cached, and tracks the LLM could not classify (e.g. when
+    OpenAI is unavailable) fall back to k-NN.
+
+    Returns:
+        tuple: ({track_id: moods}, {track_id: 'cache' | 'local' | 'knn' | 'llm'})
+    """
+    track_ids = [str(track['id']) for track in tracks if track.get('id')]
+    mood_data = get_cached_classifications(track_ids, LLM_MODEL, CLASSIFICATION_PROMPT_VERSION)
+    sources = {track_id: 'cache' for track_id in mood_data}
+    uncached_tracks = [track for track in tracks if track.get('id') and str(track['id']) not in mood_data]
+    
+    local_mood_data, uncached_tracks = classify_locally(uncached_tracks)
+    mood_data.update(local_mood_data)
+    sources.update({track_id: 'local' for track_id in local_mood_data})
+    
+    knn_mood_data = {}
+    if KNN_FOR_TRACKS_WITHOUT_LYRICS:
+        knn_mood_data = classify_with_knn([track for track in uncached_tracks if not track.get('lyrics')])
+        uncached_tracks = [track for track in uncached_tracks if str(track['id']) not in knn_mood_data]
+        mood_data.update(knn_mood_data)
+        sources.update({track_id: 'knn' for track_id in knn_mood_data})
+    
+    print(f"Classification split: {len(sources) - len(local_mood_data) - len(knn_mood_data)} cached, "
+          f"{len(local_mood_data)} local, {len(knn_mood_data)} k-NN, {len(uncached_tracks)} to LLM "
+          f"(model {LLM_MODEL}, prompt v{CLASSIFICATION_PROMPT_VERSION})")
+    sys.stdout.flush()
+    
+    if not uncached_tracks:
+        return mood_data, sources
+    
+    # Initialize the OpenAI client if not already done - only once all tracks are processed
+    if not openai_client:
+        print("Initializing OpenAI client for mood classification...")
+        sys.stdout.flush()
+        initialize_openai_client()
+    
+    new_mood_data = analyze_with_chatgpt(uncached_tracks, get_training_data())
+    # Empty classifications are retried on the next analysis rather than cached
+    store_cached_classifications(
+        {track_id: moods for track_id, moods in new_mood_data.items() if moods},
+        LLM_MODEL, CLASSIFICATION_PROMPT_VERSION
+    )
+    if SELF_TRAINING_ENABLED:
+        store_training_examples([
+            {
+                'track_id': str(track['id']),
+                'lyrics': track.get('lyrics') or '',
+                'features': {key: float(track.get(key) or 0) for key in AUDIO_FEATURE_KEYS} if has_audio_features(track) else None,
+                'moods': new_mood_data[str(track['id'])]
+            }
+            for track in uncached_tracks if new_mood_data.get(str(track['id']))
+        ], LLM_MODEL, CLASSIFICATION_PROMPT_VERSION)
+    mood_data.update(new_mood_data)
+    sources.update({track_id: 'llm' for track_id in new_mood_data})
+    
+    unclassified = [track for track in uncached_tracks if not new_mood_data.get(str(track['id']))]
+    fallback_mood_data = classify_with_knn(unclassified)
+    if fallback_mood_data:
+        print(f"k-NN fallback labeled {len(fallback_mood_data)} of {len(unclassified)} tracks the LLM left unclassified")
+        sys.stdout.flush()
+    mood_data.update(fallback_mood_data)
+    sources.update({track_id: 'knn' for track_id in fallback_mood_data})
+    return mood_data, sources
+
+def analyze_with_chatgpt(tracks, training_data):
+    """Send tracks to ChatGPT for mood analysis with improved diversity.
+
+    Tracks are split into token-budgeted chunks that are classified
+    concurrently (at most LLM_MAX_IN_FLIGHT requests at once). Chunks that
+    fail, and tracks a chunk's response left out or gave no valid mood, are
+    re-chunked and retried up to LLM_CHUNK_RETRIES times; everything else is
+    kept from the first pass. Tracks still without moods are left out of the result.
+    """
+    try:
+        print(f"Analyzing {len(tracks)} tracks with ChatGPT")
         sys.stdout.flush()
         
-        # Parse response directly as JSON
-        content = completion.choices[0].message.content
-        if content is None:
-            print("Error: Got None response from OpenAI")
+        # Ensure OpenAI client is initialized
+        if not openai_client:
+            print("OpenAI client not initialized, initializing now...")
             sys.stdout.flush()
-            return {}
+            initialize_openai_client()
             
-        try:
-            print("Parsing OpenAI response as JSON...")
+        # Check if client was properly initialized
+        if not openai_client:
+            print("Error: OpenAI client not initialized")
             sys.stdout.flush()
-            moods_by_track = json.loads(content)
-            # Ensure moods_by_track is a dictionary
-            if not isinstance(moods_by_track, dict):
-                print(f"Error: Expected dict response but got {type(moods_by_track)}")
-                sys.stdout.flush()
-                moods_by_track = {}
-                
-            print(f"Successfully analyzed moods for {len(moods_by_track)} tracks")
+            return {}
+        else:
+            print(f"Using OpenAI client: {type(openai_client).__name__}")
+            sys.stdout.flush()
+        
+        examples = build_training_examples(training_data)
+        
+        # Don't skip tracks missing data - we want to analyze as many as possible (only skip if ID is missing)
+        tracks_data = [build_track_data(track) for track in tracks if track.get('id')]
+        if not tracks_data:
+            print("No valid tracks to analyze")
+            return {}
+        
+        result = {}
+        remaining = tracks_data
+        for attempt in range(1 + LLM_CHUNK_RETRIES):
+            chunks = chunk_tracks_by_token_budget(remaining, examples)
+            label = "Sending" if attempt == 0 else f"Retry {attempt}: resending"
+            print(f"{label} {len(remaining)} tracks to OpenAI in {len(chunks)} chunks ({LLM_MAX_IN_FLIGHT} in flight)")
             sys.stdout.flush()
             
-            # Log a sample of the classification results
-            sample_size = min(5, len(moods_by_track))
-            if sample_size > 0:
-                print("\n=== SAMPLE CLASSIFICATION RESULTS ===")
-                sys.stdout.flush()
-                sample_items = list(moods_by_track.items())[:sample_size]
-                for track_id, moods in sample_items:
-                    track_obj = next((t for t in tracks if str(t['id']) == str(track_id)), None)
-                    track_name = track_obj['name'] if track_obj else "Unknown"
-                    artist = track_obj['artist'] if track_obj else "Unknown"
-                    print(f"Track: {track_name} by {artist} → Moods: {', '.join(moods)}")
-                    sys.stdout.flush()
-                print("=" * 40)
-                sys.stdout.flush()
-            
-            # Check for missing tracks - this is just for logging, not for fallback assignment
-            missing_track_ids = set(track_ids) - set(str(id) for id in moods_by_track.keys())
-            if missing_track_ids:
-                print(f"Warning: {len(missing_track_ids)} tracks were not classified by OpenAI")
-                sys.stdout.flush()
-                for track_id in missing_track_ids:
-                    track_obj = next((t for t in tracks if str(t['id']) == track_id), None)
-                    if track_obj:
-                        print(f"Missing classification for: {track_obj['name']} by {track_obj['artist']}")
+            with ThreadPoolExecutor(max_workers=LLM_MAX_IN_FLIGHT) as executor:
+                futures = {executor.submit(classify_chunk, chunk, examples): chunk for chunk in chunks}
+                failed_chunks = 0
+                for future in wait(futures).done:
+                    try:
+                        for track_id, moods in future.result().items():
+                            # A track answered without any valid mood is retried like a skipped one
+                            if moods and track_id not in result:
+                                result[track_id] = moods
+                    except Exception as e:
+                        failed_chunks += 1
+                        print(f"Error classifying a chunk of {len(futures[future])} tracks: {e}")
                         sys.stdout.flush()
             
-            # Create a result dictionary with proper string keys and validated moods
-            result = {}
-            
-            # First ensure all track IDs in the response are strings
-            for track_id, moods in moods_by_track.items():
-                # Convert any non-string keys to strings
-                str_id = str(track_id)
-                
-                # Validate moods are from the allowed list
-                valid_moods = []
-                if isinstance(moods, list):
-                    for mood in moods:
-                        if isinstance(mood, str) and mood.lower() in mood_list:
-                            valid_moods.append(mood.lower())
-                
-                # Store valid moods (or empty list if none were valid)
-                result[str_id] = valid_moods
-                
-            return result
-            
-        except Exception as e:
-            print(f"Error processing ChatGPT response: {e}")
-            import traceback; traceback.print_exc()
-            return {}
+            # Only failed chunks and tracks the model skipped or gave no valid mood go around again
+            remaining = [track_data for track_data in remaining if str(track_data['id']) not in result]
+            print(f"Classified {len(tracks_data) - len(remaining)}/{len(tracks_data)} tracks ({failed_chunks} chunks failed)")
+            sys.stdout.flush()
+            if not remaining:
+                break
+        
+        # Log a sample of the classification results
+        tracks_by_id = {str(t['id']): t for t in tracks if t.get('id')}
+        sample_size = min(5, len(result))
+        if sample_size > 0:
+            print("\n=== SAMPLE CLASSIFICATION RESULTS ===")
+            sys.stdout.flush()
+            for track_id, moods in list(result.items())[:sample_size]:
+                track_obj = tracks_by_id.get(track_id)
+                track_name = track_obj['name'] if track_obj else "Unknown"
+                artist = track_obj['artist'] if track_obj else "Unknown"
+                print(f"Track: {track_name} by {artist} → Moods: {', '.join(moods)}")
+                sys.stdout.flush()
+            print("=" * 40)
+            sys.stdout.flush()
+        
+        # Check for missing tracks - this is just for logging, not for fallback assignment
+        if remaining:
+            print(f"Warning: {len(remaining)} tracks were not classified by OpenAI")
+            sys.stdout.flush()
+            for track_data in remaining:
+                print(f"Missing classification for: {track_data['name']} by {track_data['artist']}")
+                sys.stdout.flush()
+        
+        return result
         
     except Exception as e:
         print(f"Error in analyze_with_chatgpt: {e}")
@@ -26,9 +26,116 @@ def run_migrations():
                     user_id INTEGER NOT NULL,
                     uri VARCHAR(255) NOT NULL,
                     mood VARCHAR(50) NOT NULL,
+                    added_at TIMESTAMPTZ,
                     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
                     CONSTRAINT unique_track_mood UNIQUE (user_id, uri, mood)
                 )
+                """,
+                """
+                ALTER TABLE tracks ADD COLUMN IF NOT EXISTS added_at TIMESTAMPTZ
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS track_audio_features (
+                    track_id VARCHAR(255) NOT NULL,
+                    feature_version VARCHAR(64) NOT NULL,
+                    features JSONB NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (track_id, feature_version)
+                )
+                """,
+                # Features cached before the version was recorded may come from fast mode; they never match a version
+                """
+                ALTER TABLE track_audio_features ADD COLUMN IF NOT EXISTS feature_version VARCHAR(64) NOT NULL DEFAULT 'unknown'
+                """,
+                """
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.key_column_usage
+                        WHERE table_name = 'track_audio_features' AND constraint_name = 'track_audio_features_pkey'
+                        AND column_name = 'feature_version'
+                    ) THEN
+                        ALTER TABLE track_audio_features DROP CONSTRAINT track_audio_features_pkey;
+                        ALTER TABLE track_audio_features ADD PRIMARY KEY (track_id, feature_version);
+                    END IF;
+                END $$
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS lyrics_cache (
+                    cache_key VARCHAR(512) PRIMARY KEY,
+                    lyrics BYTEA,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS itunes_preview_cache (
+                    track_id VARCHAR(255) PRIMARY KEY,
+                    preview_url TEXT,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS mood_classification_cache (
+                    track_id VARCHAR(255) NOT NULL,
+                    model VARCHAR(64) NOT NULL,
+                    prompt_version VARCHAR(64) NOT NULL,
+                    moods TEXT[] NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (track_id, model, prompt_version)
+                )
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS classification_training_examples (
+                    id BIGSERIAL PRIMARY KEY,
+                    track_id VARCHAR(255) UNIQUE NOT NULL,
+                    lyrics BYTEA,
+                    features JSONB,
+                    moods TEXT[] NOT NULL,
+                    model VARCHAR(64) NOT NULL,
+                    prompt_version VARCHAR(64) NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS analysis_jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    spotify_id VARCHAR(255) NOT NULL,
+                    mode VARCHAR(20) NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    token_info JSONB,
+                    phase VARCHAR(50),
+                    progress JSONB,
+                    result JSONB,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_id VARCHAR(255),
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    started_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+                """,
+                """
+                CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs (status, id)
+                """,
+                # One queued or running analysis per user; older duplicates are retired before the index is built
+                """
+                UPDATE analysis_jobs SET status = 'failed', error = 'Superseded by another analysis', token_info = NULL, finished_at = NOW()
+                WHERE status IN ('queued', 'running') AND id NOT IN (
+                    SELECT MAX(id) FROM analysis_jobs WHERE status IN ('queued', 'running') GROUP BY spotify_id
+                )
+                """,
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_analysis_jobs_active_user ON analysis_jobs (spotify_id)
+                WHERE status IN ('queued', 'running')
+                """,
+                # Latest upstream limiter/breaker/HTTP metrics of each process that analyzes libraries
+                """
+                CREATE TABLE IF NOT EXISTS upstream_metrics (
+                    process_id VARCHAR(255) PRIMARY KEY,
+                    metrics JSONB NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
                 """
             ]
             
@@ -0,0 +1,206 @@
+# Build step: compiles training_data.csv and the fitted Naive Bayes classifier into memory-mappable arrays.
+# Run `python model_artifact.py` after changing the training data (the Docker image runs it at build time),
+# and periodically (e.g. from cron) to fold LLM-labeled tracks from the training store into the classifier.
+import argparse
+import csv
+from collections.abc import Sequence
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from naive_bayes import NaiveBayesMoodClassifier
+
+# Bump when the artifact layout changes so old artifacts are rebuilt instead of misread
+ARTIFACT_VERSION = 2
+
+TRAINING_CSV_PATH = pathlib.Path(__file__).parent / 'training_data.csv'
+MODEL_ARTIFACT_DIR = pathlib.Path(os.getenv('MODEL_ARTIFACT_DIR', pathlib.Path(__file__).parent / 'model_artifact'))
+
+TRAINING_FEATURE_KEYS = [
+    'tempo', 'energy', 'brightness', 'zcr', 'contrast', 'chroma', 'flatness', 'rolloff',
+    'mfcc1', 'mfcc2', 'mfcc3', 'mfcc4', 'mfcc5'
+]
+
+def read_training_csv(csv_path=TRAINING_CSV_PATH):
+    """Parse training_data.csv into a list of example dicts (song, artist, lyrics, moods and audio features)."""
+    training_data = []
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            # Skip empty entries left by trailing commas
+            moods = [mood.strip() for mood in row['moods'].split(',') if mood.strip()]
+            example = {'song': row['song name'], 'artist': row['artist'], 'lyrics': row['lyrics'], 'moods': moods}
+            example.update({key: row[key] for key in TRAINING_FEATURE_KEYS})
+            training_data.append(example)
+    return training_data
+
+def read_training_store(after_id=0, page_size=1000):
+    """Read every LLM-labeled example saved in the database training store after after_id.
+
+    Returns:
+        tuple: (list of example dicts, largest id read, or after_id if there were none)
+    """
+    # Import here so building from the CSV alone works without database dependencies
+    from db import get_training_examples
+
+    examples = []
+    max_id = after_id
+    while True:
+        page = get_training_examples(after_id=max_id, limit=page_size)
+        if not page:
+            return examples, max_id
+        examples.extend(page)
+        max_id = page[-1]['id']
+
+def source_fingerprint(csv_path=TRAINING_CSV_PATH):
+    """SHA-256 of the training CSV, used to detect artifacts built from older training data."""
+    with open(csv_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class TrainingSet(Sequence):
+    """Read-only sequence view over the compiled training examples.
+
+    Examples are materialized as dicts only when indexed, so the lyrics stay in
+    memory-mapped pages shared by every worker until a prompt actually needs them.
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['songs'])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        example = {
+            'song': str(self.arrays['songs'][index]),
+            'artist': str(self.arrays['artists'][index]),
+            'lyrics': str(self.arrays['lyrics'][index]),
+            'moods': str(self.arrays['moods'][index]).split(',')
+        }
+        example.update(zip(TRAINING_FEATURE_KEYS, self.arrays['features'][index].tolist()))
+        return example
+
+    def feature_matrix(self):
+        """(examples x TRAINING_FEATURE_KEYS) audio features and each example's mood list, without touching the lyrics."""
+        return np.asarray(self.arrays['features']), [str(moods).split(',') for moods in self.arrays['moods']]
+
+def build_model_artifact(csv_path=TRAINING_CSV_PATH, artifact_dir=MODEL_ARTIFACT_DIR, include_store=True):
+    """Compile the training set and the fitted classifier into artifact_dir as .npy files plus a manifest.
+
+    The training set (few-shot examples and k-NN data) is always the curated CSV; with include_store
+    the classifier is also fitted on the LLM-labeled examples in the training store.
+    """
+    training_data = read_training_csv(csv_path)
+    store_examples, store_max_id = read_training_store() if include_store else ([], 0)
+    classifier = NaiveBayesMoodClassifier()
+    classifier.fit([
+        (example['lyrics'], example['moods'])
+        for example in training_data + store_examples if example['lyrics'] and example['moods']
+    ])
+
+    arrays = {
+        'songs': np.array([example['song'] for example in training_data], dtype=str),
+        'artists': np.array([example['artist'] for example in training_data], dtype=str),
+        'lyrics': np.array([example['lyrics'] for example in training_data], dtype=str),
+        'moods': np.array([','.join(example['moods']) for example in training_data], dtype=str),
+        'features': np.array(
+            [[float(example[key] or 0) for key in TRAINING_FEATURE_KEYS] for example in training_data],
+            dtype=np.float64
+        ).reshape(len(training_data), len(TRAINING_FEATURE_KEYS))
+    }
+    arrays.update({f"nb_{name}": value for name, value in classifier.to_arrays().items()})
+
+    manifest = {
+        'version': ARTIFACT_VERSION,
+        'source_sha256': source_fingerprint(csv_path),
+        'examples': len(training_data),
+        'store_examples': len(store_examples),
+        # Workers train incrementally on store examples after this id
+        'store_max_id': store_max_id,
+        'vocab_size': len(classifier.vocab),
+        'built_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'arrays': sorted(arrays)
+    }
+
+    # Write into a sibling temp dir and swap it in, so workers never see a half-written artifact
+    artifact_dir = pathlib.Path(artifact_dir)
+    artifact_dir.parent.mkdir(parents=True, exist_ok=True)
+    staging_dir = pathlib.Path(tempfile.mkdtemp(prefix='.model_artifact-', dir=artifact_dir.parent))
+    for name, value in arrays.items():
+        np.save(staging_dir / f"{name}.npy", value, allow_pickle=False)
+    with open(staging_dir / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    # mkdtemp creates the directory as 0700; workers may run as a different user
+    staging_dir.chmod(0o755)
+    # Move the old artifact aside rather than deleting it in place: the path is only missing between
+    # the two renames (readers then fall back to the CSV), and arrays a worker already mapped stay valid
+    retired_dir = None
+    if artifact_dir.exists():
+        retired_dir = artifact_dir.with_name(f".{artifact_dir.name}-retired-{os.getpid()}")
+        artifact_dir.rename(retired_dir)
+    staging_dir.rename(artifact_dir)
+    if retired_dir:
+        shutil.rmtree(retired_dir, ignore_errors=True)
+    return manifest
+
+def read_artifact_manifest(artifact_dir=MODEL_ARTIFACT_DIR):
+    """The artifact's manifest dict, or None if no artifact has been built."""
+    try:
+        with open(pathlib.Path(artifact_dir) / 'manifest.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def load_model_artifact(artifact_dir=MODEL_ARTIFACT_DIR, csv_path=TRAINING_CSV_PATH):
+    """Memory-map a compiled artifact.
+
+    Returns:
+        tuple: (TrainingSet, NaiveBayesMoodClassifier, manifest), or None if the artifact is missing,
+        unreadable, from another ARTIFACT_VERSION or built from a different training CSV
+    """
+    artifact_dir = pathlib.Path(artifact_dir)
+    manifest = read_artifact_manifest(artifact_dir)
+    if manifest is None:
+        print(f"No model artifact at {artifact_dir}; run `python model_artifact.py` to build it")
+        sys.stdout.flush()
+        return None
+
+    if manifest.get('version') != ARTIFACT_VERSION:
+        print(f"Model artifact version {manifest.get('version')} != {ARTIFACT_VERSION}; ignoring it")
+        sys.stdout.flush()
+        return None
+    if os.path.exists(csv_path) and manifest.get('source_sha256') != source_fingerprint(csv_path):
+        print("Model artifact was built from different training data; ignoring it")
+        sys.stdout.flush()
+        return None
+
+    try:
+        # mmap_mode='r' maps the files read-only, so every worker shares the same page-cache pages
+        arrays = {name: np.load(artifact_dir / f"{name}.npy", mmap_mode='r', allow_pickle=False) for name in manifest['arrays']}
+        classifier = NaiveBayesMoodClassifier.from_arrays(
+            {name[len('nb_'):]: value for name, value in arrays.items() if name.startswith('nb_')}
+        )
+    except (OSError, ValueError, KeyError) as e:
+        # e.g. the artifact was swapped by a rebuild while we were reading it
+        print(f"Could not load model artifact from {artifact_dir}: {e}; ignoring it")
+        sys.stdout.flush()
+        return None
+    return TrainingSet(arrays), classifier, manifest
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile training data and the local classifier into a model artifact")
+    parser.add_argument('--skip-store', action='store_true',
+                        help="build from training_data.csv only, without the database training store")
+    args = parser.parse_args()
+    start = time.time()
+    manifest = build_model_artifact(include_store=not args.skip_store)
+    print(f"Built model artifact v{manifest['version']} at {MODEL_ARTIFACT_DIR}: {manifest['examples']} examples "
+          f"+ {manifest['store_examples']} from the training store, {manifest['vocab_size']} words in {time.time() - start:.2f}s")
@@ -1,14 +1,20 @@
 import numpy as np
-from collections import defaultdict, Counter
+from collections import Counter
+from scipy.sparse import csr_matrix
 import re
 
 class NaiveBayesMoodClassifier:
     def __init__(self):
-        self.mood_word_counts = defaultdict(Counter)
+        self.moods = []                 # mood labels, in the order they were first seen
+        self.vocab = {}                 # word -> column index
         self.mood_counts = Counter()
-        self.vocab = set()
-        self.mood_priors = {}
-        self.word_probs = defaultdict(dict)
+        self.word_counts = np.zeros((0, 0))
+        self.log_priors = np.zeros(0)
+        self.log_word_probs = np.zeros((0, 0))
+
+    @property
+    def mood_priors(self):
+        return dict(zip(self.moods, np.exp(self.log_priors)))
 
     def tokenize(self, text):
         # Simple whitespace and punctuation tokenizer
@@ -18,39 +24,132 @@ class NaiveBayesMoodClassifier:
         """
         training_data: list of tuples (lyrics, moods)
         moods can be a string (single mood) or a list of strings (multi-mood)
+        Refits from scratch, discarding anything learned before
+        """
+        self.__init__()
+        self.partial_fit(training_data)
+
+    def partial_fit(self, training_data):
+        """
+        Add more (lyrics, moods) examples to an already fitted model; new words and moods
+        extend the vocabulary and mood list, and the result matches fitting on all examples at once
         """
+        docs = []
         for lyrics, moods in training_data:
             if isinstance(moods, str):
                 moods = [moods]
             tokens = self.tokenize(lyrics)
+            docs.append((Counter(tokens), moods))
             for mood in moods:
-                self.mood_word_counts[mood].update(tokens)
+                if mood not in self.mood_counts:
+                    self.moods.append(mood)
                 self.mood_counts[mood] += 1
-            self.vocab.update(tokens)
-        total = sum(self.mood_counts.values())
-        self.mood_priors = {mood: count / total for mood, count in self.mood_counts.items()}
-        # Calculate word probabilities with Laplace smoothing
-        for mood in self.mood_word_counts:
-            total_words = sum(self.mood_word_counts[mood].values())
-            for word in self.vocab:
-                self.word_probs[mood][word] = (
-                    self.mood_word_counts[mood][word] + 1
-                ) / (total_words + len(self.vocab))
-
-    def predict(self, lyrics, threshold=0.1):
-        tokens = self.tokenize(lyrics)
-        mood_scores = {}
-        for mood in self.mood_priors:
-            # Start with log prior
-            log_prob = np.log(self.mood_priors[mood])
             for word in tokens:
-                if word in self.vocab:
-                    log_prob += np.log(self.word_probs[mood].get(word, 1 / (sum(self.mood_word_counts[mood].values()) + len(self.vocab))))
-            mood_scores[mood] = log_prob
+                self.vocab.setdefault(word, len(self.vocab))
+        if not docs:
+            return
+
+        # Grow into a fresh array (this also copies read-only memory-mapped counts before updating them)
+        word_counts = np.zeros((len(self.moods), len(self.vocab)))
+        word_counts[:self.word_counts.shape[0], :self.word_counts.shape[1]] = self.word_counts
+        mood_index = {mood: i for i, mood in enumerate(self.moods)}
+        for token_counts, moods in docs:
+            columns = [self.vocab[word] for word in token_counts]
+            counts = list(token_counts.values())
+            for mood in moods:
+                word_counts[mood_index[mood], columns] += counts
+        self.word_counts = word_counts
+        self._update_log_probs()
+
+    def _update_log_probs(self):
+        # Priors and word probabilities with Laplace smoothing, kept as logs for scoring
+        mood_totals = np.array([self.mood_counts[mood] for mood in self.moods], dtype=float)
+        self.log_priors = np.log(mood_totals / mood_totals.sum())
+        total_words = self.word_counts.sum(axis=1, keepdims=True)
+        self.log_word_probs = np.log((self.word_counts + 1) / (total_words + len(self.vocab)))
+
+    def copy(self):
+        """
+        Independent copy to partial_fit while other threads keep scoring with this one;
+        the count and probability arrays are shared, since fitting replaces them rather than writing to them
+        """
+        classifier = type(self)()
+        classifier.moods = list(self.moods)
+        classifier.vocab = dict(self.vocab)
+        classifier.mood_counts = Counter(self.mood_counts)
+        classifier.word_counts = self.word_counts
+        classifier.log_priors = self.log_priors
+        classifier.log_word_probs = self.log_word_probs
+        return classifier
+
+    def to_arrays(self):
+        """
+        Fitted parameters as plain numpy arrays (for saving to a model artifact)
+        """
+        words = sorted(self.vocab, key=self.vocab.get)
+        return {
+            'moods': np.array(self.moods, dtype=str),
+            'words': np.array(words, dtype=str),
+            'mood_counts': np.array([self.mood_counts[mood] for mood in self.moods], dtype=np.int64),
+            'word_counts': self.word_counts,
+            'log_priors': self.log_priors,
+            'log_word_probs': self.log_word_probs
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild a fitted classifier from to_arrays() output; the matrices are used as-is,
+        so memory-mapped arrays stay memory-mapped
+        """
+        classifier = cls()
+        classifier.moods = [str(mood) for mood in arrays['moods']]
+        classifier.vocab = {str(word): i for i, word in enumerate(arrays['words'])}
+        classifier.mood_counts = Counter(dict(zip(classifier.moods, (int(count) for count in arrays['mood_counts']))))
+        classifier.word_counts = arrays['word_counts']
+        classifier.log_priors = arrays['log_priors']
+        classifier.log_word_probs = arrays['log_word_probs']
+        return classifier
+
+    def vectorize(self, documents):
+        """
+        Sparse (documents x vocab) matrix of token counts; words outside the vocabulary are dropped
+        """
+        rows, columns = [], []
+        for row, lyrics in enumerate(documents):
+            for word in self.tokenize(lyrics or ''):
+                column = self.vocab.get(word)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+        data = np.ones(len(rows))
+        # Duplicate (row, column) entries are summed into counts
+        return csr_matrix((data, (rows, columns)), shape=(len(documents), len(self.vocab)))
+
+    def posteriors(self, counts):
+        """
+        Posterior probability of each mood for every row of a vectorize() count matrix,
+        as a (documents x moods) array whose columns follow self.moods
+        """
+        # One sparse product scores every document against every mood
+        log_scores = np.asarray(counts @ self.log_word_probs.T) + self.log_priors
         # Convert log-probs to probabilities
-        max_log = max(mood_scores.values())
-        exp_scores = {mood: np.exp(score - max_log) for mood, score in mood_scores.items()}
-        total = sum(exp_scores.values())
-        probs = {mood: exp_scores[mood] / total for mood in exp_scores}
-        # Return all moods above threshold (default 0.1)
-        return [mood for mood, prob in probs.items() if prob >= threshold]
\ No newline at end of file
+        exp_scores = np.exp(log_scores - log_scores.max(axis=1, keepdims=True))
+        return exp_scores / exp_scores.sum(axis=1, keepdims=True)
+
+    def predict_proba_batch(self, documents):
+        return self.posteriors(self.vectorize(documents))
+
+    def predict_proba(self, lyrics):
+        """
+        Posterior probability of each mood given the lyrics, as a dict summing to 1
+        """
+        return dict(zip(self.moods, self.predict_proba_batch([lyrics])[0]))
+
+    def predict_batch(self, documents, threshold=0.1):
+        probs = self.predict_proba_batch(documents)
+        # Return all moods above threshold (default 0.1) for each document
+        return [[self.moods[i] for i in np.flatnonzero(row >= threshold)] for row in probs]
+
+    def predict(self, lyrics, threshold=0.1):
+        return self.predict_batch([lyrics], threshold)[0]
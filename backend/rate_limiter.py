@@ -0,0 +1,259 @@
+# this file limits how hard each upstream provider (Genius, Vagalume, iTunes, OpenAI) is hit:
+# every provider has its own token bucket (requests per second) and an AIMD concurrency window
+# that grows while calls succeed, halves when the provider throttles or fails, and waits out Retry-After.
+# Calls also go through the provider's circuit breaker (see circuit_breaker.py)
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from circuit_breaker import get_breaker, CircuitOpen, UpstreamUnavailable
+
+# Longest a call waits for its provider's limiter before giving up on that provider
+LIMITER_MAX_WAIT_SECONDS = float(os.getenv('LIMITER_MAX_WAIT_SECONDS', '30'))
+# Backoff after a throttled response without a usable Retry-After, and the cap on any Retry-After
+LIMITER_DEFAULT_BACKOFF_SECONDS = float(os.getenv('LIMITER_DEFAULT_BACKOFF_SECONDS', '2'))
+LIMITER_MAX_BACKOFF_SECONDS = float(os.getenv('LIMITER_MAX_BACKOFF_SECONDS', '60'))
+# Multiplicative decrease of the concurrency window, applied at most once per cooldown
+# so a burst of failures from calls that were already in flight counts as one signal
+LIMITER_DECREASE_FACTOR = 0.5
+LIMITER_DECREASE_COOLDOWN_SECONDS = 1.0
+# Latency samples kept per provider for the metrics (and latency_percentile)
+LIMITER_LATENCY_SAMPLES = 200
+
+# Default requests/second, burst and maximum concurrency per provider; override with
+# <PROVIDER>_RATE_PER_SECOND, <PROVIDER>_BURST and <PROVIDER>_MAX_CONCURRENCY
+PROVIDER_LIMITS = {
+    'genius': {'rate': 10, 'burst': 10, 'max_concurrency': 16},
+    'vagalume': {'rate': 5, 'burst': 5, 'max_concurrency': 8},
+    # iTunes search answers 403 rather than 429 when it throttles
+    'itunes': {'rate': 10, 'burst': 10, 'max_concurrency': 16, 'throttle_statuses': (403, 429, 503)},
+    'openai': {'rate': 2, 'burst': 4, 'max_concurrency': int(os.getenv('LLM_MAX_IN_FLIGHT', '4'))},
+}
+
+class UpstreamThrottled(UpstreamUnavailable):
+    """Raised when a provider's limiter can't grant a call within the wait budget."""
+    def __init__(self, provider):
+        super().__init__(provider, "is throttled")
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None if absent or invalid."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def status_of(error):
+    """HTTP status carried by a requests/lyricsgenius/openai exception, if any."""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None and isinstance(getattr(error, 'errno', None), int):
+        # lyricsgenius re-raises HTTPError(status_code, message)
+        status = error.errno
+    return status
+
+class AdaptiveLimiter:
+    """Token bucket plus AIMD concurrency window for one provider, shared by every thread in the process."""
+    def __init__(self, name, rate, burst, max_concurrency, throttle_statuses=(429, 503)):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.throttle_statuses = throttle_statuses
+        self.window = float(self.max_concurrency)
+        self.tokens = self.burst
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.latencies = deque(maxlen=LIMITER_LATENCY_SAMPLES)
+        self.counts = {'calls': 0, 'succeeded': 0, 'client_errors': 0, 'throttled': 0, 'failed': 0, 'rejected': 0}
+        self.wait_seconds = 0.0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        # last_refill is pushed past now while a Retry-After pause runs, so no tokens pile up during it
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.last_refill) * self.rate)
+        self.last_refill = max(self.last_refill, now)
+
+    def acquire(self, timeout=None):
+        """Wait for a concurrency slot and a token. Returns False if that takes longer than timeout."""
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.in_flight >= int(self.window):
+                    delay = None  # until a call is released
+                elif self.tokens < 1:
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.counts['calls'] += 1
+                    self.wait_seconds += now - start
+                    return True
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counts['rejected'] += 1
+                        return False
+                    delay = remaining if delay is None else min(delay, remaining)
+                self.cond.wait(delay)
+
+    def release(self, outcome, retry_after=None, latency=None):
+        """Finish a call: 'success' grows the window by one per window's worth of calls,
+        'client_error' (a 4xx about the request itself) leaves it alone, 'throttled' and
+        'failed' halve it, and 'throttled' also pauses the provider."""
+        with self.cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if latency is not None:
+                self.latencies.append(latency)
+            if outcome == 'success':
+                self.counts['succeeded'] += 1
+                self.window = min(self.max_concurrency, self.window + 1 / self.window)
+            elif outcome == 'client_error':
+                self.counts['client_errors'] += 1
+            else:
+                self.counts[outcome] += 1
+                if now - self.last_decrease >= LIMITER_DECREASE_COOLDOWN_SECONDS:
+                    self.window = max(1.0, self.window * LIMITER_DECREASE_FACTOR)
+                    self.last_decrease = now
+                if outcome == 'throttled':
+                    backoff = LIMITER_DEFAULT_BACKOFF_SECONDS if retry_after is None else retry_after
+                    self.blocked_until = max(self.blocked_until, now + min(backoff, LIMITER_MAX_BACKOFF_SECONDS))
+                    self.tokens = 0
+                    self.last_refill = self.blocked_until
+            self.cond.notify_all()
+
+    def latency_percentile(self, q):
+        """q-th percentile (0-100) of recent call latencies in seconds, or None before any call finished."""
+        with self.cond:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+    def snapshot(self):
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            snapshot = {
+                'concurrency_limit': int(self.window),
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'rate_per_second': self.rate,
+                'tokens': round(self.tokens, 2),
+                'paused_for_seconds': round(max(0.0, self.blocked_until - now), 2),
+                'total_wait_seconds': round(self.wait_seconds, 2),
+                **self.counts
+            }
+        snapshot['latency_p50'] = self.latency_percentile(50)
+        snapshot['latency_p90'] = self.latency_percentile(90)
+        return snapshot
+
+class UpstreamCall:
+    """Handle for one limited call; report throttling or failure on it, anything else counts as success."""
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.outcome = 'success'
+        self.retry_after = None
+
+    def throttled(self, retry_after=None):
+        self.outcome = 'throttled'
+        self.retry_after = retry_after
+
+    def check_response(self, response):
+        """Record an HTTP response: throttle statuses (with Retry-After), 5xx errors and other 4xx
+        (client errors, unless the call already throttled or failed). Returns the response."""
+        if response.status_code in self.limiter.throttle_statuses:
+            self.throttled(parse_retry_after(response.headers.get('Retry-After')))
+        elif response.status_code >= 500:
+            self.outcome = 'failed'
+        elif response.status_code >= 400 and self.outcome == 'success':
+            self.outcome = 'client_error'
+        return response
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+# Calls currently inside a limited() block on each thread, innermost last
+_active = threading.local()
+
+def get_limiter(provider):
+    """The process-wide limiter for a provider, created from PROVIDER_LIMITS on first use."""
+    with _limiters_lock:
+        if provider not in _limiters:
+            config = dict(PROVIDER_LIMITS.get(provider, {'rate': 5, 'burst': 5, 'max_concurrency': 8}))
+            prefix = provider.upper()
+            config['rate'] = float(os.getenv(f'{prefix}_RATE_PER_SECOND', config['rate']))
+            config['burst'] = float(os.getenv(f'{prefix}_BURST', config['burst']))
+            config['max_concurrency'] = int(os.getenv(f'{prefix}_MAX_CONCURRENCY', config['max_concurrency']))
+            _limiters[provider] = AdaptiveLimiter(provider, **config)
+        return _limiters[provider]
+
+@contextmanager
+def limited(provider, timeout=LIMITER_MAX_WAIT_SECONDS):
+    """Run the block as one call to provider under its limiter.
+
+    Yields an UpstreamCall; pass HTTP responses to call.check_response(response) or call
+    call.throttled(retry_after) directly (sessions from http_clients with report_responses
+    do that for every response, see active_call). Exceptions carrying a throttle status count as
+    throttled, other 4xx as client errors and everything else (timeouts, connection
+    errors, 5xx) as failures, which also count towards opening the provider's breaker.
+
+    Raises:
+        CircuitOpen: if the provider's breaker is open
+        UpstreamThrottled: if no slot opened up within timeout seconds
+    """
+    breaker = get_breaker(provider)
+    permit = breaker.allow()
+    if permit is None:
+        raise CircuitOpen(provider)
+    limiter = get_limiter(provider)
+    if not limiter.acquire(timeout):
+        breaker.cancel(permit)
+        raise UpstreamThrottled(provider)
+    call = UpstreamCall(limiter)
+    start = time.monotonic()
+    calls = _active.__dict__.setdefault('calls', [])
+    calls.append(call)
+    try:
+        yield call
+    except Exception as e:
+        status = status_of(e)
+        if status in limiter.throttle_statuses:
+            response = getattr(e, 'response', None)
+            call.throttled(parse_retry_after(response.headers.get('Retry-After')) if response is not None else None)
+        elif status is not None and 400 <= status < 500:
+            call.outcome = 'client_error'
+        elif call.outcome == 'success':
+            call.outcome = 'failed'
+        raise
+    finally:
+        calls.pop()
+        limiter.release(call.outcome, call.retry_after, time.monotonic() - start)
+        breaker.record(permit, call.outcome)
+
+def active_call(provider):
+    """The innermost limited() call to provider running on this thread, or None."""
+    for call in reversed(getattr(_active, 'calls', [])):
+        if call.limiter.name == provider:
+            return call
+    return None
+
+def limiter_metrics():
+    """Current limits and counters of every provider used so far in this process."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.snapshot() for name, limiter in sorted(limiters.items())}
@@ -19,13 +19,16 @@ def create_spotify_oauth(token_info=None):
         show_dialog=True
     )
 
+def get_spotify_client_from_token_info(token_info):
+    """Spotify client for a stored OAuth token (refreshed automatically when it expires), for use outside a request"""
+    return spotipy.Spotify(auth_manager=create_spotify_oauth(token_info))
+
 def get_spotify_client_from_session():
     token_info = session.get('spotify_token_info', None)
     if not token_info:
         return None
-    auth_manager = create_spotify_oauth(token_info)
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-    new_token_info = auth_manager.get_cached_token()
+    sp = get_spotify_client_from_token_info(token_info)
+    new_token_info = sp.auth_manager.get_cached_token()
     if new_token_info and new_token_info != token_info:
         session['spotify_token_info'] = new_token_info
         session.modified = True
@@ -0,0 +1,214 @@
+# this file checks the per-user analysis lease: enqueue/attach/stale takeover/claim against the migrated
+# schema, and run_single_flight_analysis on top of it (run with `python -m pytest tests` from backend/).
+# The database tests need TEST_DATABASE_URL pointing at a disposable PostgreSQL database; they empty analysis_jobs
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis_jobs
+import db
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL not set")
+class AnalysisJobLeaseTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.patcher = mock.patch.dict(db.db_config, {
+            'db_url': TEST_DATABASE_URL, 'initialized': True, 'connection_params': {'connect_timeout': 10}
+        })
+        cls.patcher.start()
+        from migrations import run_migrations
+        run_migrations()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher.stop()
+
+    def setUp(self):
+        self.execute("DELETE FROM analysis_jobs")
+
+    def execute(self, query, params=None):
+        conn = db.get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall() if cursor.description else None
+            conn.commit()
+            return rows
+        finally:
+            db.close_db_connection(conn)
+
+    def job(self, job_id):
+        return self.execute("SELECT status, error, token_info, worker_id FROM analysis_jobs WHERE id = %s", (job_id,))[0]
+
+    def test_second_enqueue_attaches(self):
+        job_id, created = db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'a'})
+        self.assertTrue(created)
+        self.assertEqual(db.enqueue_analysis_job('alice', 'full', {'access_token': 'b'}), (job_id, False))
+        # Other users get their own job
+        other_id, created = db.enqueue_analysis_job('bob', 'incremental', {'access_token': 'c'})
+        self.assertTrue(created)
+        self.assertNotEqual(other_id, job_id)
+
+    def test_inline_job_runs_without_token(self):
+        job_id, created = db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'a'}, worker_id='web:1:inline')
+        self.assertTrue(created)
+        self.assertEqual(self.job(job_id), ('running', None, None, 'web:1:inline'))
+        # Inline runs aren't handed to analysis workers
+        self.assertIsNone(db.claim_analysis_job('worker', 300))
+        self.assertEqual(db.enqueue_analysis_job('alice', 'incremental', worker_id='web:2:inline'), (job_id, False))
+
+    def test_concurrent_enqueues_create_one_job(self):
+        results = []
+        barrier = threading.Barrier(8)
+
+        def enqueue(i):
+            barrier.wait()
+            results.append(db.enqueue_analysis_job('alice', 'incremental', worker_id=f"web:{i}:inline"))
+
+        threads = [threading.Thread(target=enqueue, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(1 for _, created in results if created), 1)
+        self.assertEqual(len({job_id for job_id, _ in results}), 1)
+
+    def test_finished_job_releases_the_lease(self):
+        job_id, _ = db.enqueue_analysis_job('alice', 'incremental', worker_id='web:1:inline')
+        db.finish_analysis_job(job_id, 'completed', result={'status_code': 200})
+        new_id, created = db.enqueue_analysis_job('alice', 'incremental', worker_id='web:1:inline')
+        self.assertTrue(created)
+        self.assertNotEqual(new_id, job_id)
+
+    def test_stale_running_job_is_taken_over(self):
+        job_id, _ = db.enqueue_analysis_job('alice', 'incremental', worker_id='web:1:inline')
+        self.execute("UPDATE analysis_jobs SET heartbeat_at = NOW() - INTERVAL '10 minutes' WHERE id = %s", (job_id,))
+        # A recent heartbeat still holds the lease
+        self.assertEqual(db.enqueue_analysis_job('alice', 'incremental', stale_seconds=900), (job_id, False))
+
+        new_id, created = db.enqueue_analysis_job('alice', 'incremental', worker_id='web:2:inline', stale_seconds=300)
+        self.assertTrue(created)
+        self.assertEqual(self.job(job_id)[:2], ('failed', 'Analysis worker stopped responding'))
+        self.assertEqual(self.job(new_id)[0], 'running')
+
+    def test_unclaimed_queued_job_is_taken_over(self):
+        job_id, _ = db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'a'})
+        self.execute("UPDATE analysis_jobs SET created_at = NOW() - INTERVAL '20 minutes' WHERE id = %s", (job_id,))
+        new_id, created = db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'b'}, queued_seconds=600)
+        self.assertTrue(created)
+        self.assertEqual(self.job(job_id)[:3], ('failed', 'No analysis worker picked the job up', None))
+
+    def test_claim_hands_over_and_clears_the_token(self):
+        first_id, _ = db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'a'})
+        second_id, _ = db.enqueue_analysis_job('bob', 'full', {'access_token': 'b'})
+
+        job = db.claim_analysis_job('worker-1', 300)
+        self.assertEqual((job['id'], job['spotify_id'], job['token_info'], job['attempts']),
+                         (first_id, 'alice', {'access_token': 'a'}, 1))
+        self.assertEqual(self.job(first_id), ('running', None, None, 'worker-1'))
+        self.assertEqual(db.claim_analysis_job('worker-2', 300)['id'], second_id)
+        self.assertIsNone(db.claim_analysis_job('worker-3', 300))
+        # The claimed job still holds the user's lease
+        self.assertEqual(db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'c'}), (first_id, False))
+
+    def test_claim_fails_stale_running_jobs(self):
+        job_id, _ = db.enqueue_analysis_job('alice', 'incremental', {'access_token': 'a'})
+        db.claim_analysis_job('worker-1', 300)
+        self.execute("UPDATE analysis_jobs SET heartbeat_at = NOW() - INTERVAL '10 minutes' WHERE id = %s", (job_id,))
+        self.assertIsNone(db.claim_analysis_job('worker-2', 300))
+        self.assertEqual(self.job(job_id)[:2], ('failed', 'Analysis worker stopped responding'))
+
+    def test_concurrent_claims_get_different_jobs(self):
+        for user in ('alice', 'bob', 'carol', 'dave'):
+            db.enqueue_analysis_job(user, 'incremental', {'access_token': user})
+        claimed = []
+        barrier = threading.Barrier(6)
+
+        def claim(i):
+            barrier.wait()
+            claimed.append(db.claim_analysis_job(f"worker-{i}", 300))
+
+        threads = [threading.Thread(target=claim, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # SKIP LOCKED may leave a job for the next poll, but never hands one out twice
+        while True:
+            job = db.claim_analysis_job('worker-late', 300)
+            if not job:
+                break
+            claimed.append(job)
+        jobs = [job for job in claimed if job]
+        self.assertEqual(sorted(job['spotify_id'] for job in jobs), ['alice', 'bob', 'carol', 'dave'])
+
+class SingleFlightAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        patches = {
+            'enqueue_analysis_job': mock.DEFAULT, 'finish_analysis_job': mock.DEFAULT, 'wait_for_analysis_job': mock.DEFAULT,
+            'run_analysis': mock.DEFAULT, 'publish_upstream_metrics': mock.DEFAULT, 'update_analysis_job_progress': mock.DEFAULT,
+            'get_mood_uris_for_user': mock.DEFAULT, 'get_or_create_user': mock.DEFAULT
+        }
+        patcher = mock.patch.multiple(analysis_jobs, **patches)
+        self.mocks = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mocks['run_analysis'].return_value = ({'message': 'analyzed'}, 200, {'happy': ['uri']})
+        self.mocks['get_or_create_user'].return_value = 7
+        self.mocks['get_mood_uris_for_user'].return_value = {'sad': ['stored']}
+
+    def test_lease_holder_runs_and_finishes_the_job(self):
+        self.mocks['enqueue_analysis_job'].return_value = (1, True)
+        result = analysis_jobs.run_single_flight_analysis(None, 'alice')
+
+        self.assertEqual(result, ({'message': 'analyzed'}, 200, {'happy': ['uri']}))
+        self.assertIsNotNone(self.mocks['enqueue_analysis_job'].call_args.kwargs['worker_id'])
+        self.mocks['finish_analysis_job'].assert_called_once_with(
+            1, 'completed', result={'message': 'analyzed', 'status_code': 200}, error=None
+        )
+        self.mocks['wait_for_analysis_job'].assert_not_called()
+
+    def test_failed_run_fails_the_job(self):
+        self.mocks['enqueue_analysis_job'].return_value = (1, True)
+        self.mocks['run_analysis'].side_effect = RuntimeError('boom')
+        with self.assertRaises(RuntimeError):
+            analysis_jobs.run_single_flight_analysis(None, 'alice')
+        self.mocks['finish_analysis_job'].assert_called_once_with(1, 'failed', error='Analysis failed: boom')
+
+    def test_attached_caller_gets_the_in_flight_result(self):
+        self.mocks['enqueue_analysis_job'].return_value = (1, False)
+        self.mocks['wait_for_analysis_job'].return_value = {
+            'status': 'completed', 'result': {'message': 'analyzed', 'status_code': 200}, 'error': None
+        }
+        result = analysis_jobs.run_single_flight_analysis(None, 'alice')
+
+        self.assertEqual(result, ({'message': 'analyzed'}, 200, {'sad': ['stored']}))
+        self.mocks['run_analysis'].assert_not_called()
+        self.mocks['finish_analysis_job'].assert_not_called()
+
+    def test_attached_caller_gets_a_failed_result(self):
+        self.mocks['enqueue_analysis_job'].return_value = (1, False)
+        self.mocks['wait_for_analysis_job'].return_value = {'status': 'failed', 'result': None, 'error': 'Spotify is down'}
+        self.assertEqual(analysis_jobs.run_single_flight_analysis(None, 'alice'), ({'error': 'Spotify is down'}, 500, None))
+
+    def test_dead_run_is_taken_over(self):
+        self.mocks['enqueue_analysis_job'].side_effect = [(1, False), (2, True)]
+        self.mocks['wait_for_analysis_job'].return_value = None
+        result = analysis_jobs.run_single_flight_analysis(None, 'alice')
+
+        self.assertEqual(result[1], 200)
+        self.mocks['run_analysis'].assert_called_once()
+        self.assertEqual(self.mocks['finish_analysis_job'].call_args.args[:2], (2, 'completed'))
+
+    def test_runs_without_a_lease_when_there_is_no_database(self):
+        self.mocks['enqueue_analysis_job'].return_value = (None, False)
+        self.assertEqual(analysis_jobs.run_single_flight_analysis(None, 'alice')[1], 200)
+        self.mocks['finish_analysis_job'].assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
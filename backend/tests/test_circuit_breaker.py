@@ -0,0 +1,107 @@
+# this file walks a CircuitBreaker through its closed/open/half-open transitions on a fake clock
+# (run with `python -m pytest tests` from backend/)
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SECONDS, BREAKER_MAX_OPEN_SECONDS
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(circuit_breaker.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test')
+
+    def fail_until_open(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            self.breaker.record(self.breaker.allow(), 'failed')
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD - 1):
+            self.breaker.record(self.breaker.allow(), 'failed')
+        # A success in between resets the count
+        self.breaker.record(self.breaker.allow(), 'success')
+        for _ in range(BREAKER_FAILURE_THRESHOLD - 1):
+            self.breaker.record(self.breaker.allow(), 'failed')
+        self.assertEqual(self.breaker.state, 'closed')
+
+        self.breaker.record(self.breaker.allow(), 'failed')
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertIsNone(self.breaker.allow())
+        self.assertEqual(self.breaker.counts['short_circuited'], 1)
+
+    def test_one_probe_after_open_period(self):
+        self.fail_until_open()
+        self.now += BREAKER_OPEN_SECONDS - 1
+        self.assertIsNone(self.breaker.allow())
+
+        self.now += 1
+        probe = self.breaker.allow()
+        self.assertTrue(probe.is_probe)
+        self.assertEqual(self.breaker.state, 'half_open')
+        # Only one probe at a time
+        self.assertIsNone(self.breaker.allow())
+
+        self.breaker.record(probe, 'success')
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.breaker.open_seconds, BREAKER_OPEN_SECONDS)
+        self.assertFalse(self.breaker.allow().is_probe)
+
+    def test_failed_probe_doubles_open_period(self):
+        self.fail_until_open()
+        expected = BREAKER_OPEN_SECONDS
+        for _ in range(10):
+            self.now += expected
+            self.breaker.record(self.breaker.allow(), 'failed')
+            expected = min(expected * 2, BREAKER_MAX_OPEN_SECONDS)
+            self.assertEqual(self.breaker.state, 'open')
+            self.assertEqual(self.breaker.open_seconds, expected)
+            self.now += expected - 1
+            self.assertIsNone(self.breaker.allow())
+            self.now += 1
+            self.breaker.cancel(self.breaker.allow())
+            self.now -= expected
+        self.assertEqual(self.breaker.open_seconds, BREAKER_MAX_OPEN_SECONDS)
+
+    def test_only_the_probe_moves_the_breaker(self):
+        # Calls allowed while closed that finish after the breaker opened change nothing
+        late_success = self.breaker.allow()
+        late_failure = self.breaker.allow()
+        self.fail_until_open()
+        self.breaker.record(late_success, 'success')
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.now += BREAKER_OPEN_SECONDS
+        probe = self.breaker.allow()
+        self.breaker.record(late_failure, 'failed')
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertEqual(self.breaker.open_seconds, BREAKER_OPEN_SECONDS)
+
+        self.breaker.record(probe, 'success')
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_cancel_frees_the_probe_slot(self):
+        self.fail_until_open()
+        self.now += BREAKER_OPEN_SECONDS
+        probe = self.breaker.allow()
+        self.assertIsNone(self.breaker.allow())
+
+        self.breaker.cancel(probe)
+        self.assertEqual(self.breaker.state, 'half_open')
+        next_probe = self.breaker.allow()
+        self.assertTrue(next_probe.is_probe)
+        self.assertEqual(self.breaker.counts['probes'], 2)
+
+        # Cancelling a regular call doesn't touch the probe slot
+        self.breaker.cancel(circuit_breaker.BreakerPermit(is_probe=False))
+        self.assertIsNone(self.breaker.allow())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# this file checks that Genius throttling reaches the 'genius' limiter even though lyricsgenius
+# hides the HTTP status of error responses (run with `python -m pytest tests` from backend/)
+import os
+import sys
+import unittest
+from unittest import mock
+import requests
+from requests.adapters import HTTPAdapter
+from lyricsgenius import Genius
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_clients
+import lyrics_service
+from circuit_breaker import get_breaker
+from rate_limiter import get_limiter
+
+def fake_response(request, status, headers=None, body=b''):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response._content = body
+    response.url = request.url
+    response.request = request
+    return response
+
+class GeniusThrottlingTest(unittest.TestCase):
+    def setUp(self):
+        self.genius = Genius('token', timeout=http_clients.http_timeout('genius'), retries=0, sleep_time=0)
+        session = http_clients.get_session('genius')
+        session.headers.update(self.genius._session.headers)
+        self.genius._session = session
+        self.limiter = get_limiter('genius')
+        self.breaker = get_breaker('genius')
+
+    def tearDown(self):
+        # Undo the pause so other tests start from an unthrottled limiter
+        with self.limiter.cond:
+            self.limiter.blocked_until = 0.0
+            self.limiter.window = float(self.limiter.max_concurrency)
+
+    def test_429_is_recorded_as_throttled_with_retry_after(self):
+        throttled_before = self.limiter.counts['throttled']
+        window_before = self.limiter.window
+        with mock.patch.object(HTTPAdapter, 'send',
+                               side_effect=lambda request, **kwargs: fake_response(request, 429, {'Retry-After': '7'})):
+            lyrics = lyrics_service.fetch_lyrics_with_genius(self.genius, 'Song', 'Artist')
+
+        # Unanswered, so the miss isn't cached as "no lyrics"
+        self.assertIsNone(lyrics)
+        self.assertEqual(self.limiter.counts['throttled'], throttled_before + 1)
+        self.assertLess(self.limiter.window, window_before)
+        self.assertGreater(self.limiter.snapshot()['paused_for_seconds'], 5)
+        # Throttling isn't a failure, so it doesn't count towards opening the breaker
+        self.assertEqual(self.breaker.consecutive_failures, 0)
+
+    def test_404_is_a_client_error_answer(self):
+        client_errors_before = self.limiter.counts['client_errors']
+        with mock.patch.object(HTTPAdapter, 'send',
+                               side_effect=lambda request, **kwargs: fake_response(request, 404)):
+            lyrics = lyrics_service.fetch_lyrics_with_genius(self.genius, 'Song', 'Artist')
+
+        self.assertEqual(lyrics, "")
+        self.assertEqual(self.limiter.counts['client_errors'], client_errors_before + 1)
+
+if __name__ == '__main__':
+    unittest.main()
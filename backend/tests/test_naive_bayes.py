@@ -0,0 +1,68 @@
+# this file checks the array-backed NaiveBayesMoodClassifier against the original dict-based one, and that
+# partial_fit matches one fit on all examples (run with `python -m pytest tests` from backend/)
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_naive_bayes import DictNaiveBayesMoodClassifier, load_examples, make_documents
+from naive_bayes import NaiveBayesMoodClassifier
+
+class NaiveBayesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.examples = load_examples()
+        cls.documents = make_documents(cls.examples, 200)
+
+    def assertSamePosteriors(self, expected, actual, documents=None):
+        for lyrics in documents or self.documents:
+            expected_probs = expected.predict_proba(lyrics)
+            actual_probs = actual.predict_proba(lyrics)
+            self.assertEqual(set(expected_probs), set(actual_probs))
+            for mood, prob in expected_probs.items():
+                self.assertAlmostEqual(prob, actual_probs[mood], places=9)
+
+    def test_matches_dict_implementation(self):
+        reference = DictNaiveBayesMoodClassifier()
+        reference.fit(self.examples)
+        classifier = NaiveBayesMoodClassifier()
+        classifier.fit(self.examples)
+
+        # The dict-based predict is slow, so it only scores a sample
+        documents = self.documents[:40]
+        self.assertSamePosteriors(reference, classifier, documents)
+        for threshold in (0.1, 0.3):
+            expected = [sorted(reference.predict(lyrics, threshold)) for lyrics in documents]
+            self.assertEqual(expected, [sorted(moods) for moods in classifier.predict_batch(documents, threshold)])
+            self.assertEqual(expected, [sorted(classifier.predict(lyrics, threshold)) for lyrics in documents])
+
+    def test_partial_fit_matches_one_fit(self):
+        full = NaiveBayesMoodClassifier()
+        full.fit(self.examples)
+
+        # New words and moods arrive in the later batches
+        incremental = NaiveBayesMoodClassifier()
+        for start in range(0, len(self.examples), 7):
+            incremental.partial_fit(self.examples[start:start + 7])
+
+        self.assertEqual(full.mood_counts, incremental.mood_counts)
+        self.assertEqual(set(full.vocab), set(incremental.vocab))
+        self.assertSamePosteriors(full, incremental)
+
+    def test_copy_leaves_original_unchanged(self):
+        half = len(self.examples) // 2
+        classifier = NaiveBayesMoodClassifier()
+        classifier.fit(self.examples[:half])
+        before = {lyrics: classifier.predict_proba(lyrics) for lyrics in self.documents}
+
+        refitted = classifier.copy()
+        refitted.partial_fit(self.examples[half:])
+
+        self.assertEqual(before, {lyrics: classifier.predict_proba(lyrics) for lyrics in self.documents})
+        full = NaiveBayesMoodClassifier()
+        full.fit(self.examples)
+        self.assertSamePosteriors(full, refitted)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { BrowserRouter as Router, Routes, Route, Navigate } from 'react-router-dom';
 import LoginPage from './pages/LoginPage';
 import PlayerPage from './pages/PlayerPage';
@@ -21,6 +21,9 @@ export const getApiEndpoint = (pathStartingWithApi: string) => {
   }
 };
 
+// How often the playing mood's tracks are refreshed while the library is still being analyzed
+const MOOD_REFRESH_INTERVAL_MS = 10000;
+
 // Types
 interface SpotifyDevice {
   id: string;
@@ -67,6 +70,9 @@ function App() {
   const [message, setMessage] = useState<Message | null>(null);
   const [devices, setDevices] = useState<SpotifyDevice[]>([]);
   const [selectedDevice, setSelectedDevice] = useState<SpotifyDevice | null>(null);
+  const [analysisRunning, setAnalysisRunning] = useState<boolean>(false);
+  // Tracks already sent to Spotify for the selected mood
+  const sentTrackUris = useRef<Set<string>>(new Set());
 
   const checkAuthStatus = useCallback(async () => {
     try {
@@ -128,6 +134,7 @@ function App() {
         setDevices([]);
         setSelectedDevice(null);
         setMessage(null);
+        setAnalysisRunning(false);
       }
     } catch (error) {
       console.error('Logout failed:', error);
@@ -167,7 +174,9 @@ function App() {
 
         // If no tracks for this mood, show message and return early
         if (!moodData.track_uris || moodData.track_uris.length === 0) {
-            setMessage({ type: 'warning', text: `No ${mood} tracks found in your library. Try another mood.` });
+            setMessage({ type: 'warning', text: analysisRunning
+                ? `No ${mood} tracks found yet. Your library is still being analyzed, try again in a moment.`
+                : `No ${mood} tracks found in your library. Try another mood.` });
             setSelectedMood(null);
             return;
         }
@@ -193,6 +202,7 @@ function App() {
             throw new Error(errorData.error || 'Failed to play tracks');
         }
 
+        sentTrackUris.current = new Set(moodData.track_uris);
         setMessage({ type: 'success', text: `Playing ${mood} music...` });
 
     } catch (error) {
@@ -208,6 +218,44 @@ function App() {
     checkAuthStatus();
   }, [checkAuthStatus]);
 
+  // While the analysis stores more tracks, queue the playing mood's new ones behind what's already playing
+  useEffect(() => {
+    if (!analysisRunning || !selectedMood || !selectedDevice) return;
+    const refreshMoodTracks = async () => {
+      try {
+        const response = await fetch(getApiEndpoint('/api/mood-tracks?mood=' + selectedMood.toLowerCase()), {
+          credentials: 'include',
+          headers: {
+            'Cache-Control': 'no-cache',
+            'Pragma': 'no-cache'
+          }
+        });
+        if (!response.ok) return;
+        const moodData = await response.json();
+        const newUris = (moodData.track_uris || []).filter((uri: string) => !sentTrackUris.current.has(uri));
+        if (newUris.length === 0) return;
+        const queueResponse = await fetch(getApiEndpoint('/api/queue'), {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          credentials: 'include',
+          body: JSON.stringify({
+            track_uris: newUris,
+            device_id: selectedDevice.id
+          })
+        });
+        if (queueResponse.ok) {
+          newUris.forEach((uri: string) => sentTrackUris.current.add(uri));
+        }
+      } catch (error) {
+        console.error('Failed to refresh mood tracks:', error);
+      }
+    };
+    const interval = setInterval(refreshMoodTracks, MOOD_REFRESH_INTERVAL_MS);
+    return () => clearInterval(interval);
+  }, [analysisRunning, selectedMood, selectedDevice]);
+
   return (
     <Router>
       <div className="app">
@@ -221,6 +269,7 @@ function App() {
             element={
               <LoginSuccess 
                 checkAuthStatus={checkAuthStatus}
+                setAnalysisRunning={setAnalysisRunning}
               />
             } 
           />
@@ -230,6 +279,7 @@ function App() {
               <PlayerPage
                 isAuthenticated={isAuthenticated}
                 isLoading={isLoading}
+                isAnalyzing={analysisRunning}
                 selectedMood={selectedMood}
                 message={message?.text || ''}
                 devices={devices}
@@ -246,6 +296,7 @@ function App() {
                 <PlayerPage
                   isAuthenticated={isAuthenticated}
                   isLoading={isLoading}
+                  isAnalyzing={analysisRunning}
                   selectedMood={selectedMood}
                   message={message?.text || ''}
                   devices={devices}
@@ -3,46 +3,129 @@ import { useNavigate } from 'react-router-dom';
 import MusicAnalysisLoading from './MusicAnalysisLoading';
 import { getApiEndpoint } from '../App';
 
-const LoginSuccess: React.FC<{ checkAuthStatus: () => Promise<void> }> = ({ checkAuthStatus }) => {
+// How often to check on a queued analysis job
+const ANALYSIS_POLL_INTERVAL_MS = 2000;
+
+interface LoginSuccessProps {
+  checkAuthStatus: () => Promise<void>;
+  setAnalysisRunning: (running: boolean) => void;
+}
+
+// Read an NDJSON response line by line, passing each parsed event on as it arrives
+const readEvents = async (response: Response, onEvent: (event: any) => void) => {
+  const reader = response.body!.getReader();
+  const decoder = new TextDecoder();
+  let buffered = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffered += decoder.decode(value, { stream: true });
+    const lines = buffered.split('\n');
+    buffered = lines.pop() || '';
+    for (const line of lines) {
+      if (line.trim()) onEvent(JSON.parse(line));
+    }
+  }
+};
+
+const LoginSuccess: React.FC<LoginSuccessProps> = ({ checkAuthStatus, setAnalysisRunning }) => {
   const navigate = useNavigate();
   const [isAnalyzing, setIsAnalyzing] = useState(false);
   const [error, setError] = useState<string | null>(null);
 
   useEffect(() => {
+    // Go to the player as soon as the first moods are stored; the analysis keeps running in the background
+    let showingPlayer = false;
+    const showPlayer = () => {
+      if (showingPlayer) return;
+      showingPlayer = true;
+      navigate('/player', { replace: true });
+    };
+    const fail = (message: string) => {
+      setAnalysisRunning(false);
+      if (showingPlayer) {
+        // The moods stored so far stay playable
+        console.error('Library analysis stopped early:', message);
+        return;
+      }
+      navigate('/failure', { replace: true, state: { error: message } });
+    };
+    const finish = (data: any) => {
+      if (!data.message || !data.message.toLowerCase().includes('analyzed')) {
+        fail('Analysis did not complete successfully. Please try again.');
+        return;
+      }
+      setAnalysisRunning(false);
+      showPlayer();
+    };
+
     const handleLoginSuccess = async () => {
       try {
         await checkAuthStatus();
         setIsAnalyzing(true);
         setError(null);
-        
+
         // Only trigger analysis once, right after login
-        const response = await fetch(getApiEndpoint('/api/analyze'), {
+        let response = await fetch(getApiEndpoint('/api/analyze/stream'), {
           method: 'POST',
           credentials: 'include'
         });
-        
-        const data = await response.json();
-        
-        if (!response.ok) {
-          navigate('/failure', { replace: true, state: { error: data.error || 'Failed to analyze your library. Please try again.' } });
+        setAnalysisRunning(response.ok);
+
+        // Queued analysis: poll the job until the worker has stored the first moods, then until it's done
+        if (response.status === 202) {
+          let data = await response.json();
+          while (data.status === 'queued' || data.status === 'running') {
+            if ((data.progress?.tracks_with_moods || 0) > 0) showPlayer();
+            await new Promise(resolve => setTimeout(resolve, ANALYSIS_POLL_INTERVAL_MS));
+            response = await fetch(getApiEndpoint(`/api/analyze/${data.job_id}`), {
+              credentials: 'include'
+            });
+            data = await response.json();
+            if (!response.ok) break;
+          }
+          if (!response.ok || data.status === 'failed') {
+            fail(data.error || 'Failed to analyze your library. Please try again.');
+            return;
+          }
+          finish(data);
           return;
         }
-        
-        if (!data.message || !data.message.toLowerCase().includes('analyzed')) {
-          navigate('/failure', { replace: true, state: { error: 'Analysis did not complete successfully. Please try again.' } });
+
+        if (!response.ok) {
+          const data = await response.json();
+          fail(data.error || 'Failed to analyze your library. Please try again.');
           return;
         }
-        
-        // Success: redirect to player
-        navigate('/player', { replace: true });
+
+        // Inline analysis: stored tracks arrive as 'tracks' events, the result as 'done'
+        let finished = false;
+        await readEvents(response, (event) => {
+          if (event.event === 'tracks' && event.tracks.length > 0) {
+            showPlayer();
+          } else if (event.event === 'done') {
+            finished = true;
+            if (event.status_code !== 200) {
+              fail(event.error || 'Failed to analyze your library. Please try again.');
+            } else {
+              finish(event);
+            }
+          } else if (event.event === 'error') {
+            finished = true;
+            fail(event.error || 'Failed to analyze your library. Please try again.');
+          }
+        });
+        if (!finished) {
+          fail('Analysis did not complete successfully. Please try again.');
+        }
       } catch (error) {
         console.error('Login verification or analysis failed:', error);
-        navigate('/failure', { replace: true, state: { error: 'Login verification or analysis failed. Please try again.' } });
+        fail('Login verification or analysis failed. Please try again.');
       }
     };
-    
+
     handleLoginSuccess();
-  }, [checkAuthStatus, navigate]);
+  }, [checkAuthStatus, navigate, setAnalysisRunning]);
 
   if (isAnalyzing) {
     return <MusicAnalysisLoading />;
@@ -51,4 +134,4 @@ const LoginSuccess: React.FC<{ checkAuthStatus: () => Promise<void> }> = ({ chec
   return null;
 };
 
-export default LoginSuccess;
\ No newline at end of file
+export default LoginSuccess;
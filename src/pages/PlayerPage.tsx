@@ -6,6 +6,7 @@ import './PlayerPage.css';
 interface PlayerPageProps {
   isAuthenticated: boolean;
   isLoading: boolean;
+  isAnalyzing: boolean;
   selectedMood: string | null;
   message: string;
   devices: SpotifyDevice[];
@@ -19,6 +20,7 @@ function PlayerPage(props: PlayerPageProps) {
   const {
     isAuthenticated,
     isLoading,
+    isAnalyzing,
     selectedMood,
     message,
     devices,
@@ -55,6 +57,9 @@ function PlayerPage(props: PlayerPageProps) {
         <h1 className="login-title float-in-delay-2">Mood Player</h1>
         <p className="subtitle float-in-delay-3">Select your mood and device</p>
         <p className="tagline float-in-delay-4" style={{ color: '#b3b3b3' }}>Let your feelings pick the soundtrack</p>
+        {isAnalyzing && (
+          <p className="tagline float-in-delay-5" style={{ color: '#b3b3b3' }}>Still analyzing your library, more tracks are added to each mood as they're classified</p>
+        )}
       </header>
       <main
         className="float-in-delay-5"